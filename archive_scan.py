@@ -0,0 +1,242 @@
+"""Scan the saved receipt PDFs and check history against them, or rebuild it from them.
+
+The PDFs under the customers' SaveFolders are the legal record. scan() walks
+those folders and reads each receipt in a process pool. A file name like
+'Gazoz 00026 jun 25.pdf' gives the customer and number. The overlay text is
+extracted from the slot boxes in receiptGen.overlay_boxes (pypdfium2 returns
+the Hebrew in logical order). Results are cached per machine and keyed by
+path, mtime and size, so a re-scan only opens files that changed.
+
+compare() matches the PDFs with history and reports:
+  pdf_only      a receipt PDF with no history record (rebuild_records() restores these)
+  pdf_mismatch  amount, date or description differ between the PDF and history
+  no_pdf        a history record whose PDF was not found in its SaveFolder
+  pdf_error     a PDF that could not be read
+
+    python archive_scan.py verify [folder ...] [--workers N]
+    python archive_scan.py rebuild [folder ...]      append records for pdf_only receipts
+"""
+import os
+import re
+import calendar
+from concurrent.futures import ProcessPoolExecutor
+from store import CUSTOMERS_FILE, DB_DIR, HISTORY_FILE, LOCAL_DIR, read_json, write_json_atomic
+from tracing import span
+
+SCAN_CACHE_FILE = os.path.join(LOCAL_DIR, "archive_scan_cache.json")
+# Files per task sent to a worker; opening a PDF is quick, so batch them
+SCAN_CHUNK = 16
+FILENAME_RE = re.compile(r"^(?P<name>.+?) (?P<num>\d{3,6})(?: (?P<mon>[a-z]{3}) (?P<yy>\d{2}))?(?P<recreate>_recreate)?\.pdf$", re.IGNORECASE)
+_MONTHS = {calendar.month_abbr[m].lower(): m for m in range(1, 13)}
+# Labels on the bank line, as extracted (logical order)
+BANK_FIELDS = (
+    ("bank_transfer_referance", r"אסמכתא:\s*(\S+)"),
+    ("transfer_bankAccount", r"מחשבון\s*:?\s*(\S+)"),
+    ("CheckNumber", r"מס צ'ק:\s*(\S+)"),
+    ("BankNumber", r"בנק:\s*(\S+)"),
+    ("bankAccount", r"(?<!מ)חשבון:\s*(\S+)"),
+)
+
+
+def parse_filename(filename):
+    """(customer, number, month, year) from a saved receipt name, or None if it is not one."""
+    m = FILENAME_RE.match(filename)
+    if not m or m.group("recreate"):
+        return None
+    month = _MONTHS.get((m.group("mon") or "").lower())
+    year = 2000 + int(m.group("yy")) if m.group("yy") else None
+    return m.group("name"), int(m.group("num")), month, year
+
+
+def extract_fields(path):
+    """Read the overlay text of a receipt PDF into receipt fields."""
+    import pypdfium2
+    from receiptGen import overlay_boxes
+    doc = pypdfium2.PdfDocument(path)
+    try:
+        textpage = doc[0].get_textpage()
+        raw = {slot: textpage.get_text_bounded(left=l, bottom=b, right=r, top=t).strip()
+               for slot, (l, b, r, t) in overlay_boxes().items()}
+    finally:
+        doc.close()
+    fields = {k: raw.get(k, "") for k in ("recipeNum", "payment", "mamVal", "discription", "Date")}
+    for field, pattern in BANK_FIELDS:
+        m = re.search(pattern, raw.get("bank", ""))
+        if m:
+            fields[field] = m.group(1)
+    return fields
+
+
+def _scan_files(paths):
+    # Runs in a worker process
+    results = []
+    for path in paths:
+        try:
+            results.append((path, extract_fields(path), None))
+        except Exception as e:
+            results.append((path, None, str(e)))
+    return results
+
+
+def default_roots(customers_path=CUSTOMERS_FILE):
+    """Every customer's SaveFolder, plus DB_DIR (the generator's fallback folder)."""
+    roots = {DB_DIR}
+    try:
+        for data in read_json(customers_path).values():
+            folder = isinstance(data, dict) and data.get("SaveFolder")
+            if folder and os.path.isabs(folder):
+                roots.add(folder)
+    except Exception:
+        pass
+    # Nested roots would be walked twice
+    roots = sorted(os.path.normpath(r) for r in roots if os.path.isdir(r))
+    return [r for i, r in enumerate(roots) if not any(r.startswith(p + os.sep) for p in roots[:i])]
+
+
+def _walk_pdfs(roots):
+    for root in roots:
+        for folder, _, files in os.walk(root):
+            for filename in files:
+                if filename.lower().endswith(".pdf") and parse_filename(filename):
+                    yield os.path.join(folder, filename)
+
+
+def scan(roots=None, workers=None, progress=None, cache_path=SCAN_CACHE_FILE):
+    """
+    Return ({path: entry}, files_read) for every receipt PDF under `roots`. Each entry
+    holds the customer, number and month/year from the file name, the extracted
+    `fields` (None if the PDF could not be read) and the `error`.
+    """
+    try:
+        cache = read_json(cache_path)
+    except Exception:
+        cache = {}
+    roots = default_roots() if roots is None else roots
+    results = {}
+    todo = []
+    with span("archive.walk"):
+        for path in _walk_pdfs(roots):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            stamp = [st.st_mtime_ns, st.st_size]
+            cached = cache.get(path)
+            if cached and cached["stamp"] == stamp:
+                results[path] = cached
+            else:
+                name, num, month, year = parse_filename(os.path.basename(path))
+                results[path] = {"stamp": stamp, "customer": name, "num": num, "month": month, "year": year,
+                                 "fields": None, "error": None}
+                todo.append(path)
+    if todo:
+        chunks = [todo[i:i + SCAN_CHUNK] for i in range(0, len(todo), SCAN_CHUNK)]
+        done = 0
+        with span("archive.extract"), ProcessPoolExecutor(max_workers=workers) as pool:
+            for batch in pool.map(_scan_files, chunks):
+                for path, fields, error in batch:
+                    results[path].update(fields=fields, error=error)
+                done += len(batch)
+                if progress:
+                    progress(done, len(todo))
+    # Files that disappeared drop out of the cache
+    write_json_atomic(cache_path, results, indent=None)
+    return results, len(todo)
+
+
+def _num(value):
+    text = str(value or "").strip()
+    return int(text) if text.isdigit() else None
+
+
+def _amount(value):
+    try:
+        return round(float(str(value).replace(",", "").strip()), 2)
+    except ValueError:
+        return None
+
+
+def _words(text):
+    return sorted(str(text or "").split())
+
+
+def compare(scan_results, history):
+    """Match scanned PDFs with history ({key: {customer: data}}); returns [(kind, number, detail, path)]."""
+    by_num = {}
+    issues = []
+    for path, entry in scan_results.items():
+        if entry["error"]:
+            issues.append(("pdf_error", entry["num"], entry["error"], path))
+            continue
+        num = _num(entry["fields"].get("recipeNum")) or entry["num"]
+        by_num.setdefault(num, []).append((path, entry))
+    seen = set()
+    for key, item in history.items():
+        if not isinstance(item, dict) or not item:
+            continue
+        cust = next(iter(item))
+        data = item[cust]
+        num = _num(data.get("recipeNum")) or _num(key)
+        if num is None:
+            continue
+        seen.add(num)
+        pdfs = by_num.get(num)
+        if not pdfs:
+            issues.append(("no_pdf", num, f"{cust}: no saved PDF found", ""))
+            continue
+        for path, entry in pdfs:
+            fields = entry["fields"]
+            diffs = []
+            if _amount(fields.get("payment")) != _amount(data.get("payment")):
+                diffs.append(f"payment {fields.get('payment')!r} vs {data.get('payment')!r}")
+            if fields.get("Date", "").strip() != str(data.get("Date", "")).strip():
+                diffs.append(f"Date {fields.get('Date')!r} vs {data.get('Date')!r}")
+            if _words(fields.get("discription")) != _words(data.get("discription")):
+                diffs.append("description differs")
+            if diffs:
+                issues.append(("pdf_mismatch", num, "PDF vs history: " + "; ".join(diffs), path))
+    for num, pdfs in by_num.items():
+        if num not in seen:
+            for path, entry in pdfs:
+                issues.append(("pdf_only", num, f"{entry['customer']}: not in history", path))
+    issues.sort(key=lambda i: (i[0], i[1] or 0))
+    return issues
+
+
+def rebuild_records(scan_results, issues):
+    """History records ({key: {customer: data}}) for the PDFs that history is missing."""
+    records = {}
+    for kind, num, _, path in issues:
+        if kind != "pdf_only":
+            continue
+        entry = scan_results[path]
+        data = {"customer": entry["customer"], "invoice_no": "", "SaveFolder": os.path.dirname(path)}
+        data.update(entry["fields"])
+        data["recipeNum"] = f"{num:05d}"
+        records[f"{num:05d}"] = {entry["customer"]: data}
+    return records
+
+
+if __name__ == "__main__":
+    import argparse
+    from store import load_history
+    parser = argparse.ArgumentParser(description="Verify or rebuild history from the saved receipt PDFs")
+    parser.add_argument("command", choices=("verify", "rebuild"))
+    parser.add_argument("folders", nargs="*", help="folders to scan (default: every customer's SaveFolder)")
+    parser.add_argument("--history", default=HISTORY_FILE)
+    parser.add_argument("--workers", type=int)
+    args = parser.parse_args()
+    results, opened = scan(args.folders or None, args.workers, lambda d, t: print(f"\r{d}/{t}", end=""))
+    print(f"\n{len(results)} receipt PDFs, {opened} read (the rest unchanged since the last scan)")
+    history = load_history(args.history)
+    issues = compare(results, history)
+    for kind, num, detail, path in issues:
+        print(f"{kind:<13} {'' if num is None else f'{num:05d}':>6}  {detail}  {path}")
+    if args.command == "rebuild":
+        from history_store import append_history
+        records = rebuild_records(results, issues)
+        if records:
+            append_history(args.history, records, backup=True)
+        print(f"Restored {len(records)} history records from PDFs")
+    elif not issues:
+        print("OK: history matches the archive")
@@ -0,0 +1,389 @@
+"""Match bank statement credits to customers and queue receipts for them.
+
+Statements (CSV or XLSX) are read row by row; XLSX uses openpyxl read-only
+mode. Each credit is matched in this order:
+  1. transfer reference    (customer's bank_transfer_referance)
+  2. payer account number  (bankAccount / transfer_bankAccount)
+  3. Hebrew name           (exact, against key and display name)
+  4. amount                (customer's usual payment, only if unique)
+  5. Hebrew name           (difflib-fuzzy, preferring a customer whose payment agrees)
+Everything except the fuzzy fallback is a dict lookup, so matching stays
+linear in the statement. Name matches are shown but only issued when the
+user selects them; "Generate" alone issues the CONFIDENT_METHODS rows.
+Matched credits become receipt records that batch_render.issue_receipts
+creates in one pass. Every credit gets an id (a hash of its fields, plus a
+count for identical credits in one statement); ids of credits that got a
+receipt are kept in bank_issued.json in the DB folder, so reopening the
+statement, or a later one that overlaps it, does not issue them again.
+"""
+import os
+import re
+import csv
+import difflib
+from datetime import date, datetime
+import hashlib
+import tkinter as tk
+from tkinter import ttk, messagebox, filedialog
+from store import DB_DIR
+
+FUZZY_CUTOFF = 0.6
+# Match methods issued without the user selecting the row
+CONFIDENT_METHODS = ("reference", "account", "account+amount", "amount")
+# {credit id: receipt number} of every credit a receipt was issued for
+BANK_ISSUED_FILE = os.path.join(DB_DIR, "bank_issued.json")
+_ID_FIELDS = ("date", "amount", "account", "bank", "reference", "check", "description")
+
+# Canonical column -> header spellings seen in Israeli bank exports (compared lower-cased)
+COLUMN_ALIASES = {
+    "date": ("date", "transaction date", "value date", "תאריך", "תאריך ערך", "תאריך פעולה"),
+    "amount": ("amount", "credit", "credit amount", "סכום", "זכות", "בזכות", "סכום זכות"),
+    "account": ("account", "from account", "payer account", "חשבון", "מספר חשבון", "חשבון מקור"),
+    "bank": ("bank", "bank number", "בנק", "מספר בנק"),
+    "reference": ("reference", "ref", "asmachta", "אסמכתא", "אסמכתה"),
+    "check": ("check", "cheque", "check number", "מספר שיק", "מספר צ'ק", "מס צ'ק", "שיק"),
+    "description": ("description", "details", "name", "payer", "תיאור", "פרטים", "שם", "תאור"),
+}
+_HEADER_LOOKUP = {alias: canon for canon, aliases in COLUMN_ALIASES.items() for alias in aliases}
+
+
+def _digits(value):
+    return re.sub(r"\D", "", str(value or "")).lstrip("0")
+
+
+def _amount(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = re.sub(r"[^\d.\-]", "", str(value).replace(",", ""))
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def _amount_key(value):
+    amt = _amount(value)
+    return None if amt is None else round(amt, 2)
+
+
+def _norm_name(text):
+    return re.sub(r"[\s\"'״׳.,\-]+", " ", str(text or "")).strip().casefold()
+
+
+def _format_date(value):
+    """Bank dates (datetime, 'dd/mm/yyyy', 'dd.mm.yy', 'yyyy-mm-dd') -> 'dd/mm/yyyy' like the form uses."""
+    if isinstance(value, (datetime, date)):
+        return value.strftime("%d/%m/%Y")
+    text = str(value or "").strip()
+    m = re.match(r"^(\d{4})-(\d{1,2})-(\d{1,2})", text)
+    if m:
+        return f"{int(m.group(3)):02d}/{int(m.group(2)):02d}/{m.group(1)}"
+    m = re.match(r"^(\d{1,2})[./\-](\d{1,2})[./\-](\d{2,4})$", text)
+    if m:
+        year = int(m.group(3))
+        if year < 100:
+            year += 2000
+        return f"{int(m.group(1)):02d}/{int(m.group(2)):02d}/{year}"
+    return text
+
+
+def _format_amount(amt):
+    return str(int(amt)) if float(amt).is_integer() else f"{amt:.2f}"
+
+
+def _iter_raw_rows(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".xlsx", ".xlsm"):
+        import openpyxl
+        wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            for row in wb.active.iter_rows(values_only=True):
+                yield list(row)
+        finally:
+            wb.close()
+        return
+    with open(path, "r", encoding=_detect_encoding(path), newline="") as f:
+        for row in csv.reader(f):
+            yield row
+
+
+def _detect_encoding(path):
+    # Israeli banks export either UTF-8 or Windows-1255; validate in chunks without keeping the text
+    try:
+        with open(path, "r", encoding="utf-8-sig") as f:
+            while f.read(64 * 1024):
+                pass
+        return "utf-8-sig"
+    except UnicodeDecodeError:
+        return "cp1255"
+
+
+def read_transactions(path):
+    """Yield dicts with canonical keys (date, amount, account, ..., id) for each credit row."""
+    columns = None
+    seen = {}
+    for row in _iter_raw_rows(path):
+        if columns is None:
+            # The header is the first row naming at least a date and an amount column
+            mapped = {i: _HEADER_LOOKUP.get(str(cell or "").strip().lower()) for i, cell in enumerate(row)}
+            found = set(v for v in mapped.values() if v)
+            if {"date", "amount"} <= found:
+                columns = {i: canon for i, canon in mapped.items() if canon}
+            continue
+        tx = {canon: row[i] for i, canon in columns.items() if i < len(row)}
+        amt = _amount(tx.get("amount"))
+        if amt is None or amt <= 0:
+            # Debits and blank lines are not payments to us
+            continue
+        tx["amount"] = amt
+        tx["date"] = _format_date(tx.get("date"))
+        tx["id"] = _tx_id(tx, seen)
+        yield tx
+
+
+def _tx_id(tx, seen):
+    fields = "\x1f".join(str(tx.get(k) if tx.get(k) is not None else "").strip() for k in _ID_FIELDS)
+    # Two identical credits on the same statement are still two payments
+    seen[fields] = seen.get(fields, 0) + 1
+    return hashlib.sha1(f"{fields}\x1f{seen[fields]}".encode("utf-8")).hexdigest()[:16]
+
+
+def load_issued(path=BANK_ISSUED_FILE):
+    """{credit id: receipt number} for the credits already issued."""
+    from versioned_store import read_versioned
+    return read_versioned(path).data
+
+
+def record_issued(ids, path=BANK_ISSUED_FILE):
+    """Add {credit id: receipt number} to the issued credits."""
+    from versioned_store import update_versioned
+    update_versioned(path, lambda issued: issued.update(ids))
+
+
+class CustomerMatcher:
+    def __init__(self, customers):
+        self.customers = customers
+        self.by_reference = {}
+        self.by_account = {}
+        self.by_amount = {}
+        self.names = {}
+        for key, data in customers.items():
+            if not isinstance(data, dict):
+                continue
+            ref = _digits(data.get("bank_transfer_referance"))
+            if ref:
+                self.by_reference.setdefault(ref, []).append(key)
+            for field in ("bankAccount", "transfer_bankAccount"):
+                acct = _digits(data.get(field))
+                if acct:
+                    self.by_account.setdefault(acct, [])
+                    if key not in self.by_account[acct]:
+                        self.by_account[acct].append(key)
+            amt = _amount_key(data.get("payment"))
+            if amt is not None:
+                self.by_amount.setdefault(amt, []).append(key)
+            for name in (key, data.get("customer")):
+                if name:
+                    self.names.setdefault(_norm_name(name), key)
+
+    def match(self, tx):
+        """Return (customer_key, method) for a transaction, or (None, None)."""
+        amt = _amount_key(tx.get("amount"))
+        ref = _digits(tx.get("reference"))
+        if ref and len(self.by_reference.get(ref, [])) == 1:
+            return self.by_reference[ref][0], "reference"
+        acct = _digits(tx.get("account"))
+        if acct and acct in self.by_account:
+            keys = self.by_account[acct]
+            if len(keys) == 1:
+                return keys[0], "account"
+            # Several properties paid from one account: the amount decides
+            same_amount = [k for k in keys if _amount_key(self.customers[k].get("payment")) == amt]
+            if len(same_amount) == 1:
+                return same_amount[0], "account+amount"
+        desc = _norm_name(tx.get("description"))
+        if desc and desc in self.names:
+            return self.names[desc], "name"
+        if amt is not None and len(self.by_amount.get(amt, [])) == 1:
+            return self.by_amount[amt][0], "amount"
+        if desc:
+            # Only a fallback: a similar name is a guess
+            close = difflib.get_close_matches(desc, list(self.names), n=3, cutoff=FUZZY_CUTOFF)
+            if close:
+                # Prefer a close name whose usual payment equals this amount
+                for name in close:
+                    if _amount_key(self.customers[self.names[name]].get("payment")) == amt:
+                        return self.names[name], "name+amount"
+                return self.names[close[0]], "fuzzy name"
+        return None, None
+
+
+def receipt_for(customer, tx):
+    """Receipt record for a matched credit, starting from the customer's saved defaults."""
+    data = dict(customer)
+    data.pop("recipeNum", None)
+    data["payment"] = _format_amount(tx["amount"])
+    data["Date"] = tx.get("date", "")
+    ref = str(tx.get("reference") or "").strip()
+    check = str(tx.get("check") or "").strip()
+    if check:
+        data["CheckNumber"] = check
+        data["bank_transfer_referance"] = ""
+        if tx.get("account"):
+            data["bankAccount"] = str(tx["account"]).strip()
+        if tx.get("bank"):
+            data["BankNumber"] = str(tx["bank"]).strip()
+    elif ref:
+        data["bank_transfer_referance"] = ref
+        data["transfer_bankAccount"] = str(tx.get("account") or data.get("transfer_bankAccount") or "").strip()
+    return data
+
+
+def match_file(path, customers):
+    """Return [(tx, customer_key, method)] for every credit in the statement."""
+    matcher = CustomerMatcher(customers)
+    return [(tx,) + matcher.match(tx) for tx in read_transactions(path)]
+
+
+class BankImportApp(tk.Frame):
+    def __init__(self, master):
+        super().__init__(master)
+        self.master = master
+        self.pack(fill="both", expand=True, padx=10, pady=10)
+        self.results = []
+        self.issued = {}
+        self._generating = False
+        self.build_ui()
+
+    def build_ui(self):
+        row = tk.Frame(self)
+        row.pack(fill="x", pady=6)
+        tk.Button(row, text="Open Bank Statement (CSV/XLSX)", command=self.open_statement).pack(side="left")
+        tk.Button(row, text="Generate Receipts for Matched", command=self.generate_matched).pack(side="left", padx=(8, 0))
+        self.email_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(row, text="Email tenants", variable=self.email_var).pack(side="left", padx=(8, 0))
+        self.status = tk.Label(row, anchor="w")
+        self.status.pack(side="left", padx=(8, 0))
+
+        columns = ("date", "amount", "description", "customer", "method")
+        self.tree = ttk.Treeview(self, columns=columns, show="headings", selectmode="extended")
+        for col, width in zip(columns, (90, 80, 260, 160, 100)):
+            self.tree.heading(col, text=col)
+            self.tree.column(col, width=width)
+        self.tree.tag_configure("issued", foreground="grey")
+        self.tree.tag_configure("review", background="#fff3cd")
+        self.tree.pack(fill="both", expand=True, pady=(8, 0))
+
+    def open_statement(self):
+        from store import CUSTOMERS_FILE, read_json
+        path = filedialog.askopenfilename(title="Select Bank Statement", filetypes=[("Bank exports", "*.csv *.xlsx"), ("All files", "*.*")])
+        if not path:
+            return
+        try:
+            self.customers = read_json(CUSTOMERS_FILE)
+            self.results = match_file(path, self.customers)
+            self.issued = load_issued()
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to read statement: {e}")
+            return
+        self.tree.delete(*self.tree.get_children())
+        for i, (tx, key, method) in enumerate(self.results):
+            self.tree.insert("", tk.END, iid=str(i), values=(tx.get("date", ""), _format_amount(tx["amount"]), tx.get("description", ""), key or "-", method or "unmatched"))
+            if tx["id"] in self.issued:
+                self._show_issued(i)
+            elif key and method not in CONFIDENT_METHODS:
+                self.tree.item(str(i), tags=("review",))
+        matched = sum(1 for _, key, _ in self.results if key)
+        review = sum(1 for tx, key, method in self.results if key and method not in CONFIDENT_METHODS and tx["id"] not in self.issued)
+        done = sum(1 for tx, _, _ in self.results if tx["id"] in self.issued)
+        self.status.config(text=f"{len(self.results)} credits, {matched} matched" + (f", {review} by name (select to issue)" if review else "")
+                           + (f", {done} already issued" if done else ""))
+
+    def _show_issued(self, i):
+        self.tree.set(str(i), "method", f"issued {self.issued[self.results[i][0]['id']]}")
+        self.tree.item(str(i), tags=("issued",))
+
+    def generate_matched(self):
+        import threading
+        from batch_render import issue_receipts
+        if self._generating:
+            return
+        # Selected rows if any, otherwise every row matched by reference, account or amount
+        # that is not issued yet; name matches are guesses the user has to pick
+        selected = [int(i) for i in self.tree.selection()]
+        if not selected:
+            selected = [i for i, (_, _, method) in enumerate(self.results) if method in CONFIDENT_METHODS]
+        try:
+            # Current on disk: another machine may have issued some of these since the statement was opened
+            self.issued = load_issued()
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to read the issued credits: {e}")
+            return
+        items = []
+        rows = []
+        for i in selected:
+            tx, key, _ = self.results[i]
+            if tx["id"] in self.issued:
+                self._show_issued(i)
+            elif key:
+                items.append((key, receipt_for(self.customers[key], tx)))
+                rows.append(i)
+        if not items:
+            messagebox.showinfo("Nothing to do", "No matched credits to generate receipts for. Rows matched by name are only issued when selected.")
+            return
+        if not messagebox.askyesno("Generate", f"Issue {len(items)} new receipts?"):
+            return
+        self.status.config(text=f"Generating {len(items)} receipts...")
+        email = self.email_var.get()
+        self._generating = True
+
+        def work():
+            try:
+                issued, failed, sequence_issues = issue_receipts(items, email=email)
+            except Exception as e:
+                err = e
+                self.after(0, lambda: (setattr(self, "_generating", False),
+                                       messagebox.showerror("Error", f"Batch generation failed: {err}")))
+                return
+            ids = {self.results[rows[idx]][0]["id"]: recipe_key for recipe_key, _, idx in issued}
+            try:
+                record_issued(ids)
+                record_error = None
+            except Exception as e:
+                record_error = e
+            self.after(0, lambda: self._mark_issued(ids, rows))
+            msg = f"Issued {len(issued)} receipts"
+            if issued:
+                msg += f" ({issued[0][0]}-{issued[-1][0]})"
+            if record_error is not None:
+                msg += f"\nCould not record them as issued ({record_error}); do not issue these credits again"
+            if failed:
+                msg += f", {len(failed)} failed: " + "; ".join(f"{k}: {e}" for k, e in failed[:5])
+            if sequence_issues:
+                msg += "\nSequence: " + "; ".join(f"{kind} {detail}" for kind, _, detail in sequence_issues[:5])
+            if email and issued:
+                from mailer import deliver
+                try:
+                    sent, unsent = deliver()
+                    msg += f"\nEmailed {sent}" + (f", {unsent} will be retried" if unsent else "")
+                except Exception as e:
+                    msg += f"\nEmails queued, not sent: {e}"
+            self.after(0, lambda: (self.status.config(text=msg), messagebox.showinfo("Done", msg)))
+
+        threading.Thread(target=work, daemon=True).start()
+
+    def _mark_issued(self, ids, rows):
+        self._generating = False
+        self.issued.update(ids)
+        for i in rows:
+            if self.results[i][0]["id"] in self.issued:
+                self._show_issued(i)
+
+
+if __name__ == '__main__':
+    root = tk.Tk()
+    root.title("Bank Statement Import")
+    app = BankImportApp(root)
+    root.geometry('900x500')
+    root.mainloop()
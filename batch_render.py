@@ -0,0 +1,273 @@
+"""Render many receipts at once on a process pool.
+
+regenerate() re-renders existing history records. issue_receipts() creates new
+receipts in bulk with consecutive numbers: every receipt is rendered to a
+temporary file first, then the counter is advanced, the batch appended to
+history in a single write and the files renamed to their receipt names.
+
+Each regenerated output path is recorded in render_index.json together with the hash of
+the record and of the template assets it was rendered from. Records whose
+file still exists and whose hashes match are skipped, so re-running a year
+only re-renders what actually changed.
+"""
+import os
+import json
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from store import DB_DIR, HISTORY_FILE, RECEIPT_NUMBER_FILE, receipt_filename, write_json_atomic
+from zip_export import find_saved_pdf
+
+RENDER_INDEX_FILE = os.path.join(DB_DIR, "render_index.json")
+# Extra tries for a receipt whose render failed before it is left out of a batch
+RENDER_RETRIES = 2
+# Times issue_receipts renumbers a batch because numbers were taken while it rendered
+RESERVE_ATTEMPTS = 3
+
+
+def load_render_index(path=RENDER_INDEX_FILE):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def output_path_for(key, cust, data, listing_cache=None):
+    """Where a regenerated receipt goes: the existing file for that number, else SaveFolder/<name>."""
+    existing = find_saved_pdf(data, listing_cache)
+    if existing:
+        return existing
+    folder = data.get("SaveFolder") or DB_DIR
+    if not os.path.isabs(folder):
+        folder = DB_DIR
+    return os.path.join(folder, receipt_filename(cust, data.get("recipeNum", key), data.get("Date", "")))
+
+
+def _render_to(data, path, profile="standard"):
+    # Runs in a worker process
+    from receiptGen import render_receipt
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    pdf = render_receipt(data, profile=profile)
+    with open(path, "wb") as f:
+        f.write(pdf)
+    return path
+
+
+def regenerate(records, workers=None, force=False, progress=None, index_path=RENDER_INDEX_FILE):
+    """
+    Regenerate (key, customer, data) records.
+
+    Returns (rendered, skipped, failed) where failed is a list of (key, error message).
+    `progress(done, total)` is called from the calling thread after each record.
+    """
+    from receiptGen import data_hash, template_hash
+    index = load_render_index(index_path)
+    tmpl = template_hash()
+    listings = {}
+    jobs = []
+    skipped = 0
+    for key, cust, data in records:
+        path = output_path_for(key, cust, data, listings)
+        dh = data_hash(data)
+        entry = index.get(path)
+        if not force and entry and entry.get("data") == dh and entry.get("template") == tmpl and os.path.exists(path):
+            skipped += 1
+            continue
+        jobs.append((key, data, path, dh))
+    total = len(jobs) + skipped
+    done = skipped
+    rendered = 0
+    failed = []
+    if progress and skipped:
+        progress(done, total)
+    if jobs:
+        workers = workers or min(4, os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(_render_to, data, path): (key, path, dh) for key, data, path, dh in jobs}
+            for fut in as_completed(futures):
+                key, path, dh = futures[fut]
+                try:
+                    fut.result()
+                    index[path] = {"key": key, "data": dh, "template": tmpl}
+                    rendered += 1
+                except Exception as e:
+                    failed.append((key, str(e)))
+                done += 1
+                if progress:
+                    progress(done, total)
+        try:
+            write_json_atomic(index_path, index)
+        except Exception:
+            # A lost index only means the next run re-renders these files
+            pass
+    return rendered, skipped, failed
+
+
+def next_free_number(history_path=HISTORY_FILE, counter_path=RECEIPT_NUMBER_FILE):
+    """The counter's next number, moved past any number history already has (the counter may lag behind)."""
+    from history_store import highest_receipt_number
+    try:
+        with open(counter_path, "r", encoding="utf-8") as f:
+            counter = int(f.read().strip())
+    except (OSError, ValueError):
+        counter = 1
+    try:
+        highest = highest_receipt_number(history_path)
+    except FileNotFoundError:
+        highest = 0
+    return max(counter, highest + 1)
+
+
+def _job_path(cust_key, data):
+    folder = data.get("SaveFolder") or DB_DIR
+    if not os.path.isabs(folder):
+        folder = DB_DIR
+    return os.path.join(folder, receipt_filename(cust_key, data["recipeNum"], data.get("Date", "")))
+
+
+def _remove(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class _BatchRenderer:
+    """
+    Renders numbered jobs on a pool, retrying failures.
+
+    Each job is rendered to a temporary name next to its receipt path; publish()
+    renames them once the numbers are reserved, so a file with a receipt's name
+    only exists for a number that was actually issued.
+    """
+
+    def __init__(self, pool, profile, progress):
+        self.pool = pool
+        self.profile = profile
+        self.progress = progress
+        self.submitted = 0
+        self.finished = 0
+        # Temporary names end in .tmp, which the Drive sync skips
+        self._suffix = f".{uuid.uuid4().hex[:8]}.tmp"
+        # receipt path -> data it was rendered from (into its temporary file)
+        self.written = {}
+
+    def temp_path(self, path):
+        return path + self._suffix
+
+    def render(self, jobs):
+        """Render [(index, cust_key, data, path)]; returns {index: error} for those that failed every try."""
+        errors = {}
+        for _ in range(1 + RENDER_RETRIES):
+            todo = [j for j in jobs if self.written.get(j[3]) != j[2]]
+            if not todo:
+                return {}
+            self.submitted += len(todo)
+            futures = {self.pool.submit(_render_to, data, self.temp_path(path), self.profile): (i, data, path)
+                       for i, _, data, path in todo}
+            errors = {}
+            for fut in as_completed(futures):
+                i, data, path = futures[fut]
+                try:
+                    fut.result()
+                    self.written[path] = data
+                except Exception as e:
+                    errors[i] = str(e)
+                self.finished += 1
+                if self.progress:
+                    self.progress(self.finished, self.submitted)
+        return errors
+
+    def discard(self, keep=()):
+        keep = set(keep)
+        _remove([self.temp_path(p) for p in self.written if p not in keep])
+        self.written = {p: d for p, d in self.written.items() if p in keep}
+
+    def publish(self):
+        """Give every rendered file its receipt name."""
+        for path in self.written:
+            os.replace(self.temp_path(path), path)
+        self.written = {}
+
+
+def issue_receipts(items, workers=None, progress=None, profile="standard",
+                   history_path=HISTORY_FILE, counter_path=RECEIPT_NUMBER_FILE, email=False):
+    """
+    Create new receipts for [(customer_key, data)], where data is a full receipt record
+    without a receipt number.
+
+    Returns (issued, failed, sequence_issues): issued is [(recipe_key, path, index into items)],
+    failed is [(customer_key, error)] and sequence_issues comes from sequence_audit.check_appended.
+
+    The issued receipts get consecutive numbers from next_free_number(), so the
+    sequence has no gaps and never reuses a number history already has:
+      - a failed render is retried RENDER_RETRIES times; receipts that still fail are
+        left out and the ones after them renumbered (and re-rendered) to close the gap;
+      - the counter is only moved, and history written, once every PDF is on disk
+        under a temporary name. That happens under the counter lock after checking
+        nobody took numbers in the meantime; if someone did, or history refuses a
+        number (ConflictError, e.g. a receipt synced in from another machine), the
+        batch is renumbered and tried again. The files get their receipt names only
+        after history accepted the numbers, so no existing receipt is overwritten.
+    With email=True, receipts of customers with an email address are queued for mailer.deliver().
+    """
+    from history_store import append_history
+    from versioned_store import ConflictError, FileLock
+    if not items:
+        return [], [], []
+    failed = {}
+    workers = workers or min(4, os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        renderer = _BatchRenderer(pool, profile, progress)
+        try:
+            for _ in range(RESERVE_ATTEMPTS):
+                first = next_free_number(history_path, counter_path)
+                while True:
+                    jobs = []
+                    for i, (cust_key, data) in enumerate(items):
+                        if i in failed:
+                            continue
+                        data = dict(data, recipeNum=f"{first + len(jobs):05d}")
+                        jobs.append((i, cust_key, data, _job_path(cust_key, data)))
+                    errors = renderer.render(jobs)
+                    if not errors:
+                        break
+                    failed.update(errors)
+                # Files of receipts that were renumbered since they were rendered
+                renderer.discard(keep=[path for *_, path in jobs])
+                if not jobs:
+                    break
+                records = {data["recipeNum"]: {data.get("customer", "Unknown"): data} for _, _, data, _ in jobs}
+                with FileLock(counter_path):
+                    if next_free_number(history_path, counter_path) != first:
+                        # Numbers were taken while we rendered; start again from the new next number
+                        continue
+                    try:
+                        # One history write for the whole batch
+                        generation = append_history(history_path, records)
+                    except ConflictError:
+                        continue
+                    renderer.publish()
+                    with open(counter_path, "w", encoding="utf-8") as f:
+                        f.write(f"{first + len(jobs):05d}")
+                break
+            else:
+                raise RuntimeError("Receipt numbers kept changing while the batch was rendered; nothing was issued")
+        finally:
+            # Temporary files not published (nothing is left after a successful publish)
+            renderer.discard()
+    failed = [(items[i][0], err) for i, err in sorted(failed.items())]
+    if not jobs:
+        return [], failed, []
+    issued = [(data["recipeNum"], path, i) for i, _, data, path in jobs]
+    from sequence_audit import check_appended
+    sequence_issues = check_appended(history_path, [(k, next(iter(e.values()))) for k, e in records.items()], generation)
+    from ledger import record_appended
+    record_appended(history_path, [(k, *next(iter(e.items()))) for k, e in records.items()], generation)
+    if email:
+        from mailer import MailQueue
+        mail_queue = MailQueue()
+        for recipe_key, path, _ in issued:
+            mail_queue.enqueue_receipt(next(iter(records[recipe_key].values())), path)
+    return issued, failed, sequence_issues
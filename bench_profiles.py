@@ -0,0 +1,39 @@
+"""Compare size and render time of the standard and compact PDF profiles.
+
+Both profiles parse the SVG template once per process; one untimed render
+per profile does that first, so the times compare rendering only.
+
+    python bench_profiles.py [runs]
+"""
+import sys
+import json
+import time
+from receiptGen import render_receipt
+
+
+def bench(data, profile, runs):
+    times = []
+    size = 0
+    # Warm-up: parse the template (and prepare the compact signature) outside the timings
+    render_receipt(data, use_cache=False, profile=profile)
+    for _ in range(runs):
+        start = time.perf_counter()
+        pdf = render_receipt(data, use_cache=False, profile=profile)
+        times.append(time.perf_counter() - start)
+        size = len(pdf)
+    times.sort()
+    return size, times[len(times) // 2] * 1000, times[0] * 1000
+
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    with open("sample_data.json", "r", encoding="utf-8") as f:
+        data = json.load(f)
+    data.setdefault("Date", "01/06/2025")
+    print(f"{'profile':<10} {'size (bytes)':>12} {'median ms':>10} {'min ms':>8}")
+    results = {}
+    for profile in ("standard", "compact"):
+        size, median, best = bench(data, profile, runs)
+        results[profile] = size
+        print(f"{profile:<10} {size:>12} {median:>10.1f} {best:>8.1f}")
+    print(f"compact is {100.0 * results['compact'] / results['standard']:.0f}% of standard")
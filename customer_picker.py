@@ -0,0 +1,148 @@
+"""Type-ahead customer picker for the generator tab.
+
+CustomerIndex maps every substring of up to GRAM characters of each customer
+key and Hebrew display name to the keys containing it. A query of up to GRAM
+characters is a single dict lookup. Longer queries use the shortest posting
+list among their grams and are verified with a plain `in` check. The cost
+depends on how many customers match, not on how many customers there are.
+"""
+import os
+import json
+import tkinter as tk
+from tkinter import ttk
+from store import LOCAL_DIR
+
+GRAM = 3
+MAX_RESULTS = 30
+MAX_RECENT = 10
+RECENT_FILE = os.path.join(LOCAL_DIR, "recent_customers.json")
+
+
+def _norm(text):
+    return (text or "").casefold().strip()
+
+
+class CustomerIndex:
+    def __init__(self, customers):
+        # key -> normalized "key display" haystack
+        self.haystack = {}
+        self.labels = {}
+        self.grams = {}
+        self.keys = sorted(customers.keys())
+        for key in self.keys:
+            data = customers.get(key) or {}
+            display = data.get("customer", "") if isinstance(data, dict) else ""
+            self.labels[key] = f"{key} | {display}" if display and display != key else key
+            hay = _norm(key) + "\n" + _norm(display)
+            self.haystack[key] = hay
+            seen = set()
+            for i in range(len(hay)):
+                for n in range(1, GRAM + 1):
+                    g = hay[i:i + n]
+                    if len(g) < n or "\n" in g or g in seen:
+                        continue
+                    seen.add(g)
+                    self.grams.setdefault(g, []).append(key)
+
+    def search(self, text, recent=(), limit=MAX_RESULTS):
+        """Return up to `limit` keys matching `text`: recent ones first, then prefix matches, then the rest."""
+        q = _norm(text)
+        if not q:
+            first = [k for k in recent if k in self.haystack]
+            rest = (k for k in self.keys if k not in first)
+            return (first + [k for _, k in zip(range(limit), rest)])[:limit]
+        if len(q) <= GRAM:
+            candidates = self.grams.get(q, [])
+        else:
+            postings = [self.grams.get(q[i:i + GRAM], []) for i in range(len(q) - GRAM + 1)]
+            shortest = min(postings, key=len)
+            candidates = [k for k in shortest if q in self.haystack[k]]
+        recent_rank = {k: i for i, k in enumerate(recent)}
+        prefix = []
+        other = []
+        for k in candidates:
+            if k in recent_rank:
+                continue
+            hay = self.haystack[k]
+            if hay.startswith(q) or ("\n" + q) in hay:
+                prefix.append(k)
+            else:
+                other.append(k)
+            if len(prefix) >= limit:
+                break
+        hits = sorted((k for k in candidates if k in recent_rank), key=recent_rank.get)
+        return (hits + prefix + other)[:limit]
+
+
+def load_recent():
+    try:
+        with open(RECENT_FILE, "r", encoding="utf-8") as f:
+            recent = json.load(f)
+        return [k for k in recent if isinstance(k, str)][:MAX_RECENT]
+    except Exception:
+        return []
+
+
+def save_recent(recent):
+    try:
+        os.makedirs(os.path.dirname(RECENT_FILE), exist_ok=True)
+        with open(RECENT_FILE, "w", encoding="utf-8") as f:
+            json.dump(recent[:MAX_RECENT], f, ensure_ascii=False)
+    except Exception:
+        pass
+
+
+class CustomerPicker(tk.Frame):
+    """Combobox that filters customers as the user types and calls `command(key)` on selection."""
+
+    def __init__(self, master, customers, variable, command=None):
+        super().__init__(master)
+        self.variable = variable
+        self.command = command
+        self.index = CustomerIndex(customers)
+        self.recent = load_recent()
+        self.result_keys = []
+        self.text_var = tk.StringVar()
+        self.combo = ttk.Combobox(self, textvariable=self.text_var, width=40)
+        self.combo.pack(side="left", fill="x", expand=True)
+        self.combo.bind("<KeyRelease>", self._on_key)
+        self.combo.bind("<<ComboboxSelected>>", self._on_selected)
+        self.combo.bind("<Return>", self._on_return)
+        self._update_results("")
+
+    def set_customers(self, customers):
+        self.index = CustomerIndex(customers)
+        self._update_results(self.text_var.get())
+
+    def _update_results(self, text):
+        self.result_keys = self.index.search(text, self.recent)
+        self.combo["values"] = [self.index.labels[k] for k in self.result_keys]
+
+    def _on_key(self, event):
+        if event.keysym in ("Up", "Down", "Return", "Escape", "Tab"):
+            return
+        self._update_results(self.text_var.get())
+
+    def _on_selected(self, event=None):
+        idx = self.combo.current()
+        if 0 <= idx < len(self.result_keys):
+            self.select(self.result_keys[idx])
+
+    def _on_return(self, event=None):
+        # Enter picks the best match for what was typed
+        if self.result_keys:
+            self.select(self.result_keys[0])
+
+    def select(self, key):
+        if key not in self.index.labels:
+            return
+        self.variable.set(key)
+        self.text_var.set(self.index.labels[key])
+        if key in self.recent:
+            self.recent.remove(key)
+        self.recent.insert(0, key)
+        del self.recent[MAX_RECENT:]
+        save_recent(self.recent)
+        self._update_results("")
+        if self.command:
+            self.command(key)
@@ -0,0 +1,82 @@
+import os
+import tempfile
+import tkinter as tk
+from tkinter import ttk, messagebox, filedialog
+import tracing
+
+
+class DiagnosticsApp(tk.Frame):
+    """Shows p50/p95 timings per stage recorded by the tracing module."""
+
+    def __init__(self, master):
+        super().__init__(master)
+        self.master = master
+        self.pack(fill="both", expand=True, padx=10, pady=10)
+        self.trace_var = tk.BooleanVar(value=tracing.is_enabled())
+        self.profile_var = tk.BooleanVar(value=bool(tracing.profile_dir()))
+        self.build_ui()
+        self.refresh()
+
+    def build_ui(self):
+        row = tk.Frame(self)
+        row.pack(fill="x", pady=6)
+        tk.Checkbutton(row, text="Enable tracing", variable=self.trace_var, command=self.toggle_tracing).pack(side="left")
+        tk.Checkbutton(row, text="cProfile each action", variable=self.profile_var, command=self.toggle_tracing).pack(side="left", padx=(8, 0))
+        tk.Button(row, text="Refresh", command=self.refresh).pack(side="left", padx=(8, 0))
+        tk.Button(row, text="Reset", command=self.reset).pack(side="left", padx=(8, 0))
+        tk.Button(row, text="Save Chrome Trace", command=self.save_trace).pack(side="left", padx=(8, 0))
+
+        columns = ("count", "p50", "p95", "max")
+        self.tree = ttk.Treeview(self, columns=columns)
+        self.tree.heading("#0", text="Stage")
+        self.tree.column("#0", width=220)
+        for col in columns:
+            self.tree.heading(col, text=col if col == "count" else f"{col} (ms)")
+            self.tree.column(col, width=90, anchor="e")
+        self.tree.pack(fill="both", expand=True, pady=(8, 0))
+
+        self.status = tk.Label(self, anchor="w")
+        self.status.pack(fill="x")
+
+    def toggle_tracing(self):
+        if self.trace_var.get():
+            prof_dir = None
+            if self.profile_var.get():
+                prof_dir = os.path.join(tempfile.gettempdir(), "receipt_profiles")
+            tracing.enable(profile_dir=prof_dir)
+        else:
+            tracing.disable()
+        self.refresh()
+
+    def refresh(self):
+        self.tree.delete(*self.tree.get_children())
+        for name, st in sorted(tracing.stage_stats().items()):
+            self.tree.insert("", tk.END, text=name, values=(st["count"], f"{st['p50']:.1f}", f"{st['p95']:.1f}", f"{st['max']:.1f}"))
+        if not tracing.is_enabled():
+            self.status.config(text="Tracing is off.")
+        elif tracing.profile_dir():
+            self.status.config(text=f"Tracing on; profiles written to {tracing.profile_dir()}")
+        else:
+            self.status.config(text="Tracing on.")
+
+    def reset(self):
+        tracing.reset()
+        self.refresh()
+
+    def save_trace(self):
+        path = filedialog.asksaveasfilename(title="Save Chrome Trace", defaultextension=".json", filetypes=[("JSON files", "*.json")])
+        if not path:
+            return
+        try:
+            count = tracing.write_chrome_trace(path)
+            messagebox.showinfo("Saved", f"Wrote {count} events to {path}")
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to write trace: {e}")
+
+
+if __name__ == '__main__':
+    root = tk.Tk()
+    root.title("Diagnostics")
+    app = DiagnosticsApp(root)
+    root.geometry('700x400')
+    root.mainloop()
@@ -0,0 +1,275 @@
+"""One pass over history, fanned out to any number of export formats.
+
+run() streams the selected period from history once, orders the rows by
+date (then receipt number) and hands each row to every sink in turn. A sink
+gets start() before the first row, add(row) per row and finish() at the
+end. finish() returns its result: the TSV text, a file path, the totals.
+Exporting clipboard + .xlsx + .csv in one go costs one history scan.
+A sink whose start(), add() or finish() raises gets close() (which drops
+its partial file) and the exception as its result; the others carry on.
+collect_rows() and feed() are the two halves of run(), for callers that
+check the rows before choosing where to write them.
+
+A row is an ExportRow: the history key, customer and record, its parsed
+date, and `values`, the nine spreadsheet columns the Excel export has always
+used:
+    'הכנסה', date, payment, customer, '', receipt no, bank, account, check
+
+    python export_pipeline.py 2025 [--month 6] [--xlsx f] [--csv f] [--jsonl f] [--totals]
+"""
+import os
+import json
+import datetime
+from store import HISTORY_FILE, iter_history, parse_date
+from tracing import span
+
+
+class ExportRow:
+    __slots__ = ("key", "customer", "data", "date", "values")
+
+    def __init__(self, key, customer, data):
+        self.key = key
+        self.customer = customer
+        self.data = data
+        self.date = parse_date(data.get("Date", ""))
+        # Columns: A(hebrew 'הכנסה'), B(date), C(payment), D(customer), E(blank), F(receipt_no), G(bank_number), H(bank_account), I(CheckNumber)
+        self.values = ["הכנסה", data.get("Date", ""), data.get("payment", ""), customer, "",
+                       data.get("recipeNum", key), data.get("BankNumber", ""), data.get("bankAccount", ""),
+                       data.get("CheckNumber", "")]
+
+
+class Sink:
+    """Base sink; subclasses override what they need."""
+    name = "sink"
+
+    def start(self):
+        pass
+
+    def add(self, row):
+        pass
+
+    def finish(self):
+        return None
+
+    def close(self):
+        """Give up after an error: release what start() opened, leave no partial output."""
+        pass
+
+
+class _FileSink(Sink):
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+
+    def finish(self):
+        self.f.close()
+        self.f = None
+        return self.path
+
+    def close(self):
+        if self.f is not None:
+            try:
+                self.f.close()
+            except Exception:
+                pass
+            self.f = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+class TsvSink(Sink):
+    """Tab-separated text for the clipboard."""
+    name = "tsv"
+
+    def start(self):
+        self.lines = []
+
+    def add(self, row):
+        self.lines.append("\t".join(map(str, row.values)))
+
+    def finish(self):
+        return "\n".join(self.lines)
+
+
+class XlsxSink(Sink):
+    """An .xlsx workbook, written with openpyxl's streaming write_only mode."""
+    name = "xlsx"
+
+    def __init__(self, path):
+        self.path = path
+        self.wb = None
+
+    def start(self):
+        import openpyxl
+        self.wb = openpyxl.Workbook(write_only=True)
+        self.ws = self.wb.create_sheet()
+
+    def add(self, row):
+        self.ws.append(row.values)
+
+    def finish(self):
+        with span("export.xlsx_save"):
+            self.wb.save(self.path)
+        self.wb = None
+        return self.path
+
+    def close(self):
+        # Nothing is written to `path` before save(); closing drops the rows spooled so far
+        if self.wb is not None:
+            try:
+                self.wb.close()
+            except Exception:
+                pass
+            self.wb = None
+
+
+class CsvSink(_FileSink):
+    name = "csv"
+
+    def start(self):
+        import csv
+        # utf-8-sig so Excel opens the Hebrew correctly
+        self.f = open(self.path, "w", encoding="utf-8-sig", newline="")
+        self.writer = csv.writer(self.f)
+
+    def add(self, row):
+        self.writer.writerow(row.values)
+
+
+class JsonLinesSink(_FileSink):
+    """One full history record per line: {"key", "customer", "data"}."""
+    name = "jsonl"
+
+    def start(self):
+        self.f = open(self.path, "w", encoding="utf-8")
+
+    def add(self, row):
+        self.f.write(json.dumps({"key": row.key, "customer": row.customer, "data": row.data}, ensure_ascii=False))
+        self.f.write("\n")
+
+
+class TotalsSink(Sink):
+    """Receipt count and amount per customer and per month: {"customers": {...}, "months": {...}, "count", "amount"}."""
+    name = "totals"
+
+    def start(self):
+        self.totals = {"customers": {}, "months": {}, "count": 0, "amount": 0.0}
+
+    def add(self, row):
+        try:
+            amount = float(str(row.data.get("payment", "")).replace(",", "").strip())
+        except ValueError:
+            amount = 0.0
+        month = f"{row.date.year:04d}-{row.date.month:02d}" if row.date else ""
+        for group, name in (("customers", row.customer), ("months", month)):
+            entry = self.totals[group].setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += amount
+        self.totals["count"] += 1
+        self.totals["amount"] += amount
+
+    def finish(self):
+        return self.totals
+
+
+class RecordsSink(Sink):
+    """The (key, customer, data) records themselves, e.g. for zip_export.export_zip."""
+    name = "records"
+
+    def start(self):
+        self.records = []
+
+    def add(self, row):
+        self.records.append((row.key, row.customer, row.data))
+
+    def finish(self):
+        return self.records
+
+
+def collect_rows(history_path=HISTORY_FILE, start=None, end=None, customer=None):
+    """The period's rows in export order (by date, then receipt key), from one streamed pass."""
+    with span("export.scan"):
+        try:
+            rows = [ExportRow(key, cust, data) for key, cust, data in iter_history(history_path, start, end, customer)]
+        except FileNotFoundError:
+            rows = []
+    # Undated records (only possible without a date filter) go first
+    rows.sort(key=lambda r: (r.date or datetime.date.min, r.key))
+    return rows
+
+
+def feed(sinks, rows):
+    """
+    Hand `rows` to every sink; returns {sink name: result}, in sink order.
+
+    A sink that raises is closed and its result is the exception; it does not stop the others.
+    """
+    errors = {}
+
+    def fail(sink, error):
+        sink.close()
+        errors[id(sink)] = error
+
+    active = []
+    for sink in sinks:
+        try:
+            sink.start()
+            active.append(sink)
+        except Exception as e:
+            fail(sink, e)
+    with span("export.sinks"):
+        for row in rows:
+            for sink in active:
+                try:
+                    sink.add(row)
+                except Exception as e:
+                    fail(sink, e)
+            if errors:
+                active = [sink for sink in active if id(sink) not in errors]
+    results = {}
+    for sink in sinks:
+        if id(sink) not in errors:
+            try:
+                results[sink.name] = sink.finish()
+                continue
+            except Exception as e:
+                fail(sink, e)
+        results[sink.name] = errors[id(sink)]
+    return results
+
+
+def run(sinks, history_path=HISTORY_FILE, start=None, end=None, customer=None):
+    """Feed every row of the period to every sink; returns ({sink name: result}, row count)."""
+    rows = collect_rows(history_path, start, end, customer)
+    return feed(sinks, rows), len(rows)
+
+
+if __name__ == "__main__":
+    import argparse
+    from store import period_bounds
+    parser = argparse.ArgumentParser(description="Export a period of history to several formats in one pass")
+    parser.add_argument("year", type=int)
+    parser.add_argument("--month", type=int)
+    parser.add_argument("--customer")
+    parser.add_argument("--history", default=HISTORY_FILE)
+    parser.add_argument("--xlsx")
+    parser.add_argument("--csv")
+    parser.add_argument("--jsonl")
+    parser.add_argument("--totals", action="store_true")
+    args = parser.parse_args()
+    sinks = [cls(path) for cls, path in ((XlsxSink, args.xlsx), (CsvSink, args.csv), (JsonLinesSink, args.jsonl)) if path]
+    if args.totals:
+        sinks.append(TotalsSink())
+    if not sinks:
+        parser.error("choose at least one of --xlsx, --csv, --jsonl, --totals")
+    results, count = run(sinks, args.history, *period_bounds(args.year, args.month), customer=args.customer)
+    print(f"{count} rows")
+    for name, result in results.items():
+        if name == "totals" and isinstance(result, dict):
+            print(f"totals: {result['count']} receipts, {result['amount']:,.2f}")
+            for cust, (n, amount) in sorted(result["customers"].items()):
+                print(f"  {cust:<30} {n:>5} {amount:>14,.2f}")
+        else:
+            print(f"{name}: {result}")
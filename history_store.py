@@ -0,0 +1,415 @@
+"""Year-partitioned receipt history.
+
+After ``python history_store.py migrate``, history.json is replaced by one
+file per year of the receipt Date under DB_DIR/history/. There is also an
+"undated" file for receipts without a valid Date, and a manifest
+(history_manifest.json, next to where history.json was). The manifest
+lists each partition's file, record count and SHA-256, plus an index of its
+keys: runs of receipt numbers ("ranges", a handful per year) and any keys
+that are not numbers. Every append goes through it, so its versioned-store
+generation counts history writes and the store watcher only needs to watch
+that one file. The index lets an append refuse a receipt number that is
+already used in another year without opening every partition.
+
+The current year and the ones before it, HOT_YEARS in all, are stored as
+plain JSON and loaded by the GUI at startup. Older years are closed:
+gzip-compressed (2023.json.gz) and only read when a filter or export
+reaches them. HistoryCache keeps at most MAX_COLD_LOADED of them in
+memory, least recently used first out, so startup time and memory stay
+flat as the archive grows.
+
+Without a manifest everything falls back to the single history.json, so
+a machine can keep working until it is migrated. Migrate all machines
+together: older versions of the tools only know history.json.
+
+    python history_store.py status|migrate|close [--history path] [--hot-years 2]
+"""
+import os
+import time
+import bisect
+import shutil
+import datetime
+from collections import OrderedDict
+from store import HISTORY_FILE, iter_history_entries, parse_date, read_json
+from versioned_store import ConflictError, FileLock, read_generation, read_versioned, update_versioned
+from tracing import span
+
+HOT_YEARS = 2
+MAX_COLD_LOADED = 3
+UNDATED = "undated"
+MANIFEST_NAME = "history_manifest.json"
+# File names the store watcher reports for history changes, in either layout
+HISTORY_NAMES = ("history.json", MANIFEST_NAME)
+
+
+def manifest_path(history_path=HISTORY_FILE):
+    return os.path.join(os.path.dirname(history_path), MANIFEST_NAME)
+
+
+def partition_dir(history_path=HISTORY_FILE):
+    return os.path.join(os.path.dirname(history_path), "history")
+
+
+def is_partitioned(history_path=HISTORY_FILE):
+    return os.path.exists(manifest_path(history_path))
+
+
+def partition_name(data):
+    dt = parse_date(data.get("Date", "")) if isinstance(data, dict) else None
+    return str(dt.year) if dt else UNDATED
+
+
+def _is_hot(name, hot_years, today=None):
+    if name == UNDATED:
+        return True
+    year = (today or datetime.date.today()).year
+    return int(name) > year - hot_years
+
+
+def history_stamp(history_path=HISTORY_FILE):
+    """[generation, mtime_ns, size] of the file every history write updates; None if there is no history."""
+    path = manifest_path(history_path)
+    if not os.path.exists(path):
+        path = history_path
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [read_generation(path), st.st_mtime_ns, st.st_size]
+
+
+def read_manifest(history_path=HISTORY_FILE):
+    """The manifest dict, or None for a single-file history."""
+    try:
+        return read_json(manifest_path(history_path))
+    except FileNotFoundError:
+        return None
+
+
+def partition_files(history_path=HISTORY_FILE, start=None, end=None):
+    """Files holding the records dated in [start, end] (all of them without bounds), oldest first."""
+    manifest = read_manifest(history_path)
+    if manifest is None:
+        return [history_path] if os.path.exists(history_path) else []
+    folder = partition_dir(history_path)
+    files = []
+    for name in sorted(manifest["partitions"]):
+        if name == UNDATED:
+            # Records without a date never match a date filter
+            if start or end:
+                continue
+        elif (start and int(name) < start.year) or (end and int(name) > end.year):
+            continue
+        files.append(os.path.join(folder, manifest["partitions"][name]["file"]))
+    return files
+
+
+def key_index(keys):
+    """The manifest's key index for a partition: {"ranges": [[lo, hi], ...] of receipt numbers, "other_keys": [...]}."""
+    ranges = []
+    for n in sorted({int(k) for k in keys if k.isdigit()}):
+        if ranges and n == ranges[-1][1] + 1:
+            ranges[-1][1] = n
+        else:
+            ranges.append([n, n])
+    return {"ranges": ranges, "other_keys": sorted(k for k in keys if not k.isdigit())}
+
+
+def _may_hold(info, key):
+    # False means the partition certainly does not have `key`
+    if not key.isdigit():
+        return key in info["other_keys"]
+    n = int(key)
+    ranges = info["ranges"]
+    i = bisect.bisect_right(ranges, [n, float("inf")]) - 1
+    return i >= 0 and ranges[i][0] <= n <= ranges[i][1]
+
+
+def _partition_data(folder, info):
+    return read_versioned(os.path.join(folder, info["file"])).data
+
+
+def _ensure_index(manifest, folder):
+    """Add the key index to partitions described by an older manifest (under the manifest lock)."""
+    for info in manifest["partitions"].values():
+        if "ranges" not in info:
+            info.update(key_index(_partition_data(folder, info)))
+
+
+def _check_other_partitions(manifest, folder, by_partition):
+    """Raise ConflictError for keys being added to one partition that another one already has."""
+    for name, recs in by_partition.items():
+        for other, info in manifest["partitions"].items():
+            if other == name:
+                continue
+            maybe = [k for k in recs if _may_hold(info, k)]
+            # The index works on numbers, so "3" also hits "00003"; only the file can tell
+            held = _partition_data(folder, info) if maybe else {}
+            clash = [k for k in maybe if k in held]
+            if clash:
+                raise ConflictError(os.path.join(folder, info["file"]), clash, "already has")
+
+
+def highest_receipt_number(history_path=HISTORY_FILE):
+    """The largest numeric receipt key in the history, 0 if there is none (from the key index when partitioned)."""
+    manifest = read_manifest(history_path)
+    if manifest is not None and all("ranges" in info for info in manifest["partitions"].values()):
+        return max((info["ranges"][-1][1] for info in manifest["partitions"].values() if info["ranges"]), default=0)
+    keys = (key for part in partition_files(history_path) for key, _ in iter_history_entries(part))
+    return max((int(k) for k in keys if k.isdigit()), default=0)
+
+
+def _backup(path):
+    # Same timestamped copy the generator always made of history.json before writing it
+    try:
+        if os.path.exists(path):
+            ts = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+            with span("history.backup"):
+                shutil.copy2(path, f"{path}.bak.{ts}")
+    except Exception:
+        pass
+
+
+def _add_records(records, path, backup):
+    def mutate(existing):
+        # Runs under the file's lock on its latest version
+        clash = [k for k, v in records.items() if k in existing and existing[k] != v]
+        if clash:
+            raise ConflictError(path, clash)
+        if backup:
+            _backup(path)
+        existing.update(records)
+    return mutate
+
+
+def append_history(history_path, records, backup=False):
+    """
+    Add {recipe_key: {customer: data}} records to the history, in either layout.
+
+    Raises ConflictError if a key already exists with different data. Returns the
+    generation of the write (the manifest's when partitioned), which identifies
+    this version of the whole history.
+    """
+    mpath = manifest_path(history_path)
+    if not os.path.exists(mpath):
+        return update_versioned(history_path, _add_records(records, history_path, backup)).generation
+    by_partition = {}
+    for key, entry in records.items():
+        data = next(iter(entry.values())) if entry else {}
+        by_partition.setdefault(partition_name(data), {})[key] = entry
+    folder = partition_dir(history_path)
+
+    obsolete = []
+
+    def mutate(manifest):
+        parts = manifest["partitions"]
+        _ensure_index(manifest, folder)
+        # A receipt number is unique across all years, not just within the one it is filed under
+        _check_other_partitions(manifest, folder, by_partition)
+        for name, recs in by_partition.items():
+            info = parts.get(name) or {"file": f"{name}.json", "closed": False}
+            path = os.path.join(folder, info["file"])
+            snap = update_versioned(path, _add_records(recs, path, backup), compress=info["closed"])
+            info.update(count=len(snap.data), sha256=snap.sha256, **key_index(snap.data))
+            parts[name] = info
+        obsolete[:] = _close_cold(manifest, folder)
+
+    with span("history.append"):
+        generation = update_versioned(mpath, mutate).generation
+    _remove_files(obsolete)
+    return generation
+
+
+def _close_cold(manifest, folder, today=None):
+    """
+    Compress open partitions that have left the hot window (called under the manifest lock).
+
+    Returns the files the compressed ones replace. The caller deletes them with
+    _remove_files() only after the manifest is written: until then it still lists them.
+    """
+    hot_years = manifest.get("hot_years", HOT_YEARS)
+    obsolete = []
+    for name, info in manifest["partitions"].items():
+        if info["closed"] or _is_hot(name, hot_years, today):
+            continue
+        old = os.path.join(folder, info["file"])
+        new_file = f"{name}.json.gz"
+        with span("history.close_year"):
+            data = read_versioned(old).data
+            snap = update_versioned(os.path.join(folder, new_file), lambda d: d.update(data), compress=True)
+        info.update(file=new_file, closed=True, count=len(snap.data), sha256=snap.sha256)
+        obsolete += [old, old + ".meta"]
+    return obsolete
+
+
+def _remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def close_years(history_path=HISTORY_FILE):
+    """Compress any partition older than the hot window (a new year has started)."""
+    folder = partition_dir(history_path)
+    obsolete = []
+    update_versioned(manifest_path(history_path), lambda manifest: obsolete.extend(_close_cold(manifest, folder)))
+    _remove_files(obsolete)
+
+
+def migrate(history_path=HISTORY_FILE, hot_years=HOT_YEARS):
+    """Split a single history.json into year partitions; the old file is kept as history.json.migrated."""
+    mpath = manifest_path(history_path)
+    if os.path.exists(mpath):
+        raise RuntimeError(f"{history_path} is already partitioned ({mpath})")
+    folder = partition_dir(history_path)
+    os.makedirs(folder, exist_ok=True)
+    with FileLock(history_path):
+        by_partition = {}
+        for key, entry in iter_history_entries(history_path):
+            data = next(iter(entry.values())) if isinstance(entry, dict) and entry else {}
+            by_partition.setdefault(partition_name(data), {})[key] = entry
+
+        def mutate(manifest):
+            manifest.update(version=1, hot_years=hot_years, partitions={})
+            for name, recs in sorted(by_partition.items()):
+                closed = not _is_hot(name, hot_years)
+                file = f"{name}.json.gz" if closed else f"{name}.json"
+                snap = update_versioned(os.path.join(folder, file), lambda d, recs=recs: d.update(recs), compress=closed)
+                manifest["partitions"][name] = {"file": file, "closed": closed, "count": len(snap.data),
+                                                "sha256": snap.sha256, **key_index(snap.data)}
+
+        update_versioned(mpath, mutate)
+        os.replace(history_path, history_path + ".migrated")
+    return read_manifest(history_path)
+
+
+class HistoryCache:
+    """
+    The history records the GUI has in memory: hot partitions, plus an LRU of cold ones.
+
+    For a single-file history everything is "hot" and loaded at once.
+    """
+
+    def __init__(self, history_path=HISTORY_FILE, max_cold=MAX_COLD_LOADED):
+        self.history_path = history_path
+        self.max_cold = max_cold
+        self.manifest = None
+        # partition name -> (sha256 it was loaded at, {key: entry})
+        self.hot = {}
+        self.cold = OrderedDict()
+
+    def _load(self, name):
+        info = self.manifest["partitions"][name]
+        with span("history.load_partition"):
+            data = dict(iter_history_entries(os.path.join(partition_dir(self.history_path), info["file"])))
+        return info.get("sha256"), data
+
+    def load_hot(self):
+        """(Re)load the partitions used day to day; cold ones stay on disk."""
+        self.manifest = read_manifest(self.history_path)
+        self.cold.clear()
+        if self.manifest is None:
+            try:
+                self.hot = {"all": (None, dict(iter_history_entries(self.history_path)))}
+            except FileNotFoundError:
+                self.hot = {"all": (None, {})}
+            return
+        hot_years = self.manifest.get("hot_years", HOT_YEARS)
+        self.hot = {name: self._load(name) for name in self.manifest["partitions"] if _is_hot(name, hot_years)}
+
+    def years(self):
+        """Every year in the history, newest first, and the subset currently in memory."""
+        if self.manifest is None:
+            return [], []
+        years = sorted((n for n in self.manifest["partitions"] if n != UNDATED), reverse=True)
+        return years, [y for y in years if y in self.hot or y in self.cold]
+
+    def ensure_years(self, years):
+        """Load the cold partitions for `years` (ints or strings); returns True if anything was loaded."""
+        if self.manifest is None:
+            return False
+        loaded = False
+        for name in map(str, years):
+            if name in self.hot or name not in self.manifest["partitions"]:
+                continue
+            if name in self.cold:
+                self.cold.move_to_end(name)
+                continue
+            self.cold[name] = self._load(name)
+            loaded = True
+            while len(self.cold) > self.max_cold:
+                self.cold.popitem(last=False)
+        return loaded
+
+    def entries(self):
+        """All loaded records as one {key: {customer: data}} dict (shares the record objects)."""
+        merged = {}
+        for _, data in list(self.hot.values()) + list(self.cold.values()):
+            merged.update(data)
+        return merged
+
+    def refresh(self):
+        """Reload partitions whose content changed on disk. Returns True if anything changed."""
+        if self.manifest is None or not is_partitioned(self.history_path):
+            before = self.hot
+            self.load_hot()
+            return self.hot != before
+        manifest = read_manifest(self.history_path)
+        if manifest == self.manifest:
+            return False
+        hot_years = manifest.get("hot_years", HOT_YEARS)
+        changed = False
+        for name, info in manifest["partitions"].items():
+            if name in self.cold:
+                if self.cold[name][0] != info.get("sha256"):
+                    self.cold[name] = self._load(name)
+                    changed = True
+            elif _is_hot(name, hot_years) and self.hot.get(name, (None,))[0] != info.get("sha256"):
+                self.hot[name] = self._load(name)
+                changed = True
+        for name in [n for n in self.hot if n not in manifest["partitions"] or not _is_hot(n, hot_years)]:
+            del self.hot[name]
+            changed = True
+        # Only now: if a partition failed to load, the next refresh tries again
+        self.manifest = manifest
+        return changed
+
+
+def bench(history_path=HISTORY_FILE):
+    """Compare loading everything with loading only the hot partitions."""
+    import tracemalloc
+    for label, load in (("all years", lambda: dict(e for f in partition_files(history_path) for e in iter_history_entries(f))),
+                        ("hot only", lambda: HistoryCache(history_path).load_hot())):
+        tracemalloc.start()
+        start = time.perf_counter()
+        load()
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{label:<10} {elapsed * 1000:8.0f} ms  peak {peak / 1e6:7.1f} MB")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Year-partitioned receipt history")
+    parser.add_argument("command", choices=("status", "migrate", "close", "bench"))
+    parser.add_argument("--history", default=HISTORY_FILE, help="history.json path (its folder holds the partitions)")
+    parser.add_argument("--hot-years", type=int, default=HOT_YEARS)
+    args = parser.parse_args()
+    if args.command == "migrate":
+        migrate(args.history, args.hot_years)
+    elif args.command == "close":
+        close_years(args.history)
+    elif args.command == "bench":
+        bench(args.history)
+    if args.command != "bench":
+        manifest = read_manifest(args.history)
+        if manifest is None:
+            print(f"{args.history}: single file (not partitioned)")
+        else:
+            for name, info in sorted(manifest["partitions"].items()):
+                path = os.path.join(partition_dir(args.history), info["file"])
+                state = "closed" if info["closed"] else "hot" if _is_hot(name, manifest.get("hot_years", HOT_YEARS)) else "open"
+                print(f"{name:<8} {info['count']:>7} records  {os.path.getsize(path) / 1024:>9.0f} KB  {state}")
@@ -0,0 +1,274 @@
+"""Per-customer ledger: what each tenant paid per month, kept up to date per receipt.
+
+The ledger holds, per history customer, the total and receipt count per month
+("2025-06"), the overall total and count, and the last receipt. It is derived
+from history, so it lives in LOCAL_DIR (per machine), stamped with the
+history's generation. record_appended() adds a new receipt in O(1) when the
+ledger saw the previous generation. Any other change (another machine's
+receipts, a migration) rebuilds it with one streamed pass.
+
+A bitmap of receipt numbers, the same idea as sequence_audit, makes a
+re-appended receipt count only once.
+
+arrears() compares the months since a tenant's first receipt with their
+customer record's payment (the monthly rent the generator pre-fills).
+
+    python ledger.py [--year 2025] [--history path]
+"""
+import os
+import base64
+import hashlib
+import calendar
+import datetime
+import threading
+from store import CUSTOMERS_FILE, HISTORY_FILE, LOCAL_DIR, iter_history, parse_date, read_json, write_json_atomic
+from tracing import span
+from sequence_audit import MAX_NUMBER
+
+LEDGER_VERSION = 1
+
+
+def _amount(value):
+    try:
+        return round(float(str(value).replace(",", "").strip()), 2)
+    except ValueError:
+        return 0.0
+
+
+def _number(value):
+    text = str(value or "").strip()
+    return int(text) if text.isdigit() else None
+
+
+def month_key(dt):
+    return f"{dt.year:04d}-{dt.month:02d}"
+
+
+class Ledger:
+    def __init__(self):
+        # customer -> {"months": {"YYYY-MM": [total, count]}, "total", "count", "last": [num, Date, payment]}
+        self.customers = {}
+        # One bit per receipt number already counted; other keys in `extra_keys`
+        self.numbers = bytearray()
+        self.extra_keys = set()
+        # history_stamp() of the history this ledger reflects
+        self.stamp = None
+
+    def _seen(self, key):
+        num = _number(key)
+        if num is None or num >= MAX_NUMBER:
+            # Non-numeric keys, and typos too large to index by number
+            if key in self.extra_keys:
+                return True
+            self.extra_keys.add(key)
+            return False
+        if num >> 3 >= len(self.numbers):
+            self.numbers.extend(bytes(max((num >> 3) + 1, 2 * len(self.numbers)) - len(self.numbers)))
+        bit = 1 << (num & 7)
+        if self.numbers[num >> 3] & bit:
+            return True
+        self.numbers[num >> 3] |= bit
+        return False
+
+    def add(self, key, cust, data):
+        """Count one receipt; returns False if this history key was already counted."""
+        if self._seen(key):
+            return False
+        payment = _amount(data.get("payment"))
+        entry = self.customers.get(cust)
+        if entry is None:
+            entry = self.customers[cust] = {"months": {}, "total": 0.0, "count": 0, "last": None}
+        dt = parse_date(data.get("Date", ""))
+        if dt is not None:
+            month = entry["months"].setdefault(month_key(dt), [0.0, 0])
+            month[0] = round(month[0] + payment, 2)
+            month[1] += 1
+        entry["total"] = round(entry["total"] + payment, 2)
+        entry["count"] += 1
+        # The last receipt is the highest number (issue order), not the latest date
+        num = data.get("recipeNum") or key
+        last = entry["last"]
+        if last is None or (_number(num) or 0) >= (_number(last[0]) or 0):
+            entry["last"] = [num, data.get("Date", ""), data.get("payment", "")]
+        return True
+
+    def build(self, records):
+        """One pass over (key, customer, data) records."""
+        for key, cust, data in records:
+            self.add(key, cust, data)
+        return self
+
+    def to_json(self, history_path):
+        return {"version": LEDGER_VERSION, "history": os.path.abspath(history_path), "stamp": self.stamp,
+                "customers": self.customers, "numbers": base64.b64encode(bytes(self.numbers)).decode("ascii"),
+                "extra_keys": sorted(self.extra_keys)}
+
+    @classmethod
+    def from_json(cls, obj):
+        ledger = cls()
+        ledger.customers = obj["customers"]
+        ledger.numbers = bytearray(base64.b64decode(obj["numbers"]))
+        ledger.extra_keys = set(obj["extra_keys"])
+        ledger.stamp = obj["stamp"]
+        return ledger
+
+    def summary(self, cust, year):
+        """(paid, receipts) for one customer in `year`, and their last receipt [num, Date, payment] or None."""
+        entry = self.customers.get(cust)
+        if entry is None:
+            return 0.0, 0, None
+        prefix = f"{year:04d}-"
+        paid = count = 0
+        for month, (total, n) in entry["months"].items():
+            if month.startswith(prefix):
+                paid += total
+                count += n
+        return round(paid, 2), count, entry["last"]
+
+    def arrears(self, customers, year, today=None):
+        """
+        One row per customer with receipts or a rent: (name, rent, paid, receipts, missing_months, balance, last).
+
+        `customers` is the customers_data dict; rent is each record's payment. Months run
+        from January of `year` (or the customer's first receipt, if later) to December (or
+        this month). missing_months are the month numbers without any receipt and balance
+        is rent times the months minus what was paid (positive = owed).
+        """
+        today = today or datetime.date.today()
+        last_month = 12 if year < today.year else today.month if year == today.year else 0
+        rows = []
+        names = {}
+        for key, data in customers.items():
+            if isinstance(data, dict):
+                names[data.get("customer") or key] = _amount(data.get("payment"))
+        for cust in self.customers:
+            names.setdefault(cust, 0.0)
+        for name in sorted(names):
+            rent = names[name]
+            entry = self.customers.get(name)
+            months = entry["months"] if entry else {}
+            paid, count, last = self.summary(name, year)
+            first = min(months) if months else None
+            start = 1
+            if first is None or first > f"{year:04d}-12":
+                # No receipts up to that year: not a tenant yet
+                start = 13
+            elif first.startswith(f"{year:04d}-"):
+                start = int(first[5:])
+            span_months = range(start, last_month + 1)
+            if not count and not span_months:
+                continue
+            missing = [m for m in span_months if f"{year:04d}-{m:02d}" not in months]
+            balance = round(rent * len(span_months) - paid, 2) if rent else 0.0
+            rows.append((name, rent, paid, count, missing, balance, last))
+        return rows
+
+
+def ledger_path(history_path=HISTORY_FILE):
+    # One cache per history file, so a test or bench history never overwrites the real one
+    digest = hashlib.sha1(os.path.normcase(os.path.abspath(history_path)).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(LOCAL_DIR, f"ledger_{digest}.json")
+
+
+def _save(ledger, history_path):
+    try:
+        write_json_atomic(ledger_path(history_path), ledger.to_json(history_path), indent=None)
+    except OSError:
+        pass
+
+
+def _rebuild(history_path):
+    from history_store import history_stamp
+    with span("ledger.build"):
+        ledger = Ledger()
+        # Stamp first: a write landing during the pass shows up as a newer stamp next time
+        ledger.stamp = history_stamp(history_path)
+        try:
+            ledger.build(iter_history(history_path))
+        except FileNotFoundError:
+            pass
+    _save(ledger, history_path)
+    return ledger
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def _cached(history_path):
+    ledger = _shared.get(history_path)
+    if ledger is None:
+        try:
+            obj = read_json(ledger_path(history_path))
+            if obj.get("version") == LEDGER_VERSION:
+                ledger = Ledger.from_json(obj)
+        except Exception:
+            ledger = None
+    return ledger
+
+
+def load_ledger(history_path=HISTORY_FILE):
+    """The ledger for `history_path`, from memory or LOCAL_DIR if still current, else rebuilt."""
+    from history_store import history_stamp
+    with _shared_lock:
+        ledger = _cached(history_path)
+        if ledger is None or ledger.stamp != history_stamp(history_path):
+            ledger = _rebuild(history_path)
+        _shared[history_path] = ledger
+        return ledger
+
+
+def record_appended(history_path, records, generation):
+    """
+    Count receipts [(key, customer, data)] that one write just appended to `history_path`.
+
+    `generation` is the write's generation (append_history's return value). If the ledger
+    saw the previous generation this is O(1) per receipt; otherwise it is rebuilt.
+    """
+    from history_store import history_stamp
+    with _shared_lock:
+        ledger = _cached(history_path)
+        if ledger is not None and ledger.stamp and ledger.stamp[0] == generation - 1:
+            with span("ledger.update"):
+                for key, cust, data in records:
+                    ledger.add(key, cust, data)
+                ledger.stamp = history_stamp(history_path)
+            _save(ledger, history_path)
+        else:
+            ledger = _rebuild(history_path)
+        _shared[history_path] = ledger
+        return ledger
+
+
+def format_missing(months):
+    return ",".join(calendar.month_abbr[m].lower() for m in months)
+
+
+def format_row(row):
+    name, rent, paid, count, missing, balance, last = row
+    last_text = f"{last[0]} {last[1]} ({last[2]})" if last else "-"
+    missing_text = format_missing(missing) or "-"
+    return f"{name:<28} {rent:>9,.0f} {paid:>11,.0f} {count:>4} {balance:>10,.0f}  {missing_text:<24} {last_text}"
+
+
+HEADER = f"{'customer':<28} {'rent':>9} {'paid':>11} {'#':>4} {'owed':>10}  {'no receipt':<24} last receipt"
+
+
+if __name__ == "__main__":
+    import time
+    import argparse
+    parser = argparse.ArgumentParser(description="Per-customer payments and arrears")
+    parser.add_argument("--year", type=int, default=datetime.date.today().year)
+    parser.add_argument("--history", default=HISTORY_FILE)
+    parser.add_argument("--customers", default=CUSTOMERS_FILE)
+    args = parser.parse_args()
+    start = time.perf_counter()
+    ledger = load_ledger(args.history)
+    print(f"Ledger for {len(ledger.customers)} customers in {(time.perf_counter() - start) * 1000:.0f} ms")
+    try:
+        customers = read_json(args.customers)
+    except Exception:
+        customers = {}
+    print(HEADER)
+    for row in ledger.arrears(customers, args.year):
+        print(format_row(row))
@@ -0,0 +1,216 @@
+"""Import receipts kept only in spreadsheets into history.
+
+The workbooks use the column layout the Excel export writes:
+    A 'הכנסה'  B date  C payment  D customer  E (blank)  F receipt number
+    G bank  H account  I check number
+Rows whose first column is not 'הכנסה' (headers, notes, expenses) are
+skipped. Workbooks are read with openpyxl in read_only mode, one row at a
+time, so size does not matter.
+
+Each row becomes a history record with every SAMPLE_KEYS field, keyed by
+its zero-padded receipt number:
+  - a number already in history with the same date, amount and customer
+    is skipped as a duplicate;
+  - one with different data is reported as a conflict and not imported;
+  - so are rows with a bad date, amount or number.
+Records are appended in batches of BATCH_SIZE: one history write per batch
+instead of one per row. After each batch the sheet and row reached are
+saved in LOCAL_DIR, so an interrupted import continues where it stopped.
+
+    python legacy_import.py workbook.xlsx [...] [--dry-run] [--history path]
+"""
+import os
+import hashlib
+import datetime
+from new_customer import SAMPLE_KEYS
+from store import HISTORY_FILE, LOCAL_DIR, iter_history, parse_date, read_json, write_json_atomic
+from tracing import span
+
+INCOME_MARK = "הכנסה"
+BATCH_SIZE = 5000
+COLUMNS = 9
+# Excel's row limit; passing explicit bounds stops openpyxl scanning a whole sheet for its size first
+MAX_ROWS = 1048576
+
+
+def _text(value):
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def _date_text(value):
+    """Cell value as the 'dd/mm/yyyy' history uses, or None if it is not a date."""
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    if isinstance(value, datetime.date):
+        return value.strftime("%d/%m/%Y")
+    dt = parse_date(_text(value).replace(".", "/").replace("-", "/"))
+    return dt.strftime("%d/%m/%Y") if dt else None
+
+
+def _amount_text(value):
+    text = _text(value).replace(",", "").replace("₪", "").strip()
+    try:
+        amount = float(text)
+    except ValueError:
+        return None
+    return str(int(amount)) if amount.is_integer() else f"{amount:.2f}"
+
+
+def row_to_record(row):
+    """
+    Map one exported row to (key, customer, data).
+
+    Returns None for rows that are not income rows. Raises ValueError for income
+    rows that cannot be imported.
+    """
+    cells = list(row) + [None] * (COLUMNS - len(row))
+    if _text(cells[0]) != INCOME_MARK:
+        return None
+    date_str = _date_text(cells[1])
+    if date_str is None:
+        raise ValueError(f"bad date {cells[1]!r}")
+    payment = _amount_text(cells[2])
+    if payment is None:
+        raise ValueError(f"bad amount {cells[2]!r}")
+    customer = _text(cells[3])
+    if not customer:
+        raise ValueError("no customer")
+    number = _text(cells[5])
+    if not number.isdigit():
+        raise ValueError(f"bad receipt number {cells[5]!r}")
+    data = {k: "" for k in SAMPLE_KEYS}
+    data.update(recipeNum=f"{int(number):05d}", Date=date_str, payment=payment, customer=customer,
+                BankNumber=_text(cells[6]), bankAccount=_text(cells[7]), CheckNumber=_text(cells[8]))
+    return data["recipeNum"], customer, data
+
+
+def _fingerprint(cust, data):
+    # What makes two records of the same number "the same receipt"
+    return cust, parse_date(data.get("Date", "")), _amount_text(data.get("payment"))
+
+
+def checkpoint_path(workbook_path):
+    st = os.stat(workbook_path)
+    ident = f"{os.path.abspath(workbook_path)}|{st.st_size}|{st.st_mtime_ns}"
+    return os.path.join(LOCAL_DIR, f"legacy_import_{hashlib.sha1(ident.encode('utf-8')).hexdigest()[:12]}.json")
+
+
+class ImportResult:
+    def __init__(self):
+        self.imported = 0
+        self.duplicates = 0
+        self.skipped = 0
+        # [(sheet, row number, reason)]
+        self.errors = []
+        self.resumed_from = None
+
+    def summary(self):
+        text = f"{self.imported} imported, {self.duplicates} already in history, {self.skipped} other rows skipped"
+        if self.errors:
+            text += f", {len(self.errors)} rows not imported"
+        return text
+
+
+def import_workbook(path, history_path=HISTORY_FILE, dry_run=False, progress=None, batch_size=BATCH_SIZE):
+    """Import one workbook; returns an ImportResult. `progress(sheet, row)` is called after each batch."""
+    import openpyxl
+    from history_store import append_history
+    result = ImportResult()
+    ckpt_path = checkpoint_path(path)
+    try:
+        done = read_json(ckpt_path)
+        result.resumed_from = dict(done)
+    except Exception:
+        done = {}
+    with span("import.existing"):
+        try:
+            existing = {key: _fingerprint(cust, data) for key, cust, data in iter_history(history_path)}
+        except FileNotFoundError:
+            existing = {}
+    batch = {}
+
+    def commit(sheet, row_no):
+        if batch and not dry_run:
+            with span("import.commit"):
+                append_history(history_path, batch)
+        result.imported += len(batch)
+        batch.clear()
+        if not dry_run:
+            done[sheet] = row_no
+            write_json_atomic(ckpt_path, done, indent=None)
+        if progress:
+            progress(sheet, row_no)
+
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        for ws in wb.worksheets:
+            start = done.get(ws.title, 0)
+            row_no = start
+            rows = ws.iter_rows(min_row=start + 1, max_row=MAX_ROWS, max_col=COLUMNS, values_only=True)
+            for row_no, row in enumerate(rows, start=start + 1):
+                try:
+                    rec = row_to_record(row)
+                except ValueError as e:
+                    result.errors.append((ws.title, row_no, str(e)))
+                    continue
+                if rec is None:
+                    result.skipped += 1
+                    continue
+                key, cust, data = rec
+                seen = existing.get(key)
+                if seen is not None:
+                    if seen == _fingerprint(cust, data):
+                        result.duplicates += 1
+                    else:
+                        result.errors.append((ws.title, row_no, f"receipt {key} is already in history with different data"))
+                    continue
+                existing[key] = _fingerprint(cust, data)
+                batch[key] = {cust: data}
+                if len(batch) >= batch_size:
+                    commit(ws.title, row_no)
+            commit(ws.title, row_no)
+    finally:
+        wb.close()
+    if not dry_run:
+        # Finished: a later run of the same file starts from the top (and finds only duplicates)
+        try:
+            os.remove(ckpt_path)
+        except OSError:
+            pass
+    return result
+
+
+def write_error_report(result, path):
+    """Write the rows that were not imported as a CSV for fixing by hand."""
+    import csv
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["sheet", "row", "reason"])
+        writer.writerows(result.errors)
+
+
+if __name__ == "__main__":
+    import time
+    import argparse
+    parser = argparse.ArgumentParser(description="Import legacy receipts from Excel workbooks into history")
+    parser.add_argument("workbooks", nargs="+")
+    parser.add_argument("--history", default=HISTORY_FILE)
+    parser.add_argument("--dry-run", action="store_true", help="check the rows without writing history")
+    args = parser.parse_args()
+    for workbook in args.workbooks:
+        start = time.perf_counter()
+        result = import_workbook(workbook, args.history, args.dry_run,
+                                 progress=lambda sheet, row: print(f"\r{sheet}: row {row}", end=""))
+        print(f"\n{workbook}: {result.summary()} in {time.perf_counter() - start:.1f} s")
+        if result.resumed_from:
+            print(f"  resumed after {result.resumed_from}")
+        for sheet, row_no, reason in result.errors[:20]:
+            print(f"  {sheet} row {row_no}: {reason}")
+        if len(result.errors) > 20:
+            report = os.path.splitext(workbook)[0] + "_import_errors.csv"
+            write_error_report(result, report)
+            print(f"  ... {len(result.errors) - 20} more, all listed in {report}")
@@ -0,0 +1,466 @@
+"""Email generated receipts to tenants through a persistent outbound queue.
+
+Receipts are queued in LOCAL_DIR/mail_queue.json (per machine, outside Drive
+sync), so nothing is lost if the app closes before delivery. deliver() sends
+everything that is due with a few sender threads. Each thread keeps one SMTP
+connection open for its share of the batch and reconnects only after
+MAX_PER_CONNECTION messages or when the server drops it. A failed message is
+retried with exponential backoff. After MAX_ATTEMPTS it is marked failed.
+
+SMTP settings come from LOCAL_DIR/smtp.json or RECEIPT_SMTP_* environment
+variables (HOST, PORT, USER, PASSWORD, FROM, TLS=starttls|ssl|none).
+
+    python mailer.py stub [--port 8025] [--fail-rate 0.1]   run a local test server
+    python mailer.py bench [--count 300] [--workers 4] [--fail-rate 0.05]
+    python mailer.py send                                     deliver what is queued
+"""
+import os
+import ssl
+import time
+import uuid
+import queue
+import random
+import smtplib
+import threading
+import mimetypes
+from email.message import EmailMessage
+from store import LOCAL_DIR, read_json, write_json_atomic
+from tracing import span
+
+QUEUE_FILE = os.path.join(LOCAL_DIR, "mail_queue.json")
+SMTP_CONFIG_FILE = os.path.join(LOCAL_DIR, "smtp.json")
+SENDER_WORKERS = 3
+# Many providers cut a session after ~100 messages; start a fresh one before that
+MAX_PER_CONNECTION = 90
+MAX_ATTEMPTS = 6
+RETRY_BASE = 30.0
+RETRY_MAX = 3600.0
+SUBJECT = "קבלה מספר {recipeNum}"
+BODY = "שלום {customer},\n\nמצורפת קבלה מספר {recipeNum} על סך {payment} ש\"ח.\n\nתודה"
+
+
+def load_smtp_config(path=SMTP_CONFIG_FILE):
+    config = {"host": "", "port": 587, "user": "", "password": "", "from": "", "tls": "starttls"}
+    try:
+        config.update(read_json(path))
+    except Exception:
+        pass
+    for key in config:
+        value = os.environ.get("RECEIPT_SMTP_" + key.upper())
+        if value:
+            config[key] = value
+    config["port"] = int(config["port"])
+    config["from"] = config["from"] or config["user"]
+    return config
+
+
+def _backoff(attempts):
+    return min(RETRY_MAX, RETRY_BASE * 2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+
+
+def _is_permanent(error):
+    # A deleted PDF or a 5xx reply (bad address, rejected content) will not get better by waiting
+    if isinstance(error, FileNotFoundError):
+        return True
+    code = getattr(error, "smtp_code", None)
+    if code is None and isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [c for c, _ in error.recipients.values()]
+        code = min(codes) if codes else None
+    return code is not None and 500 <= code < 600
+
+
+class MailQueue:
+    """
+    Outbound messages keyed by id, in mail_queue.json. Thread and process safe.
+
+    Every change re-reads the file and writes it back under its FileLock, so
+    several MailQueue objects (the generator's, a delivery run's) never write
+    over each other's messages.
+    """
+
+    def __init__(self, path=QUEUE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self.items = self._read()
+
+    def _read(self):
+        try:
+            return read_json(self.path)
+        except Exception:
+            return {}
+
+    def _change(self, apply):
+        """Run `apply(items)` on the file's current contents and save them."""
+        from versioned_store import FileLock
+        with self._lock, FileLock(self.path):
+            self.items = self._read()
+            result = apply(self.items)
+            write_json_atomic(self.path, self.items, indent=None)
+            return result
+
+    def enqueue(self, to, pdf_path, subject, body):
+        item_id = uuid.uuid4().hex
+        self._change(lambda items: items.__setitem__(item_id, {
+            "to": to, "pdf": pdf_path, "subject": subject, "body": body,
+            "status": "pending", "attempts": 0, "next_try": 0, "error": "",
+        }))
+        return item_id
+
+    def enqueue_receipt(self, data, pdf_path):
+        """Queue a receipt for the address(es) in data['email']; returns the id or None."""
+        to = (data.get("email") or "").replace(";", ",").strip()
+        if not to:
+            return None
+        fields = {k: data.get(k, "") for k in ("recipeNum", "customer", "payment")}
+        return self.enqueue(to, pdf_path, SUBJECT.format(**fields), BODY.format(**fields))
+
+    def due(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self.items = self._read()
+            return [(i, dict(m)) for i, m in self.items.items() if m["status"] == "pending" and m["next_try"] <= now]
+
+    def counts(self):
+        with self._lock:
+            self.items = self._read()
+            result = {}
+            for m in self.items.values():
+                result[m["status"]] = result.get(m["status"], 0) + 1
+            return result
+
+    def update(self, results):
+        """Apply [(id, error_or_None)] from a delivery run in one write."""
+        now = time.time()
+
+        def apply(items):
+            for item_id, error in results:
+                item = items.get(item_id)
+                if item is None:
+                    continue
+                if error is None:
+                    # Sent items are dropped; the PDF and history are the record
+                    del items[item_id]
+                    continue
+                item["attempts"] += 1
+                item["error"] = str(error)
+                if _is_permanent(error) or item["attempts"] >= MAX_ATTEMPTS:
+                    item["status"] = "failed"
+                else:
+                    item["next_try"] = now + _backoff(item["attempts"])
+        self._change(apply)
+
+    def retry_failed(self):
+        def apply(items):
+            for item in items.values():
+                if item["status"] == "failed":
+                    item.update(status="pending", attempts=0, next_try=0)
+        self._change(apply)
+
+    def retry_now(self):
+        """Make every pending message due at once (the benchmark does not wait out backoffs)."""
+        self._change(lambda items: [item.update(next_try=0) for item in items.values()])
+
+
+def build_message(item, sender):
+    msg = EmailMessage()
+    msg["From"] = sender
+    msg["To"] = item["to"]
+    msg["Subject"] = item["subject"]
+    msg.set_content(item["body"])
+    with open(item["pdf"], "rb") as f:
+        payload = f.read()
+    ctype = mimetypes.guess_type(item["pdf"])[0] or "application/pdf"
+    maintype, subtype = ctype.split("/", 1)
+    msg.add_attachment(payload, maintype=maintype, subtype=subtype, filename=os.path.basename(item["pdf"]))
+    return msg
+
+
+def _connect(config):
+    if config["tls"] == "ssl":
+        server = smtplib.SMTP_SSL(config["host"], config["port"], timeout=30, context=ssl.create_default_context())
+    else:
+        server = smtplib.SMTP(config["host"], config["port"], timeout=30)
+        if config["tls"] == "starttls":
+            server.starttls(context=ssl.create_default_context())
+    if config["user"]:
+        server.login(config["user"], config["password"])
+    return server
+
+
+def _close(server):
+    try:
+        server.quit()
+    except Exception:
+        try:
+            server.close()
+        except Exception:
+            pass
+
+
+def _sender(config, work, record):
+    """Drain `work` over one connection, reopening it only when needed; `record(id, error)` after each message."""
+    server = None
+    sent_on_connection = 0
+    while True:
+        try:
+            item_id, item = work.get_nowait()
+        except queue.Empty:
+            break
+        try:
+            msg = build_message(item, config["from"])
+        except Exception as e:
+            record(item_id, e)
+            continue
+        error = None
+        for _ in range(2):
+            try:
+                if server is None or sent_on_connection >= MAX_PER_CONNECTION:
+                    if server is not None:
+                        _close(server)
+                    server = None
+                    with span("mail.connect"):
+                        server = _connect(config)
+                    sent_on_connection = 0
+                with span("mail.send"):
+                    server.send_message(msg)
+                sent_on_connection += 1
+                error = None
+                break
+            except smtplib.SMTPServerDisconnected as e:
+                # Server hung up (idle timeout, session limit): reconnect once and resend
+                server = None
+                error = e
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused) as e:
+                # The server refused this message but the session is still usable
+                error = e
+                break
+            except Exception as e:
+                if server is not None:
+                    _close(server)
+                server = None
+                error = e
+                break
+        record(item_id, error)
+    if server is not None:
+        _close(server)
+
+
+# Held for every delivery run in this process, so two runs never send the same due messages
+_deliver_lock = threading.Lock()
+
+
+def deliver(mail_queue=None, config=None, workers=SENDER_WORKERS, progress=None):
+    """Send every due message, after any run already going. Returns (sent, failed_this_run)."""
+    with _deliver_lock:
+        return _deliver(mail_queue, config, workers, progress)
+
+
+def _deliver(mail_queue, config, workers, progress):
+    mail_queue = mail_queue or MailQueue()
+    config = config or load_smtp_config()
+    due = mail_queue.due()
+    if not due:
+        return 0, 0
+    if not config["host"]:
+        raise RuntimeError("SMTP is not configured (smtp.json or RECEIPT_SMTP_HOST)")
+    work = queue.Queue()
+    for entry in due:
+        work.put(entry)
+    results = []
+
+    def record(item_id, error):
+        # Saved as each message completes, so a crash mid-run does not resend what went out
+        mail_queue.update([(item_id, error)])
+        results.append((item_id, error))
+
+    threads = [threading.Thread(target=_sender, args=(config, work, record), daemon=True)
+               for _ in range(max(1, min(workers, len(due))))]
+    with span("mail.deliver"):
+        for t in threads:
+            t.start()
+        while any(t.is_alive() for t in threads):
+            for t in threads:
+                t.join(timeout=0.2)
+            if progress:
+                progress(len(results), len(due))
+    sent = sum(1 for _, error in results if error is None)
+    return sent, len(results) - sent
+
+
+# Set by a deliver_async() call that found a run going; that run then does another pass
+_rerun = threading.Event()
+# on_done callbacks waiting for the next pass
+_callbacks = []
+_callbacks_lock = threading.Lock()
+
+
+def deliver_async(on_done=None):
+    """
+    Run deliver() on a background thread.
+
+    If a run is already going it does one more pass when it finishes, so mail
+    queued meanwhile goes out then. `on_done(result, error)` is called after
+    the pass that covered this call.
+    """
+    def work():
+        while _rerun.is_set():
+            if not _deliver_lock.acquire(blocking=False):
+                # The running pass checks _rerun after releasing the lock
+                return
+            try:
+                _rerun.clear()
+                with _callbacks_lock:
+                    callbacks = _callbacks[:]
+                    del _callbacks[:]
+                try:
+                    result = _deliver(None, None, SENDER_WORKERS, None)
+                    error = None
+                except Exception as e:
+                    result, error = (0, 0), e
+            finally:
+                _deliver_lock.release()
+            for callback in callbacks:
+                callback(result, error)
+
+    if on_done:
+        with _callbacks_lock:
+            _callbacks.append(on_done)
+    _rerun.set()
+    threading.Thread(target=work, daemon=True).start()
+
+
+# --- Local SMTP stub for offline testing -----------------------------------
+
+class StubSMTPServer:
+    """
+    Minimal threaded SMTP server that accepts (and discards) mail.
+
+    `fail_rate` makes that share of messages get a 451 reply at end of DATA,
+    `drop_rate` hangs up instead, to exercise retry and reconnect paths.
+    Counts connections and accepted messages so tests can check pooling.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, fail_rate=0.0, drop_rate=0.0):
+        import socketserver
+        stub = self
+        self.fail_rate = fail_rate
+        self.drop_rate = drop_rate
+        self.connections = 0
+        self.accepted = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write((line + "\r\n").encode())
+
+            def handle(self):
+                with stub._lock:
+                    stub.connections += 1
+                self.reply("220 stub ESMTP")
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    cmd = line.decode("latin-1").strip().upper()
+                    if cmd.startswith("EHLO"):
+                        self.wfile.write(b"250-stub\r\n250-SIZE 52428800\r\n250 8BITMIME\r\n")
+                    elif cmd.startswith("HELO") or cmd.startswith(("MAIL", "RCPT", "RSET", "NOOP")):
+                        self.reply("250 OK")
+                    elif cmd == "DATA":
+                        self.reply("354 End data with <CR><LF>.<CR><LF>")
+                        while self.rfile.readline() not in (b".\r\n", b".\n", b""):
+                            pass
+                        roll = random.random()
+                        if roll < stub.drop_rate:
+                            return
+                        if roll < stub.drop_rate + stub.fail_rate:
+                            with stub._lock:
+                                stub.rejected += 1
+                            self.reply("451 Try again later")
+                        else:
+                            with stub._lock:
+                                stub.accepted += 1
+                            self.reply("250 Queued")
+                    elif cmd == "QUIT":
+                        self.reply("221 Bye")
+                        return
+                    else:
+                        self.reply("502 Command not implemented")
+
+        class Server(socketserver.ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self._server = Server((host, port), Handler)
+        self.host, self.port = self._server.server_address[:2]
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def config(self):
+        return {"host": self.host, "port": self.port, "user": "", "password": "", "from": "receipts@localhost", "tls": "none"}
+
+
+def bench(count=300, workers=SENDER_WORKERS, fail_rate=0.05, drop_rate=0.01):
+    """Queue `count` receipts against the stub, deliver until empty and report throughput."""
+    import tempfile
+    from receiptGen import render_receipt
+    import json
+    folder = tempfile.mkdtemp(prefix="mailer_bench_")
+    with open("sample_data.json", "r", encoding="utf-8") as f:
+        data = json.load(f)
+    data.setdefault("Date", "01/06/2025")
+    pdf_path = os.path.join(folder, "receipt.pdf")
+    with open(pdf_path, "wb") as f:
+        f.write(render_receipt(data))
+    mail_queue = MailQueue(os.path.join(folder, "queue.json"))
+    for i in range(count):
+        mail_queue.enqueue(f"tenant{i}@example.com", pdf_path, SUBJECT.format(recipeNum=i, customer="", payment=""), "bench")
+    stub = StubSMTPServer(fail_rate=fail_rate, drop_rate=drop_rate).start()
+    start = time.perf_counter()
+    rounds = 0
+    try:
+        while mail_queue.counts().get("pending"):
+            rounds += 1
+            # Retries are due immediately in the benchmark
+            mail_queue.retry_now()
+            deliver(mail_queue, stub.config(), workers=workers)
+    finally:
+        stub.stop()
+    elapsed = time.perf_counter() - start
+    print(f"{count} messages in {elapsed:.2f}s ({count / elapsed:.0f} msg/s), {rounds} rounds")
+    print(f"connections: {stub.connections}, accepted: {stub.accepted}, rejected: {stub.rejected}, left: {mail_queue.counts()}")
+    return stub.accepted == count
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Receipt email delivery")
+    parser.add_argument("command", choices=("stub", "bench", "send"))
+    parser.add_argument("--port", type=int, default=8025)
+    parser.add_argument("--count", type=int, default=300)
+    parser.add_argument("--workers", type=int, default=SENDER_WORKERS)
+    parser.add_argument("--fail-rate", type=float, default=None)
+    parser.add_argument("--drop-rate", type=float, default=None)
+    args = parser.parse_args()
+    if args.command == "stub":
+        stub = StubSMTPServer(port=args.port, fail_rate=args.fail_rate or 0.0, drop_rate=args.drop_rate or 0.0).start()
+        print(f"SMTP stub listening on {stub.host}:{stub.port} (Ctrl+C to stop)")
+        try:
+            while True:
+                time.sleep(5)
+                print(f"connections: {stub.connections}, accepted: {stub.accepted}, rejected: {stub.rejected}")
+        except KeyboardInterrupt:
+            stub.stop()
+    elif args.command == "bench":
+        bench(args.count, args.workers, 0.05 if args.fail_rate is None else args.fail_rate,
+              0.01 if args.drop_rate is None else args.drop_rate)
+    else:
+        sent, failed = deliver(workers=args.workers)
+        print(f"sent {sent}, failed {failed}, queue: {MailQueue().counts()}")
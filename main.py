@@ -6,6 +6,11 @@ from receiptGenGUI import ReceiptGenGUI
 from new_customer import CustomerEditor
 from recrate_receipt import RecreateReceiptApp
 from to_excel import ToExcelApp
+from diagnostics import DiagnosticsApp
+from bank_import import BankImportApp
+from sequence_audit import SequenceAuditApp
+from store_watcher import StoreWatcher
+import storage
 
 
 def main():
@@ -13,6 +18,19 @@ def main():
 	root.title("Receipt Tools")
 	root.geometry('1000x700')
 
+	# With the local cache on, bring the mirror up to date before any tab reads it
+	syncer = storage.start_write_behind()
+	if syncer is not None:
+		status = tk.Label(root, anchor='w', relief='sunken')
+		status.pack(side='bottom', fill='x')
+
+		def update_status():
+			behind = syncer.pending_names or syncer.last_error or syncer.conflicts
+			status.config(text=syncer.status_text(), fg='red' if behind else 'black')
+			root.after(1000, update_status)
+
+		update_status()
+
 	notebook = ttk.Notebook(root)
 	notebook.pack(fill='both', expand=True)
 
@@ -37,6 +55,21 @@ def main():
 	notebook.add(tab4, text='Export to Excel')
 	excel_app = ToExcelApp(tab4)
 
+	# Tab 5: Bank statement import
+	tab_bank = tk.Frame(notebook)
+	notebook.add(tab_bank, text='Bank Import')
+	bank_app = BankImportApp(tab_bank)
+
+	# Tab 6: Receipt sequence audit (gaps, duplicates, date order)
+	tab_audit = tk.Frame(notebook)
+	notebook.add(tab_audit, text='Sequence Audit')
+	audit_app = SequenceAuditApp(tab_audit)
+
+	# Tab 7: Diagnostics (stage timings when tracing is enabled)
+	tab5 = tk.Frame(notebook)
+	notebook.add(tab5, text='Diagnostics')
+	diag_app = DiagnosticsApp(tab5)
+
 	# When user switches tabs, reload history in the relevant tabs
 	def on_tab_changed(event):
 		selected = event.widget.select()
@@ -44,14 +77,41 @@ def main():
 		try:
 			if tab_text == 'Recreate Receipt':
 				rec_app.reload_history()
-			elif tab_text == 'Export to Excel':
-				excel_app.reload_history()
+			elif tab_text == 'Diagnostics':
+				diag_app.refresh()
 		except Exception:
 			pass
 
 	notebook.bind('<<NotebookTabChanged>>', on_tab_changed)
 
+	# Push changes synced from other machines into every open tab
+	watcher = StoreWatcher().start()
+
+	def pump_store_changes():
+		names = watcher.take_changes()
+		if names:
+			ok = True
+			for app in (gen_app, cust_app, rec_app, audit_app):
+				try:
+					app.on_store_changed(names)
+				except Exception:
+					# Typically a file still being synced; the watcher hands it over again
+					ok = False
+			if ok:
+				watcher.done(names)
+			else:
+				watcher.failed(names)
+		root.after(250, pump_store_changes)
+
+	root.after(250, pump_store_changes)
+
 	root.mainloop()
+	watcher.stop()
+	if syncer is not None:
+		left = syncer.stop(flush=True)
+		if left:
+			# Copied on the next start (the sync state remembers what is still to go)
+			print(f"Not yet on Drive: {', '.join(left)}")
 
 
 if __name__ == '__main__':
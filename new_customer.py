@@ -1,10 +1,12 @@
 import os
 import json
+import bisect
+import threading
 import tkinter as tk
 from tkinter import messagebox, simpledialog
-
-DB_DIR = r"G:\My Drive\Rentals\RentalsDB"
-CUSTOMERS_FILE = os.path.join(DB_DIR, "customers_data.json")
+from tracing import action, span
+from versioned_store import ConflictError, Snapshot, read_versioned, update_versioned
+from store import CUSTOMERS_FILE, DB_DIR
 SAMPLE_KEYS = [
     "recipeNum",
     "discription",
@@ -18,8 +20,11 @@ SAMPLE_KEYS = [
     "Date",
     "SaveFolder",
     "bank_transfer_referance",
-    "transfer_bankAccount"
+    "transfer_bankAccount",
+    "email"
 ]
+# Edits are written this long after the last change
+AUTOSAVE_DELAY_MS = 2000
 
 
 class CustomerEditor(tk.Frame):
@@ -30,28 +35,229 @@ class CustomerEditor(tk.Frame):
         os.makedirs(DB_DIR, exist_ok=True)
         self.customers = {}
         self.current = None
+        # Names in listbox order, kept sorted so the listbox can be patched in place
+        self.names = []
+        # Customer keys changed (added, edited, renamed or deleted) since the last write
+        self.dirty = set()
+        self._autosave_id = None
+        self._backed_up = False
+        self._write_lock = threading.Lock()
+        self._write_gen = 0
+        # Customer key -> number of the newest snapshot that wrote it
+        self._key_written = {}
+        self.ledger = None
         self.load_customers()
         self.build_ui()
+        self.load_ledger()
+        self.bind("<Destroy>", self._on_destroy)
 
     def load_customers(self):
         try:
-            with open(CUSTOMERS_FILE, "r", encoding="utf-8") as f:
-                self.customers = json.load(f)
+            # Remember the version we read so saves can detect edits from other machines
+            self._base = read_versioned(CUSTOMERS_FILE)
+            self.customers = {k: dict(v) for k, v in self._base.data.items()}
         except Exception:
+            self._base = Snapshot({}, 0, None)
             self.customers = {}
 
+    def load_ledger(self):
+        """Load the payments ledger in the background (a rebuild streams the whole history)."""
+        def work():
+            try:
+                from ledger import load_ledger
+                ledger = load_ledger()
+            except Exception:
+                return
+            self.after(0, lambda: self._set_ledger(ledger))
+
+        threading.Thread(target=work, daemon=True).start()
+
+    def _set_ledger(self, ledger):
+        self.ledger = ledger
+        self.show_ledger()
+
+    def show_ledger(self):
+        """Payments of the selected customer this year, from the ledger."""
+        if self.current is None or self.ledger is None:
+            self.ledger_label.config(text="")
+            return
+        import datetime
+        from ledger import format_missing
+        data = self.customers.get(self.current, {})
+        year = datetime.date.today().year
+        rows = self.ledger.arrears({self.current: data}, year)
+        row = next((r for r in rows if r[0] == (data.get("customer") or self.current)), None)
+        if row is None:
+            self.ledger_label.config(text=f"{year}: no receipts")
+            return
+        _, rent, paid, count, missing, balance, last = row
+        text = f"{year}: paid {paid:,.0f} in {count} receipts"
+        if last:
+            text += f"   last: {last[0]} on {last[1]} ({last[2]})"
+        if missing:
+            text += f"\nNo receipt for: {format_missing(missing)}"
+        if rent:
+            text += f"\n{'Owes' if balance > 0 else 'Balance'} {abs(balance):,.0f} at {rent:,.0f} a month"
+        self.ledger_label.config(text=text)
+
+    def on_store_changed(self, names):
+        """Merge customer edits made on another machine, keeping local unsaved edits; raises if the read fails."""
+        from history_store import HISTORY_NAMES
+        if names & set(HISTORY_NAMES):
+            self.load_ledger()
+        if "customers_data.json" not in names:
+            return
+        # A partially synced file raises here and the watcher delivers the change again
+        snap = read_versioned(CUSTOMERS_FILE)
+        fresh = snap.data
+        if not isinstance(fresh, dict):
+            return
+        with self._write_lock:
+            if snap.generation >= self._base.generation:
+                self._base = snap
+        for name in set(self.customers) | set(fresh):
+            if name in self.dirty:
+                continue
+            shown = self.current == name and self._fields_show(self.customers.get(name, {}))
+            if name not in fresh:
+                self.customers.pop(name, None)
+                self._list_remove(name)
+                if self.current == name:
+                    self.current = None
+                    if shown:
+                        self._fill_fields({})
+            elif self.customers.get(name) != fresh[name]:
+                if name not in self.customers:
+                    self._list_insert(name)
+                self.customers[name] = fresh[name]
+                # Refresh the open customer unless its fields hold edits not yet applied with Update
+                if shown:
+                    self._fill_fields(fresh[name])
+
+    def _reload_customers(self):
+        try:
+            self.on_store_changed({"customers_data.json"})
+        except Exception:
+            pass
+
+    def _fields_show(self, data):
+        return all(ent.get() == str(data.get(k, "")) for k, ent in self.fields.items())
+
+    def _fill_fields(self, data):
+        for k in SAMPLE_KEYS:
+            self.fields[k].delete(0, tk.END)
+            self.fields[k].insert(0, data.get(k, ""))
+        self.show_ledger()
+
     def backup_customers(self):
         try:
             if os.path.exists(CUSTOMERS_FILE):
                 import shutil, datetime
                 ts = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
-                shutil.copy2(CUSTOMERS_FILE, f"{CUSTOMERS_FILE}.bak.{ts}")
+                with span("customers.backup"):
+                    shutil.copy2(CUSTOMERS_FILE, f"{CUSTOMERS_FILE}.bak.{ts}")
         except Exception:
             pass
 
+    def mark_dirty(self, *names):
+        """Record changed customers and (re)start the autosave timer."""
+        self.dirty.update(names)
+        if self._autosave_id is not None:
+            self.after_cancel(self._autosave_id)
+        self._autosave_id = self.after(AUTOSAVE_DELAY_MS, self._autosave)
+
+    def _snapshot(self):
+        """The dirty customers as {name: record copy, or None if deleted}, tagged with a write number."""
+        # Copy each record so the writer thread never sees a dict being edited
+        self._write_gen += 1
+        changes = {k: (dict(self.customers[k]) if k in self.customers else None) for k in self.dirty}
+        return self._write_gen, changes
+
+    def _write(self, gen, changes):
+        with self._write_lock:
+            # Keys already written by a newer snapshot keep that version
+            changes = {k: v for k, v in changes.items() if self._key_written.get(k, 0) < gen}
+            if not changes:
+                return
+            base = self._base
+
+            def apply(data):
+                conflicts = [k for k, v in changes.items()
+                             if data.get(k) != base.data.get(k) and data.get(k) != v]
+                if conflicts:
+                    raise ConflictError(CUSTOMERS_FILE, conflicts)
+                for k, v in changes.items():
+                    if v is None:
+                        data.pop(k, None)
+                    else:
+                        data[k] = v
+
+            with action("save_customers"):
+                if not self._backed_up:
+                    # One timestamped backup per session instead of one per write
+                    self.backup_customers()
+                    self._backed_up = True
+                with span("customers.write"):
+                    # Only the changed customers are rewritten on top of the latest file; a
+                    # customer also changed elsewhere since we read it raises ConflictError
+                    written = update_versioned(CUSTOMERS_FILE, apply)
+            data = dict(base.data)
+            apply(data)
+            self._base = Snapshot(data, written.generation, written.sha256)
+            for k in changes:
+                self._key_written[k] = gen
+            if written.generation > base.generation + 1:
+                # Someone else wrote in between; pick up their customers
+                self.after(0, self._reload_customers)
+
+    def _autosave(self):
+        self._autosave_id = None
+        if not self.dirty:
+            return
+        gen, changes = self._snapshot()
+        pending = set(self.dirty)
+        self.dirty.clear()
+
+        def work():
+            try:
+                self._write(gen, changes)
+            except ConflictError as e:
+                err = e
+                self.after(0, lambda: self._on_conflict(err, pending))
+            except Exception:
+                # Put the keys back so the next change or Save retries the write
+                self.after(0, lambda: self.mark_dirty(*pending))
+
+        threading.Thread(target=work, daemon=True).start()
+
+    def _on_conflict(self, err, pending):
+        # Take everything else from disk, keep our edits dirty; the next save then overwrites
+        # the conflicting customers with the local version
+        self.dirty.update(pending)
+        self._reload_customers()
+        messagebox.showerror("Save conflict", f"{err}\nPress Save again to keep your version of these customers.")
+
+    def flush(self):
+        """Write pending changes now, on the calling thread. Returns True if anything was written."""
+        if self._autosave_id is not None:
+            self.after_cancel(self._autosave_id)
+            self._autosave_id = None
+        if not self.dirty:
+            return False
+        gen, changes = self._snapshot()
+        self._write(gen, changes)
+        self.dirty.clear()
+        return True
+
+    def _on_destroy(self, event):
+        if event.widget is self:
+            try:
+                self.flush()
+            except Exception:
+                pass
+
     def save_customers(self):
         # Prevent saving if no customer is selected and fields are filled
-        sel = self.listbox.curselection()
         if self.current is None:
             # Check if any field is filled
             filled = any(ent.get().strip() for ent in self.fields.values())
@@ -59,10 +265,12 @@ class CustomerEditor(tk.Frame):
                 messagebox.showwarning("No customer selected", "Please select or add a customer before saving. Data in the fields will not be saved.")
                 return
         try:
-            self.backup_customers()
-            with open(CUSTOMERS_FILE, "w", encoding="utf-8") as f:
-                json.dump(self.customers, f, ensure_ascii=False, indent=2)
-            messagebox.showinfo("Saved", "Customers saved successfully.")
+            if self.flush():
+                messagebox.showinfo("Saved", "Customers saved successfully.")
+            else:
+                messagebox.showinfo("Saved", "No unsaved changes.")
+        except ConflictError as e:
+            self._on_conflict(e, set())
         except Exception as e:
             messagebox.showerror("Error", f"Failed to save customers: {e}")
 
@@ -114,23 +322,42 @@ class CustomerEditor(tk.Frame):
         tk.Button(action_frame, text="Update", command=self.update_customer).pack(side="left", padx=4)
         tk.Button(action_frame, text="Rename Key", command=self.rename_customer).pack(side="left", padx=4)
 
+        # Payments this year (ledger.py); 'payment' above is taken as the monthly rent
+        self.ledger_label = tk.Label(right, anchor="w", justify="left")
+        self.ledger_label.pack(fill="x", pady=(6, 0))
+
         self.refresh_list()
 
     def refresh_list(self):
+        self.names = sorted(self.customers.keys())
         self.listbox.delete(0, tk.END)
-        for name in sorted(self.customers.keys()):
+        for name in self.names:
             self.listbox.insert(tk.END, name)
 
+    def _list_insert(self, name):
+        idx = bisect.bisect_left(self.names, name)
+        self.names.insert(idx, name)
+        self.listbox.insert(idx, name)
+        return idx
+
+    def _list_remove(self, name):
+        idx = bisect.bisect_left(self.names, name)
+        if idx < len(self.names) and self.names[idx] == name:
+            del self.names[idx]
+            self.listbox.delete(idx)
+
+    def _list_select(self, idx):
+        self.listbox.selection_clear(0, tk.END)
+        self.listbox.selection_set(idx)
+        self.listbox.see(idx)
+
     def on_select(self, evt=None):
         sel = self.listbox.curselection()
         if not sel:
             return
         name = self.listbox.get(sel[0])
         self.current = name
-        data = self.customers.get(name, {})
-        for k in SAMPLE_KEYS:
-            self.fields[k].delete(0, tk.END)
-            self.fields[k].insert(0, data.get(k, ""))
+        self._fill_fields(self.customers.get(name, {}))
 
     def add_customer(self):
         name = simpledialog.askstring("Customer Name", "Enter new customer key/name:")
@@ -142,12 +369,9 @@ class CustomerEditor(tk.Frame):
         # Create entry populated with defaults
         self.customers[name] = {k: "" for k in SAMPLE_KEYS}
         self.customers[name]["customer"] = name
-        self.refresh_list()
+        self.mark_dirty(name)
         # select new
-        idx = list(sorted(self.customers.keys())).index(name)
-        self.listbox.selection_clear(0, tk.END)
-        self.listbox.selection_set(idx)
-        self.listbox.see(idx)
+        self._list_select(self._list_insert(name))
         self.on_select()
 
     def delete_customer(self):
@@ -160,7 +384,8 @@ class CustomerEditor(tk.Frame):
                 del self.customers[name]
             except KeyError:
                 pass
-            self.refresh_list()
+            self.mark_dirty(name)
+            self._list_remove(name)
             for f in self.fields.values():
                 f.delete(0, tk.END)
             # clear current selection state
@@ -180,17 +405,16 @@ class CustomerEditor(tk.Frame):
         for k, ent in self.fields.items():
             data[k] = ent.get()
         # Do not force the 'customer' field to match the dict key; allow editing independently
-        self.customers[name] = data
+        if self.customers.get(name) != data:
+            self.customers[name] = data
+            self.mark_dirty(name)
         messagebox.showinfo("Updated", f"Customer '{name}' updated.")
-        # Refresh list and reselect the updated customer so the UI keeps context
-        self.refresh_list()
-        try:
-            idx = list(sorted(self.customers.keys())).index(name)
-            self.listbox.selection_clear(0, tk.END)
-            self.listbox.selection_set(idx)
-            self.listbox.see(idx)
+        # The key is unchanged, so the listbox row stays where it is; just reselect it
+        idx = bisect.bisect_left(self.names, name)
+        if idx < len(self.names) and self.names[idx] == name:
+            self._list_select(idx)
             self.current = name
-        except Exception:
+        else:
             self.current = None
 
     def rename_customer(self):
@@ -213,15 +437,10 @@ class CustomerEditor(tk.Frame):
         # Optionally update the 'customer' field to match new key; we won't force it, but set if empty
         if not self.customers[new_name].get('customer'):
             self.customers[new_name]['customer'] = new_name
-        self.refresh_list()
-        try:
-            idx = list(sorted(self.customers.keys())).index(new_name)
-            self.listbox.selection_clear(0, tk.END)
-            self.listbox.selection_set(idx)
-            self.listbox.see(idx)
-            self.current = new_name
-        except Exception:
-            self.current = None
+        self.mark_dirty(old_name, new_name)
+        self._list_remove(old_name)
+        self._list_select(self._list_insert(new_name))
+        self.current = new_name
 
     # 'New Blank' removed per user request; create new customers via 'Add' and then edit fields
 
@@ -5,15 +5,24 @@ from reportlab.lib.units import mm
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.pdfbase.pdfmetrics import getFont
+from reportlab.graphics import shapes
+from reportlab.lib.utils import ImageReader
+from reportlab import rl_config
 from bidi.algorithm import get_display
+import io
+import os
 import json
+import hashlib
+import threading
+from tracing import span
 
 hebrew_text = "שלום עולם"
 
 
 
-pdfmetrics.registerFont(TTFont("Alef", "Alef-Regular.ttf"))
-pdfmetrics.registerFont(TTFont("Alef-Bold", "Alef-Bold.ttf"))
+with span("fonts.register"):
+    pdfmetrics.registerFont(TTFont("Alef", "Alef-Regular.ttf"))
+    pdfmetrics.registerFont(TTFont("Alef-Bold", "Alef-Bold.ttf"))
 
 TEMPLATE_SVG = "receipt_template_TP.svg"
 OUTPUT_PDF = r"c:/tmp/receipt.pdf"
@@ -83,62 +92,246 @@ def inkscapToDraw(x_mm, y_mm, w_mm, h_mm, page_h_mm):
   h_pt = h_mm * mm
   return x_pt, y_pt, w_pt, h_pt
 
-def create_receipt(data, saveNmae):
-    c = canvas.Canvas(saveNmae, pagesize=(PAGE_W, PAGE_H))
-    PH = 161
-    # Load and draw the SVG template
-    drawing = svg2rlg(TEMPLATE_SVG)
-    drawing.width, drawing.height = PAGE_W, PAGE_H  # Ensure correct scaling
-    renderPDF.draw(drawing, c, 0, 0)
-    # Overlay dynamic fields (like invoice number, amounts)
-    c.setFont("Helvetica", 10)
-    x, y = inkScapeToReplib(60, 26, 15, 5, PH, "Helvetica", 10)
-    c.drawRightString(x*mm, y*mm, data["recipeNum"])
-    x, y = inkScapeToReplib(11, 5*9+55.75, 13, 3.5, PH, "Helvetica", 10)
-    c.drawRightString(x*mm, y*mm, data["payment"])
-    x, y = inkScapeToReplib(11, 5*8+55.75, 13, 3.5, PH, "Helvetica", 10)
-    c.drawRightString(x*mm, y*mm, data["mamVal"])
-    rtl_text = get_display(data["customer"])  # Corrects Hebrew order
-    c.setFont("Alef", 12)
-    x, y = inkScapeToReplib(32, 55.75, 80, 3.5, PH, "Alef", 12)
-    rtl_text = get_display(data["discription"])  # Corrects Hebrew order
-    c.drawRightString(x*mm, y*mm, rtl_text)
-    x, y = inkScapeToReplib(45, 36, 60, 3.5, PH, "Alef", 12)
-    c.drawRightString(x*mm, y*mm, rtl_text)
-    c.setFont("Alef", 10)
-    x, y = inkScapeToReplib(11, 115, 104, 10, PH, "Alef", 10)
+def render_receipt(data, out=None, use_cache=True, profile="standard"):
+    """
+    Render a receipt entirely in memory.
+
+    Args:
+      data      : receipt fields, same dict create_receipt takes
+      out       : optional writable file-like object (BytesIO, socket file, zip entry...)
+                  that also receives the PDF bytes
+      use_cache : serve identical records from the local render cache
+      profile   : "standard", or "compact" for smaller archive files (simplified
+                  template paths, no ASCII85, recompressed signature)
+
+    Returns:
+      memoryview over the PDF bytes
+    """
+    cache = _get_render_cache() if use_cache else None
+    if cache is not None:
+        key = render_key(data, profile)
+        with span("cache.get"):
+            cached = cache.get(key)
+        if cached is not None:
+            pdf = memoryview(cached)
+            if out is not None:
+                out.write(pdf)
+            return pdf
+    pdf = _draw_receipt(data, profile)
+    if cache is not None:
+        with span("cache.put"):
+            cache.put(key, pdf)
+    if out is not None:
+        out.write(pdf)
+    return pdf
+
+def _draw_receipt(data, profile="standard"):
+    compact = profile == "compact"
+    # rl_config.useA85 is global and read while drawing images and serializing,
+    # so renders in different threads must not interleave while it is switched
+    with _RL_CONFIG_LOCK:
+        saved_a85 = rl_config.useA85
+        rl_config.useA85 = 0 if compact else saved_a85
+        try:
+            # invariant=1 fixes the creation date and document ID so equal input gives equal bytes
+            c = canvas.Canvas(io.BytesIO(), pagesize=(PAGE_W, PAGE_H), invariant=1, pageCompression=1 if compact else None)
+            PH = 161
+            # Load and draw the SVG template
+            with span("svg.parse"):
+                drawing = _compact_template() if compact else _template()
+            drawing.width, drawing.height = PAGE_W, PAGE_H  # Ensure correct scaling
+            with span("template.draw"):
+                renderPDF.draw(drawing, c, 0, 0)
+            with span("overlay.draw"):
+                _draw_overlay(c, data, PH, _compact_signature() if compact else HoniSig)
+            with span("pdf.serialize"):
+                c.showPage()
+                pdf = memoryview(c.getpdfdata())
+        finally:
+            rl_config.useA85 = saved_a85
+    return pdf
+
+def _round_shapes(node, ndigits):
+    # Round coordinates after svglib made them absolute, so errors do not accumulate
+    # along relative path commands the way rounding the SVG text would
+    if isinstance(node, shapes.Group):
+        for child in node.contents:
+            _round_shapes(child, ndigits)
+        return
+    if getattr(node, "points", None):
+        node.points = [round(v, ndigits) for v in node.points]
+    for attr in ("x", "y", "width", "height", "x1", "y1", "x2", "y2", "cx", "cy", "r", "rx", "ry"):
+        v = getattr(node, attr, None)
+        if isinstance(v, float):
+            setattr(node, attr, round(v, ndigits))
+
+def _template():
+    """Parsed template, parsed once per process (drawing it does not modify it)."""
+    global _drawing
+    if _drawing is None:
+        _drawing = svg2rlg(TEMPLATE_SVG)
+    return _drawing
+
+def _compact_template():
+    """Parsed template with coordinates rounded to COMPACT_NDIGITS user units (mm); parsed once per process."""
+    global _compact_drawing
+    if _compact_drawing is None:
+        drawing = svg2rlg(TEMPLATE_SVG)
+        _round_shapes(drawing, COMPACT_NDIGITS)
+        _compact_drawing = drawing
+    return _compact_drawing
+
+def _compact_signature():
+    """Signature downscaled to SIGNATURE_DPI and re-encoded as grayscale JPEG; original file without Pillow."""
+    global _compact_sig
+    if _compact_sig is None:
+        try:
+            from PIL import Image
+        except ImportError:
+            _compact_sig = HoniSig
+            return _compact_sig
+        _, _, w_pt, h_pt = signature_box()
+        size = (round(w_pt / 72 * SIGNATURE_DPI), round(h_pt / 72 * SIGNATURE_DPI))
+        img = Image.open(HoniSig).convert("L").resize(size, Image.LANCZOS)
+        buf = io.BytesIO()
+        img.save(buf, "JPEG", quality=SIGNATURE_QUALITY, optimize=True)
+        _compact_sig = ImageReader(io.BytesIO(buf.getvalue()))
+    return _compact_sig
+
+def create_receipt(data, saveNmae, profile="standard"):
+    pdf = render_receipt(data, profile=profile)
+    with span("pdf.write"), open(saveNmae, "wb") as f:
+        f.write(pdf)
+    print("Saved:", saveNmae)
+
+def _bank_line(data):
     # Compose optional bank/transfer line. If 'bank_transfer' is present use it directly,
-    # otherwise build the line from available fields. If nothing is present, skip drawing.
-    bank_text = ''
+    # otherwise build the line from available fields.
     if data.get('bank_transfer_referance') is not None and data.get('bank_transfer_referance') != '':
         bank_text = data.get('bank_transfer_referance')
-        transfer_account = data.get('transfer_bankAccount')
-        c.drawRightString(x*mm, y*mm,  transfer_account + ' :מחשבון '[::-1] + bank_text + '  העברה בנקאית אסמכתא: '[::-1])
-    else:
-        parts = []
-        # Keep the original visual order but only include existing fields
-        if data.get('payment'):
-            parts.append(data.get('payment') + ' סכום: '[::-1])
-        # Hebrew labels reversed in source: keep original style
-        if data.get('bankAccount'):
-            parts.append(data.get('bankAccount') + ' חשבון: '[::-1])
-        if data.get('BankNumber'):
-            parts.append( data.get('BankNumber') + ' בנק: '[::-1])
-        if data.get('CheckNumber'):
-            parts.append(data.get('CheckNumber')+" מס צ'ק: "[::-1])
-        # join without extra separators to match previous formatting
-        bank_text = ''.join(parts)
-        c.drawRightString(x*mm, y*mm, bank_text)
-        
-
-    x, y = inkScapeToReplib(80, 130, 24, 6, PH, "Alef", 10)
-    c.drawRightString(x*mm, y*mm, f"{data.get('Date', '')}")
-    x, y, w, h = inkscapToDraw(11, 131, 24, 6, PH)
-    # print(f'sig pos {x} {y} {w} {h}')
-    c.drawImage(HoniSig, x, y, w, h)
-    c.showPage()
-    c.save()
-    print("Saved:", saveNmae)
+        transfer_account = data.get('transfer_bankAccount') or ''
+        return transfer_account + ' :מחשבון '[::-1] + bank_text + '  העברה בנקאית אסמכתא: '[::-1]
+    parts = []
+    # Keep the original visual order but only include existing fields
+    if data.get('payment'):
+        parts.append(data.get('payment') + ' סכום: '[::-1])
+    # Hebrew labels reversed in source: keep original style
+    if data.get('bankAccount'):
+        parts.append(data.get('bankAccount') + ' חשבון: '[::-1])
+    if data.get('BankNumber'):
+        parts.append( data.get('BankNumber') + ' בנק: '[::-1])
+    if data.get('CheckNumber'):
+        parts.append(data.get('CheckNumber')+" מס צ'ק: "[::-1])
+    # join without extra separators to match previous formatting
+    return ''.join(parts)
+
+# Overlay text boxes: (slot, x_mm, y_mm, box_w_mm, box_h_mm, font, size), in drawing order
+OVERLAY_LAYOUT = (
+    ("recipeNum", 60, 26, 15, 5, "Helvetica", 10),
+    ("payment", 11, 5*9+55.75, 13, 3.5, "Helvetica", 10),
+    ("mamVal", 11, 5*8+55.75, 13, 3.5, "Helvetica", 10),
+    ("discription", 32, 55.75, 80, 3.5, "Alef", 12),
+    # The customer box has always shown the description text as well
+    ("customer", 45, 36, 60, 3.5, "Alef", 12),
+    ("bank", 11, 115, 104, 10, "Alef", 10),
+    ("Date", 80, 130, 24, 6, "Alef", 10),
+)
+
+def overlay_items(data, PH=161):
+    """
+    Dynamic text drawn over the template, in drawing order.
+
+    Returns:
+      [(slot, font_name, font_size_pt, x_pt, y_pt, text)] where (x_pt, y_pt) is the
+      right end of the baseline, as passed to drawRightString
+    """
+    rtl_text = get_display(data["discription"])  # Corrects Hebrew order
+    texts = {
+        "recipeNum": data["recipeNum"],
+        "payment": data["payment"],
+        "mamVal": data["mamVal"],
+        "discription": rtl_text,
+        "customer": rtl_text,
+        "bank": _bank_line(data),
+        "Date": f"{data.get('Date', '')}",
+    }
+    items = []
+    for slot, x_mm, y_mm, w_mm, h_mm, font, size in OVERLAY_LAYOUT:
+        x, y = inkScapeToReplib(x_mm, y_mm, w_mm, h_mm, PH, font, size)
+        items.append((slot, font, size, x*mm, y*mm, texts[slot]))
+    return items
+
+def overlay_boxes(PH=161):
+    """{slot: (left, bottom, right, top)} in points: where each slot's text sits on the page."""
+    boxes = {}
+    for slot, x_mm, y_mm, w_mm, h_mm, font, size in OVERLAY_LAYOUT:
+        x, y = inkScapeToReplib(x_mm, y_mm, w_mm, h_mm, PH, font, size)
+        # Baseline to ascender, with room for descenders
+        boxes[slot] = ((x - w_mm)*mm, y*mm - 0.3*size, x*mm + 1, y*mm + 0.9*size)
+    return boxes
+
+def signature_box(PH=161):
+    """(x_pt, y_pt, w_pt, h_pt) of the signature image."""
+    return inkscapToDraw(11, 131, 24, 6, PH)
+
+def _draw_overlay(c, data, PH, signature=HoniSig):
+    # Overlay dynamic fields (like invoice number, amounts)
+    current_font = None
+    for slot, font, size, x, y, text in overlay_items(data, PH):
+        if (font, size) != current_font:
+            c.setFont(font, size)
+            current_font = (font, size)
+        c.drawRightString(x, y, text)
+    x, y, w, h = signature_box(PH)
+    c.drawImage(signature, x, y, w, h)
+
+FONT_FILES = ("Alef-Regular.ttf", "Alef-Bold.ttf")
+# Fields that end up on the page; anything else (SaveFolder, invoice_no...) does not change the PDF
+RENDER_FIELDS = ("recipeNum", "discription", "customer", "payment", "mamVal", "bankAccount", "BankNumber",
+                 "CheckNumber", "Date", "bank_transfer_referance", "transfer_bankAccount")
+# Bump when the drawing code changes so old cache entries stop matching
+RENDER_VERSION = "1"
+# Compact profile: template coordinates kept to 0.01 mm, signature at 200 DPI
+COMPACT_NDIGITS = 2
+SIGNATURE_DPI = 200
+SIGNATURE_QUALITY = 70
+_template_hash = None
+_render_cache = None
+_drawing = None
+_compact_drawing = None
+_compact_sig = None
+_RL_CONFIG_LOCK = threading.Lock()
+
+def data_hash(data):
+    """Stable hash of a receipt record; key order does not matter."""
+    blob = json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+def template_hash():
+    """Hash of everything besides the record that affects the output (template, signature, fonts)."""
+    global _template_hash
+    if _template_hash is None:
+        h = hashlib.sha256()
+        for path in (TEMPLATE_SVG, HoniSig) + FONT_FILES:
+            with open(path, "rb") as f:
+                h.update(f.read())
+        _template_hash = h.hexdigest()
+    return _template_hash
+
+def render_key(data, profile="standard"):
+    """Cache key: normalized record + template/font assets + drawing code version + output profile."""
+    normalized = {k: data[k] for k in RENDER_FIELDS if k in data}
+    blob = json.dumps([RENDER_VERSION, template_hash(), profile, normalized], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+def _get_render_cache():
+    global _render_cache
+    if _render_cache is None:
+        if os.environ.get("RECEIPT_RENDER_CACHE", "1") in ("", "0"):
+            return None
+        from render_cache import RenderCache
+        _render_cache = RenderCache()
+    return _render_cache
 
 def read_customer_data(file_path):
     with open(file_path, "r", encoding="utf-8") as f:
@@ -147,7 +340,8 @@ def read_customer_data(file_path):
 
 if __name__ == "__main__":
   # Example data
-  cData = read_customer_data(r"G:\My Drive\Rentals\RentalsDB\customers_data.json")
+  from store import CUSTOMERS_FILE
+  cData = read_customer_data(CUSTOMERS_FILE)
   sample_data = cData["Dalya"]
   sample_data['bank_transfer_referance'] = '1234567890'
   sample_data['transfer_bankAccount'] = '012909912'
@@ -1,14 +1,23 @@
 import os
-import json
+import threading
 import tkinter as tk
 from tkinter import filedialog, messagebox
-from receiptGen import create_receipt
+from receiptGen import create_receipt, render_receipt, data_hash
+from tracing import action, span
+from customer_picker import CustomerPicker
+from store import DB_DIR, ReceiptCounter, apply_changes, read_json
+from versioned_store import ConflictError
+from history_store import append_history
+from ledger import record_appended
 from bidi.algorithm import get_display
 
+# Wait this long after the last keystroke before re-rendering the preview
+PREVIEW_DELAY_MS = 300
+
 class ReceiptGenGUI:
     def __init__(self, master):
-        # Central DB directory for shared files
-        self.DB_DIR = r"G:\My Drive\Rentals\RentalsDB"
+        # Central DB directory for shared files (the Drive folder or its local mirror, see storage)
+        self.DB_DIR = DB_DIR
         # Ensure DB_DIR exists when needed (writes will create it as necessary)
         try:
             os.makedirs(self.DB_DIR, exist_ok=True)
@@ -23,10 +32,28 @@ class ReceiptGenGUI:
             pass
         self.data = {}
         self.entries = {}
+        # Form rows (label, entry) by field name, created once and reused for every customer
+        self.form_rows = {}
+        self._form_keys = []
+        # On the synced folder even with the local cache on (see storage.COUNTER_FILE)
+        self.counter = ReceiptCounter()
         self.save_path = None
         self.customers = {}
+        self.customer_file = None
         self.selected_customer = tk.StringVar()
         parent = master
+        # Live preview on the right; rendered off the UI thread a moment after typing stops
+        self.preview_label = tk.Label(parent, text="Preview", relief="sunken", bg="white")
+        self.preview_label.pack(side="right", fill="y", padx=10, pady=10)
+        self._preview_renderer = None
+        self._preview_after = None
+        self._preview_gen = 0
+        self._preview_photo = None
+        self._preview_lock = threading.Lock()
+        # Speculative render of the current form (hash of the values -> future PDF bytes)
+        self._spec_pool = None
+        self._spec_key = None
+        self._spec_future = None
         self.customer_file_btn = tk.Button(parent, text="Load Customer Data File", command=self.load_customer_file)
         self.customer_file_btn.pack(pady=10)
         self.customer_select_frame = tk.Frame(parent)
@@ -67,19 +94,35 @@ class ReceiptGenGUI:
                 return
             return
         try:
-            with open(file_path, encoding="utf-8") as f:
-                loaded = json.load(f)
+            loaded = read_json(file_path)
         except Exception as e:
             messagebox.showerror("Error", f"Failed to load file: {e}")
             return
         # If loaded is a dict of customers, set self.customers
         if isinstance(loaded, dict) and all(isinstance(v, dict) for v in loaded.values()):
             self.customers = loaded
+            self.customer_file = file_path
             self.show_customer_dropdown()
         else:
             self.data = loaded
             self.create_form()
     
+    def on_store_changed(self, names):
+        """Called by the store watcher with the DB file names that changed on disk; raises if a read fails."""
+        if "customers_data.json" in names and self.customer_file and \
+                os.path.normcase(os.path.abspath(self.customer_file)) == os.path.normcase(os.path.abspath(os.path.join(self.DB_DIR, "customers_data.json"))):
+            # A read error propagates so the watcher retries the change
+            fresh = read_json(self.customer_file)
+            if isinstance(fresh, dict) and apply_changes(self.customers, fresh) and self.customer_dropdown is not None:
+                self.customer_dropdown.set_customers(self.customers)
+        if "receipt_number.txt" in names:
+            self.counter.invalidate()
+            next_num = self.counter.peek()
+            if next_num and "recipeNum" in self.entries:
+                self.entries["recipeNum"].delete(0, tk.END)
+                self.entries["recipeNum"].insert(0, next_num)
+                self.schedule_preview()
+
     def show_customer_dropdown(self):
         for widget in self.customer_select_frame.winfo_children():
             widget.destroy()
@@ -87,12 +130,13 @@ class ReceiptGenGUI:
         if not customer_names:
             messagebox.showerror("Error", "No customers found in file.")
             return
-        self.selected_customer.set(customer_names[0])
         label = tk.Label(self.customer_select_frame, text="Select Customer:")
         label.pack(side="left")
-        self.customer_dropdown = tk.OptionMenu(self.customer_select_frame, self.selected_customer, *customer_names, command=self.on_customer_selected)
-        self.customer_dropdown.pack(side="left")
-        self.on_customer_selected(self.selected_customer.get())
+        # Searchable picker: type part of the key or Hebrew name, most recent customers listed first
+        self.customer_dropdown = CustomerPicker(self.customer_select_frame, self.customers, self.selected_customer, command=self.on_customer_selected)
+        self.customer_dropdown.pack(side="left", fill="x", expand=True)
+        recent = [k for k in self.customer_dropdown.recent if k in self.customers]
+        self.customer_dropdown.select(recent[0] if recent else customer_names[0])
 
     def on_customer_selected(self, customer_name):
         self.save_path = None
@@ -106,29 +150,117 @@ class ReceiptGenGUI:
             pass
         self.create_form()
 
+    def _form_row(self, key):
+        row = self.form_rows.get(key)
+        if row is None:
+            label = tk.Label(self.form_frame, text=key, width=20, anchor="w")
+            entry = tk.Entry(self.form_frame)
+            entry.bind("<KeyRelease>", self.schedule_preview)
+            row = self.form_rows[key] = (label, entry)
+        return row
+
     def create_form(self):
-        for widget in self.form_frame.winfo_children():
-            widget.destroy()
-        self.entries.clear()
-        # Read recipeNum from receipt_number.txt if present in DB_DIR
-        recipe_num_path = os.path.join(self.DB_DIR, "receipt_number.txt")
+        """Show self.data in the form, reusing the rows; only changed values are rewritten."""
+        with span("form.fill"):
+            # The counter is cached; the file is only re-read when the store watcher reports a change
+            next_num = self.counter.peek()
+            keys = list(self.data.keys())
+            if keys != self._form_keys:
+                # Use grid layout for responsive resizing
+                self.form_frame.columnconfigure(1, weight=1)
+                for label, entry in self.form_rows.values():
+                    label.grid_remove()
+                    entry.grid_remove()
+                for i, key in enumerate(keys):
+                    label, entry = self._form_row(key)
+                    label.grid(row=i, column=0, sticky="w", padx=2, pady=2)
+                    entry.grid(row=i, column=1, sticky="ew", padx=2, pady=2)
+                self._form_keys = keys
+                self.entries.clear()
+                self.entries.update((key, self.form_rows[key][1]) for key in keys)
+            for key, value in self.data.items():
+                entry = self.entries[key]
+                value = next_num if key == "recipeNum" and next_num else str(value)
+                if entry.get() != value:
+                    entry.delete(0, tk.END)
+                    entry.insert(0, value)
+        self.schedule_preview()
+
+    def schedule_preview(self, event=None):
+        """Debounce preview renders while the user is typing."""
+        if self._preview_after is not None:
+            self.preview_label.after_cancel(self._preview_after)
+        self._preview_after = self.preview_label.after(PREVIEW_DELAY_MS, self._start_preview)
+
+    def _start_preview(self):
+        self._preview_after = None
+        if not self.entries:
+            return
+        self._start_speculative_render()
+        if self._preview_renderer is None:
+            from receipt_preview import PreviewRenderer
+            self._preview_renderer = PreviewRenderer()
+        self._preview_gen += 1
+        gen = self._preview_gen
+        values = {k: v.get() for k, v in self.entries.items()}
+        renderer = self._preview_renderer
+
+        def work():
+            # One render at a time; a newer request makes older results stale
+            with self._preview_lock:
+                if gen != self._preview_gen:
+                    return
+                try:
+                    image = renderer.render(values)
+                    error = None
+                except Exception as e:
+                    image, error = None, e
+            self.preview_label.after(0, lambda: self._show_preview(gen, image, error))
+
+        threading.Thread(target=work, daemon=True).start()
+
+    def _start_speculative_render(self):
+        """Render the PDF for the current form in the background so Generate only has to save it."""
+        values = {k: v.get() for k, v in self.entries.items()}
+        # Only worth it when the form would render: required fields present and a numeric receipt number
+        if not values.get("recipeNum", "").isdigit() or any(k not in values for k in ("payment", "mamVal", "discription")):
+            return
+        key = data_hash(values)
+        if key == self._spec_key:
+            return
+        if self._spec_pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._spec_pool = ThreadPoolExecutor(max_workers=1)
+        # Drop the render for the previous form state if it has not started; at most one
+        # stale render can then be ahead of this one
+        if self._spec_future is not None:
+            self._spec_future.cancel()
+        self._spec_key = key
+        # Kept out of the disk render cache: most idle states are never generated
+        self._spec_future = self._spec_pool.submit(lambda: bytes(render_receipt(values, use_cache=False)))
+
+    def _take_speculative(self, data):
+        """PDF bytes rendered ahead of time for exactly `data`, or None."""
+        if self._spec_future is None or self._spec_key != data_hash(data):
+            return None
         try:
-            with open(recipe_num_path, "r", encoding="utf-8") as f:
-                next_num = f.read().strip()
+            return self._spec_future.result()
         except Exception:
-            next_num = None
-        # Use grid layout for responsive resizing
-        self.form_frame.columnconfigure(1, weight=1)
-        for i, (key, value) in enumerate(self.data.items()):
-            label = tk.Label(self.form_frame, text=key, width=20, anchor="w")
-            label.grid(row=i, column=0, sticky="w", padx=2, pady=2)
-            entry = tk.Entry(self.form_frame)
-            if key == "recipeNum" and next_num:
-                entry.insert(0, next_num)
-            else:
-                entry.insert(0, str(value))
-            entry.grid(row=i, column=1, sticky="ew", padx=2, pady=2)
-            self.entries[key] = entry
+            return None
+
+    def _show_preview(self, gen, image, error):
+        if gen != self._preview_gen:
+            return
+        if image is None:
+            self.preview_label.config(image="", text=f"Preview unavailable:\n{error}", wraplength=250)
+            return
+        try:
+            from PIL import ImageTk
+        except ImportError:
+            self.preview_label.config(image="", text="Preview needs Pillow (pip install pillow)")
+            return
+        self._preview_photo = ImageTk.PhotoImage(image)
+        self.preview_label.config(image=self._preview_photo, text="")
 
     def choose_save_location(self):
         import os
@@ -142,6 +274,10 @@ class ReceiptGenGUI:
             self.save_btn.config(text=f"Save Path Selected:\n{os.path.basename(path)}")
 
     def generate_receipt(self):
+        with action("generate_receipt"):
+            self._generate_receipt()
+
+    def _generate_receipt(self):
         if not self.data:
             messagebox.showwarning("Warning", "No customer data loaded.")
             return
@@ -149,15 +285,11 @@ class ReceiptGenGUI:
             messagebox.showwarning("Warning", "No customer selected.")
             return
         # If user did not choose a save location, generate default path from customer, recipeNum, and Date
-        if not self.save_path:
+        default_path = not self.save_path
+        if default_path:
             customer_name = self.selected_customer.get() if self.selected_customer.get() else self.data.get('customer', '')
             # Use actual receipt number from receipt_number.txt in DB_DIR
-            recipe_num_path = os.path.join(self.DB_DIR, "receipt_number.txt")
-            try:
-                with open(recipe_num_path, "r", encoding="utf-8") as f:
-                    recipe_num = f.read().strip()
-            except Exception:
-                recipe_num = self.data.get('recipeNum', '')
+            recipe_num = self.counter.peek() or self.data.get('recipeNum', '')
             date_str = self.data.get('Date', '')
             month_year = ''
             try:
@@ -178,67 +310,114 @@ class ReceiptGenGUI:
                 save_folder = self.DB_DIR
             self.save_path = os.path.join(save_folder, filename)
         data = {k: v.get() for k, v in self.entries.items()}
+        recipe_num = data.get("recipeNum", "")
+        # A number the form took from the counter is only ours if no one (on any machine) issued it since
+        from_counter = bool(recipe_num) and recipe_num == self.counter.peek()
         try:
-            create_receipt(data, self.save_path)
-            # Append this receipt to history.json
-            try:
-                history_path = os.path.join(self.DB_DIR, "history.json")
-                # Load existing history if possible
-                try:
-                    with open(history_path, "r", encoding="utf-8") as hf:
-                        import json as _json
-                        existing = _json.load(hf)
-                except Exception:
-                    # If file missing or malformed, start fresh
-                    existing = {}
-                # Use recipeNum as the top-level key (zero-padded if possible)
-                recipe_key = data.get("recipeNum", "")
-                if recipe_key and recipe_key.isdigit():
-                    # keep same formatting as receipt_number (e.g. 00001)
-                    recipe_key = f"{int(recipe_key):05d}"
-                # Group under customer name so the structure matches existing samples
-                customer_name = data.get("customer", "Unknown")
-                existing[recipe_key] = {customer_name: data}
-                # Before writing back, create a timestamped backup of the existing history file if it exists
-                try:
-                    import shutil, datetime
-                    if os.path.exists(history_path):
-                        ts = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
-                        backup_path = f"{history_path}.bak.{ts}"
-                        shutil.copy2(history_path, backup_path)
-                except Exception:
-                    # Backup failure shouldn't block saving history
-                    pass
-                # Write back
-                with open(history_path, "w", encoding="utf-8") as hf:
-                    import json as _json
-                    _json.dump(existing, hf, ensure_ascii=False, indent=2)
-            except Exception:
-                # Don't prevent successful receipt creation if history update fails
-                pass
-            # Increment recipeNum in receipt_number.txt
-            recipe_num_path = os.path.join(self.DB_DIR, "receipt_number.txt")
+            history_error = None
             new_num = None
-            if "recipeNum" in data:
-                try:
-                    num = int(data["recipeNum"])
-                    new_num = num + 1
-                    with open(recipe_num_path, "w", encoding="utf-8") as f:
-                        f.write(f"{new_num:05d}")
-                except Exception:
-                    pass
+            # Issue under the counter's lock, which is on the synced folder: check the number, save
+            # the PDF, append to history and move the counter without another machine in between
+            with self.counter.lock():
+                if from_counter:
+                    self.counter.invalidate()
+                    taken = self.counter.peek() != recipe_num
+                else:
+                    taken = False
+                if not taken:
+                    pdf = self._take_speculative(data)
+                    if pdf is not None:
+                        # Fields unchanged since the background render: just save those bytes
+                        with span("receipt.commit_speculative"), open(self.save_path, "wb") as f:
+                            f.write(pdf)
+                    else:
+                        with span("receipt.render"):
+                            create_receipt(data, self.save_path)
+                    history_error, recipe_key, generation = self._append_history(data)
+                    # Increment recipeNum in receipt_number.txt
+                    if "recipeNum" in data:
+                        try:
+                            with span("counter.write"):
+                                new_num = self.counter.advance(data["recipeNum"], locked=True)
+                        except Exception:
+                            pass
+            if taken:
+                next_num = self.counter.peek()
+                if next_num and "recipeNum" in self.entries:
+                    self.entries["recipeNum"].delete(0, tk.END)
+                    self.entries["recipeNum"].insert(0, next_num)
+                    self.schedule_preview()
+                if default_path:
+                    # The default file name carries the old number
+                    self.save_path = None
+                messagebox.showerror("Receipt number in use", f"Receipt {recipe_num} was just issued elsewhere (another machine?). The form now shows {next_num}; nothing was saved.")
+                return
+            if history_error is None:
+                history_path = os.path.join(self.DB_DIR, "history.json")
+                self._warn_sequence(history_path, recipe_key, data, generation)
+                record_appended(history_path, [(recipe_key, data.get("customer", "Unknown"), data)], generation)
+            elif isinstance(history_error, ConflictError):
+                messagebox.showerror("Receipt number in use", f"Receipt {recipe_key} already exists in history with different data (issued on another machine?). The PDF was saved but history was not updated.")
+            self._queue_email(data, self.save_path)
             messagebox.showinfo("Success", f"Receipt saved to {self.save_path}")
             # Update GUI with new receipt number
             if new_num:
                 if "recipeNum" in self.entries:
                     self.entries["recipeNum"].delete(0, tk.END)
                     self.entries["recipeNum"].insert(0, f"{new_num:05d}")
+                    self.schedule_preview()
             # Enable open folder button only after successful save
             self.open_folder_btn.config(state="normal")
         except Exception as e:
             messagebox.showerror("Error", f"Failed to generate receipt: {e}")
             self.open_folder_btn.config(state="disabled")
 
+    def _append_history(self, data):
+        """Append the receipt to history; returns (error or None, recipe_key, generation)."""
+        # Use recipeNum as the top-level key (zero-padded if possible)
+        recipe_key = data.get("recipeNum", "")
+        if recipe_key and recipe_key.isdigit():
+            # keep same formatting as receipt_number (e.g. 00001)
+            recipe_key = f"{int(recipe_key):05d}"
+        # Group under customer name so the structure matches existing samples
+        customer_name = data.get("customer", "Unknown")
+        try:
+            with span("history.write"):
+                # Under the history lock: raises ConflictError if the number is already taken,
+                # and backs up the file it writes (history.json or that year's partition)
+                generation = append_history(os.path.join(self.DB_DIR, "history.json"), {recipe_key: {customer_name: data}}, backup=True)
+            return None, recipe_key, generation
+        except Exception as e:
+            # Don't prevent successful receipt creation if history update fails
+            return e, recipe_key, None
+
+    def _warn_sequence(self, history_path, recipe_key, data, generation):
+        """Tell the user right away if this receipt broke the numbering or date order."""
+        try:
+            from sequence_audit import check_appended
+            with span("history.audit"):
+                issues = check_appended(history_path, [(recipe_key, data)], generation)
+        except Exception:
+            return
+        if issues:
+            lines = "\n".join(f"{kind}: {detail}" for kind, _, detail in issues)
+            messagebox.showwarning("Receipt sequence", f"Receipt {recipe_key} was saved, but:\n{lines}")
+
+    def _queue_email(self, data, pdf_path):
+        """Queue the receipt for the customer's email address (if any) and send in the background."""
+        try:
+            from mailer import MailQueue, deliver_async
+            if MailQueue().enqueue_receipt(data, pdf_path) is None:
+                return
+        except Exception:
+            return
+
+        def done(result, error):
+            if error is not None:
+                self.master.after(0, lambda: messagebox.showwarning("Email", f"Receipt queued but not sent yet: {error}"))
+
+        deliver_async(done)
+
 if __name__ == "__main__":
     root = tk.Tk()
     app = ReceiptGenGUI(root)
@@ -0,0 +1,131 @@
+"""Low resolution raster preview of a receipt, without going through a PDF file.
+
+The template (and signature) is rasterized once per DPI and cached. Overlay
+text is drawn with Pillow at the same positions create_receipt uses
+(receiptGen.overlay_items). When fields change, only the boxes of the
+changed slots are restored from the cached template and redrawn, along with
+any slot overlapping them.
+
+Rasterizing the template needs Pillow plus either a ReportLab renderPM
+backend (rlPyCairo) or pypdfium2. Without them PreviewUnavailable is raised.
+"""
+import io
+import threading
+from receiptGen import (TEMPLATE_SVG, HoniSig, PAGE_W, PAGE_H, overlay_items, signature_box)
+from tracing import span
+
+PREVIEW_DPI = 60
+# Pillow has no Helvetica; Arial is metric-compatible, Alef is the last resort
+FONT_FILES = {
+    "Helvetica": ("arial.ttf", "Arial.ttf", "LiberationSans-Regular.ttf", "DejaVuSans.ttf", "Alef-Regular.ttf"),
+    "Alef": ("Alef-Regular.ttf",),
+    "Alef-Bold": ("Alef-Bold.ttf",),
+}
+
+
+class PreviewUnavailable(Exception):
+    pass
+
+
+def _rasterize_template(dpi):
+    try:
+        from PIL import Image
+    except ImportError:
+        raise PreviewUnavailable("Pillow is required for the preview (pip install pillow)")
+    from svglib.svglib import svg2rlg
+    drawing = svg2rlg(TEMPLATE_SVG)
+    drawing.width, drawing.height = PAGE_W, PAGE_H
+    try:
+        from reportlab.graphics import renderPM
+        image = renderPM.drawToPIL(drawing, dpi=dpi)
+    except Exception:
+        image = None
+    if image is None:
+        try:
+            import pypdfium2
+        except ImportError:
+            raise PreviewUnavailable("Preview needs rlPyCairo or pypdfium2 to rasterize the template")
+        from reportlab.pdfgen import canvas
+        from reportlab.graphics import renderPDF
+        buf = io.BytesIO()
+        c = canvas.Canvas(buf, pagesize=(PAGE_W, PAGE_H))
+        renderPDF.draw(drawing, c, 0, 0)
+        c.showPage()
+        page = pypdfium2.PdfDocument(c.getpdfdata())[0]
+        image = page.render(scale=dpi / 72.0).to_pil()
+    image = image.convert("RGB")
+    scale = dpi / 72.0
+    x, y, w, h = signature_box()
+    sig = Image.open(HoniSig).convert("RGB").resize((max(1, round(w * scale)), max(1, round(h * scale))))
+    image.paste(sig, (round(x * scale), round((PAGE_H - y - h) * scale)))
+    return image
+
+
+class PreviewRenderer:
+    """Keeps the rasterized template and the last composed preview; thread safe."""
+
+    def __init__(self, dpi=PREVIEW_DPI):
+        self.dpi = dpi
+        self.scale = dpi / 72.0
+        self._base = None
+        self._composed = None
+        self._slots = {}   # slot -> (text, bbox) currently drawn on _composed
+        self._fonts = {}
+        self._lock = threading.Lock()
+
+    def _font(self, name, size_pt):
+        from PIL import ImageFont
+        key = (name, size_pt)
+        if key not in self._fonts:
+            font = None
+            for path in FONT_FILES.get(name, ("Alef-Regular.ttf",)):
+                try:
+                    font = ImageFont.truetype(path, max(1, round(size_pt * self.scale)))
+                    break
+                except OSError:
+                    continue
+            self._fonts[key] = font or ImageFont.load_default()
+        return self._fonts[key]
+
+    def render(self, data):
+        """Return a PIL image of the receipt for `data` (a dict of form fields)."""
+        from PIL import ImageDraw
+        with self._lock:
+            if self._base is None:
+                with span("preview.template"):
+                    self._base = _rasterize_template(self.dpi)
+                self._composed = self._base.copy()
+                self._slots = {}
+            with span("preview.overlay"):
+                items = {slot: (font, size, x, y, text) for slot, font, size, x, y, text in overlay_items(data)}
+                changed = [slot for slot, item in items.items() if self._slots.get(slot, (None,))[0] != item[4]]
+                if not changed:
+                    return self._composed.copy()
+                # Erase the old text of changed slots by restoring the template underneath
+                erased = []
+                for slot in changed:
+                    old = self._slots.pop(slot, None)
+                    if old and old[1]:
+                        self._composed.paste(self._base.crop(old[1]), old[1][:2])
+                        erased.append(old[1])
+                # Unchanged slots overlapping an erased box must be redrawn too
+                redraw = set(changed)
+                for slot, (text, bbox) in list(self._slots.items()):
+                    if bbox and any(_overlaps(bbox, e) for e in erased):
+                        redraw.add(slot)
+                draw = ImageDraw.Draw(self._composed)
+                for slot in redraw:
+                    font_name, size, x, y, text = items[slot]
+                    pos = (x * self.scale, (PAGE_H - y) * self.scale)
+                    font = self._font(font_name, size)
+                    bbox = None
+                    if text:
+                        draw.text(pos, text, font=font, fill="black", anchor="rs")
+                        l, t, r, b = draw.textbbox(pos, text, font=font, anchor="rs")
+                        bbox = (max(0, int(l) - 1), max(0, int(t) - 1), int(r) + 2, int(b) + 2)
+                    self._slots[slot] = (text, bbox)
+            return self._composed.copy()
+
+
+def _overlaps(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
@@ -3,9 +3,9 @@ import json
 import tkinter as tk
 from tkinter import messagebox, filedialog
 from receiptGen import create_receipt
-
-DB_DIR = r"G:\My Drive\Rentals\RentalsDB"
-HISTORY_FILE = os.path.join(DB_DIR, "history.json")
+from tracing import action, span
+from history_store import HISTORY_NAMES, HistoryCache
+from store import DB_DIR, HISTORY_FILE
 
 
 class RecreateReceiptApp(tk.Frame):
@@ -20,13 +20,16 @@ class RecreateReceiptApp(tk.Frame):
         # filters
         self.filter_customer = tk.StringVar(value="All")
         self.filter_date = tk.StringVar()
+        # Only the current and previous year are loaded; older years when a date filter asks for them
+        self.cache = HistoryCache(HISTORY_FILE)
         self.load_history()
         self.build_ui()
 
     def load_history(self):
         try:
-            with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-                self.history = json.load(f)
+            with span("history.load"):
+                self.cache.load_hot()
+            self.history = self.cache.entries()
         except Exception:
             self.history = {}
 
@@ -46,8 +49,10 @@ class RecreateReceiptApp(tk.Frame):
         self.date_entry.pack(side="left")
         tk.Button(filter_frame, text="Filter", command=self.apply_filters).pack(side="left", padx=4)
         tk.Button(filter_frame, text="Clear", command=self.clear_filters).pack(side="left")
+        self.years_label = tk.Label(left, anchor="w", justify="left", fg="gray")
+        self.years_label.pack(fill="x")
 
-        self.listbox = tk.Listbox(left, width=30)
+        self.listbox = tk.Listbox(left, width=30, selectmode=tk.EXTENDED)
         self.listbox.pack(fill="y", expand=True)
         self.listbox.bind("<<ListboxSelect>>", self.on_select)
 
@@ -55,6 +60,11 @@ class RecreateReceiptApp(tk.Frame):
         btn_frame.pack(fill="x")
         tk.Button(btn_frame, text="Reload", command=self.reload_history).pack(side="left", fill="x", expand=True)
         tk.Button(btn_frame, text="Regenerate", command=self.regenerate_selected).pack(side="left", fill="x", expand=True)
+        batch_frame = tk.Frame(left)
+        batch_frame.pack(fill="x")
+        tk.Button(batch_frame, text="Regenerate All Filtered", command=self.regenerate_filtered).pack(side="left", fill="x", expand=True)
+        self.force_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(batch_frame, text="Include up-to-date", variable=self.force_var).pack(side="left")
 
         # details
         self.details = tk.Text(right, wrap="word")
@@ -66,6 +76,17 @@ class RecreateReceiptApp(tk.Frame):
         # Populate listbox applying filters (keep index->key mapping)
         self.listbox.delete(0, tk.END)
         self.list_keys = []
+        fdate = self.filter_date.get().strip()
+        # A year in the date filter (e.g. '6/2021' or '2021') loads that year's partition if it is cold
+        import re
+        ym = re.search(r"(?:(?<!\d)(\d{4})|[/\-](\d{2}))\s*$", fdate)
+        if ym and self.cache.ensure_years([int(ym.group(1) or 2000 + int(ym.group(2)))]):
+            self.history = self.cache.entries()
+        years, loaded = self.cache.years()
+        if len(loaded) < len(years):
+            self.years_label.config(text=f"Showing {', '.join(loaded)}; type a year in the date filter for older receipts")
+        else:
+            self.years_label.config(text="")
         # build available customers for option menu
         customers = set()
         for key in sorted(self.history.keys()):
@@ -81,9 +102,7 @@ class RecreateReceiptApp(tk.Frame):
             menu.add_command(label=c, command=lambda v=c: self.filter_customer.set(v))
 
         fcust = self.filter_customer.get()
-        fdate = self.filter_date.get().strip()
         # detect month/year input like '6/2025', '06-25', '06/2025'
-        import re
         month_year_mode = False
         fy_month = None
         fy_year = None
@@ -137,6 +156,22 @@ class RecreateReceiptApp(tk.Frame):
         self.load_history()
         self.refresh_list()
 
+    def on_store_changed(self, names):
+        """Called by the store watcher with the DB file names that changed on disk; raises if a read fails."""
+        if not names & set(HISTORY_NAMES):
+            return
+        # Only partitions whose content changed are read again. A partially synced file
+        # raises here and the watcher delivers the change again.
+        if not self.cache.refresh():
+            return
+        self.history = self.cache.entries()
+        selected = self.selected_key
+        self.refresh_list()
+        if selected in self.list_keys:
+            idx = self.list_keys.index(selected)
+            self.listbox.selection_set(idx)
+            self.listbox.see(idx)
+
     def apply_filters(self):
         self.refresh_list()
 
@@ -168,6 +203,10 @@ class RecreateReceiptApp(tk.Frame):
         self.details.insert(tk.END, json.dumps(data, ensure_ascii=False, indent=2))
 
     def regenerate_selected(self):
+        sel = self.listbox.curselection()
+        if len(sel) > 1:
+            self.regenerate_keys([self.list_keys[i] for i in sel])
+            return
         if not self.selected_key:
             messagebox.showwarning("No selection", "Select a history entry to regenerate.")
             return
@@ -189,11 +228,56 @@ class RecreateReceiptApp(tk.Frame):
         if not base.endswith("_recreate"):
             save_path = f"{base}_recreate{ext or '.pdf'}"
         try:
-            create_receipt(data, save_path)
+            with action("regenerate_receipt"):
+                create_receipt(data, save_path)
             messagebox.showinfo("Success", f"Regenerated receipt saved to {save_path}")
         except Exception as e:
             messagebox.showerror("Error", f"Failed to regenerate receipt: {e}")
 
+    def regenerate_filtered(self):
+        if not self.list_keys:
+            messagebox.showwarning("No entries", "No history entries match the current filter.")
+            return
+        self.regenerate_keys(list(self.list_keys))
+
+    def regenerate_keys(self, keys):
+        """Regenerate several entries in the background into SaveFolder, skipping up-to-date PDFs."""
+        import threading
+        from batch_render import regenerate
+        records = []
+        for key in keys:
+            entry = self.history.get(key, {})
+            if isinstance(entry, dict) and entry:
+                cust = list(entry.keys())[0]
+                if isinstance(entry[cust], dict):
+                    records.append((key, cust, entry[cust]))
+        if not records:
+            messagebox.showwarning("No selection", "Select history entries to regenerate.")
+            return
+        if not messagebox.askyesno("Regenerate", f"Regenerate {len(records)} receipts into their save folders?"):
+            return
+        force = self.force_var.get()
+        self.details.delete(1.0, tk.END)
+        self.details.insert(tk.END, f"Regenerating {len(records)} receipts...\n")
+
+        def progress(done, total):
+            self.after(0, lambda: self.details.insert(tk.END, f"{done}/{total}\n"))
+
+        def work():
+            try:
+                with action("regenerate_batch"):
+                    rendered, skipped, failed = regenerate(records, force=force, progress=progress)
+            except Exception as e:
+                err = e
+                self.after(0, lambda: messagebox.showerror("Error", f"Batch regeneration failed: {err}"))
+                return
+            lines = [f"Rendered {rendered}, skipped {skipped} up-to-date, failed {len(failed)}."]
+            lines += [f"{key}: {msg}" for key, msg in failed]
+            summary = "\n".join(lines)
+            self.after(0, lambda: (self.details.insert(tk.END, summary + "\n"), messagebox.showinfo("Done", lines[0])))
+
+        threading.Thread(target=work, daemon=True).start()
+
 
 if __name__ == '__main__':
     root = tk.Tk()
@@ -0,0 +1,104 @@
+"""Local on-disk cache of rendered receipt PDFs, keyed by content hash.
+
+Entries are plain files named after their key. A hit refreshes the file's
+mtime, so eviction (oldest mtime first, once the folder grows past max_bytes)
+behaves as LRU. The cache lives on the local disk, never in the synced DB_DIR.
+"""
+import os
+import tempfile
+import threading
+from store import LOCAL_DIR
+
+DEFAULT_MAX_MB = 200
+
+
+def default_cache_dir():
+    return os.path.join(LOCAL_DIR, "render_cache")
+
+
+class RenderCache:
+    def __init__(self, folder=None, max_bytes=None):
+        self.folder = folder or default_cache_dir()
+        if max_bytes is None:
+            max_bytes = int(float(os.environ.get("RECEIPT_CACHE_MAX_MB", DEFAULT_MAX_MB)) * 1024 * 1024)
+        self.max_bytes = max_bytes
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + ".pdf")
+
+    def get(self, key):
+        """Return the cached bytes for `key`, or None."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                pdf = f.read()
+            os.utime(path)
+            return pdf
+        except OSError:
+            return None
+
+    def put(self, key, pdf):
+        os.makedirs(self.folder, exist_ok=True)
+        path = self._path(key)
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.folder)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(pdf)
+            os.replace(tmp, path)
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += len(pdf)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        entries = []
+        try:
+            with os.scandir(self.folder) as it:
+                for e in it:
+                    if e.name.endswith(".pdf"):
+                        try:
+                            st = e.stat()
+                        except OSError:
+                            continue
+                        entries.append((st.st_mtime, st.st_size, e.path))
+        except OSError:
+            pass
+        return entries
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        # Drop least recently used entries until 90% of the limit is free again
+        entries = sorted(self._entries())
+        size = sum(s for _, s, _ in entries)
+        target = self.max_bytes * 0.9
+        for _, s, path in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+                size -= s
+            except OSError:
+                pass
+        self._size = size
+
+    def clear(self):
+        with self._lock:
+            for _, _, path in self._entries():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._size = 0
@@ -0,0 +1,355 @@
+"""Check that issued receipt numbers form an unbroken, date-ordered sequence.
+
+One streaming pass over the history sets a bit per issued number in a
+bytearray and stores each number's date (as a day ordinal) in an array
+indexed by number. Gaps, duplicates and date inversions are then found in
+linear time over the number range. After that, add() checks a newly
+appended receipt in O(1) (amortized) against its neighbours.
+
+Reported issues, as (kind, number, detail) tuples:
+  gap            number never issued between the first and last receipt
+  duplicate      two history entries carry the same recipeNum
+  mismatch       history key and recipeNum disagree (e.g. key 00041, recipeNum 42)
+  invalid        recipeNum (and key) not a number, or at least MAX_NUMBER (a typo;
+                 the arrays are indexed by number, so such numbers are not indexed)
+  date           receipt dated earlier than a lower-numbered receipt
+  no_date        receipt without a parseable Date
+  counter        receipt_number.txt would reissue an existing number
+
+    python sequence_audit.py [--history path] [--counter path]
+"""
+import threading
+from array import array
+import tkinter as tk
+from tkinter import ttk, messagebox
+from store import HISTORY_FILE, RECEIPT_NUMBER_FILE, iter_history, parse_date
+from tracing import span
+
+ISSUE_KINDS = ("gap", "duplicate", "mismatch", "invalid", "date", "no_date", "counter")
+# Receipt numbers have five digits; this leaves plenty of room and caps the arrays at a few MB
+MAX_NUMBER = 1000000
+
+
+def _number(value):
+    text = str(value or "").strip()
+    return int(text) if text.isdigit() else None
+
+
+class SequenceAuditor:
+    def __init__(self):
+        self.bits = bytearray()
+        # Date ordinal per receipt number; 0 = no date (or not issued)
+        self.dates = array("I")
+        self.low = None
+        self.high = None
+        self.count = 0
+        # Only the exceptions are kept per record
+        self.record_issues = []
+        # Generation of the history file this index reflects (see check_appended)
+        self.generation = None
+
+    def _grow(self, num):
+        if num >= len(self.dates):
+            size = max(num + 1, 2 * len(self.dates), 1024)
+            self.dates.extend([0] * (size - len(self.dates)))
+            self.bits.extend(bytes((size + 7) // 8 - len(self.bits)))
+
+    def has(self, num):
+        return num < len(self.dates) and bool(self.bits[num >> 3] & (1 << (num & 7)))
+
+    def _previous_issued(self, num):
+        """Closest lower issued number, or None. Walks back over gaps, skipping empty bytes."""
+        n = num - 1
+        while n >= 0:
+            byte = self.bits[n >> 3]
+            if byte == 0:
+                n = (n & ~7) - 1
+                continue
+            if byte & (1 << (n & 7)):
+                return n
+            n -= 1
+        return None
+
+    def _next_issued(self, num):
+        n = num + 1
+        limit = len(self.dates)
+        while n < limit:
+            byte = self.bits[n >> 3]
+            if byte == 0:
+                n = (n | 7) + 1
+                continue
+            if byte & (1 << (n & 7)):
+                return n
+            n += 1
+        return None
+
+    def _mark(self, key, data):
+        """Record one receipt; returns (num, issues found for the record itself)."""
+        issues = []
+        num = _number(data.get("recipeNum"))
+        key_num = _number(key)
+        if num is None:
+            num = key_num
+            if num is None:
+                issues.append(("invalid", None, f"key {key!r}, recipeNum {data.get('recipeNum')!r}"))
+                return None, issues
+        if num >= MAX_NUMBER:
+            issues.append(("invalid", num, f"entry {key}: receipt number {num} is out of range"))
+            return None, issues
+        if key_num is not None and key_num != num:
+            issues.append(("mismatch", num, f"history key {key} but recipeNum {data.get('recipeNum')}"))
+        elif key_num is None:
+            issues.append(("mismatch", num, f"history key {key!r} is not a receipt number"))
+        dt = parse_date(data.get("Date", ""))
+        if dt is None:
+            issues.append(("no_date", num, f"Date {data.get('Date', '')!r}"))
+        self._grow(num)
+        if self.has(num):
+            issues.append(("duplicate", num, f"entry {key} repeats a number already in history"))
+            return num, issues
+        self.bits[num >> 3] |= 1 << (num & 7)
+        self.dates[num] = dt.toordinal() if dt else 0
+        self.count += 1
+        self.low = num if self.low is None else min(self.low, num)
+        self.high = num if self.high is None else max(self.high, num)
+        return num, issues
+
+    def build(self, records):
+        """One pass over (key, customer, data) records."""
+        for key, _, data in records:
+            self.record_issues.extend(self._mark(key, data)[1])
+        return self
+
+    def add(self, key, data):
+        """Check a newly appended receipt against what is already indexed; returns its issues."""
+        previous_high = self.high
+        num, issues = self._mark(key, data)
+        if num is None or any(kind == "duplicate" for kind, _, _ in issues):
+            self.record_issues.extend(issues)
+            return issues
+        if previous_high is not None and num > previous_high + 1:
+            first, last = previous_high + 1, num - 1
+            issues.append(("gap", first, (f"{first:05d}" if first == last else f"{first:05d}-{last:05d}") + " skipped"))
+        ordinal = self.dates[num]
+        if ordinal:
+            prev = self._previous_issued(num)
+            while prev is not None and not self.dates[prev]:
+                prev = self._previous_issued(prev)
+            if prev is not None and self.dates[prev] > ordinal:
+                issues.append(("date", num, f"dated before receipt {prev:05d}"))
+            nxt = self._next_issued(num)
+            while nxt is not None and not self.dates[nxt]:
+                nxt = self._next_issued(nxt)
+            if nxt is not None and self.dates[nxt] < ordinal:
+                issues.append(("date", nxt, f"dated before receipt {num:05d}"))
+        # Gaps and date order are recomputed from the arrays by issues()
+        self.record_issues.extend(i for i in issues if i[0] not in ("gap", "date"))
+        return issues
+
+    def gaps(self):
+        """[(first, last)] runs of missing numbers between the lowest and highest issued."""
+        runs = []
+        if self.low is None:
+            return runs
+        n = self.low
+        start = None
+        while n <= self.high:
+            byte = self.bits[n >> 3]
+            if n & 7 == 0 and byte == (0xFF if start is None else 0):
+                # The whole byte continues the current run of issued (or missing) numbers
+                n += 8
+                continue
+            issued = byte & (1 << (n & 7))
+            if not issued and start is None:
+                start = n
+            elif issued and start is not None:
+                runs.append((start, n - 1))
+                start = None
+            n += 1
+        return runs
+
+    def date_inversions(self):
+        """[(number, later_dated_lower_number)] where a receipt is dated before an earlier number."""
+        inversions = []
+        if self.low is None:
+            return inversions
+        latest = 0
+        latest_num = None
+        dates = self.dates
+        for n in range(self.low, self.high + 1):
+            ordinal = dates[n]
+            if not ordinal:
+                continue
+            if ordinal < latest:
+                inversions.append((n, latest_num))
+            else:
+                latest, latest_num = ordinal, n
+        return inversions
+
+    def issues(self, counter=None):
+        """Every issue as (kind, number, detail), in number order within each kind."""
+        found = []
+        for first, last in self.gaps():
+            found.append(("gap", first, f"{first:05d}" if first == last else f"{first:05d}-{last:05d} ({last - first + 1} numbers)"))
+        for num, later in self.date_inversions():
+            found.append(("date", num, f"dated before receipt {later:05d}"))
+        found.extend(i for i in self.record_issues if i[0] != "date")
+        if counter is not None and self.high is not None and counter <= self.high:
+            found.append(("counter", counter, f"next number {counter:05d} is not above the last issued {self.high:05d}"))
+        order = {kind: i for i, kind in enumerate(ISSUE_KINDS)}
+        found.sort(key=lambda i: (order[i[0]], -1 if i[1] is None else i[1]))
+        return found
+
+    def issues_for(self, numbers):
+        """The issues the receipts `numbers` bring, as add() reports them, from a full index."""
+        found = []
+        for first, last in self.gaps():
+            # A gap belongs to the receipt right after it
+            if last + 1 in numbers:
+                found.append(("gap", first, (f"{first:05d}" if first == last else f"{first:05d}-{last:05d}") + " skipped"))
+        for num, later in self.date_inversions():
+            if num in numbers or later in numbers:
+                found.append(("date", num, f"dated before receipt {later:05d}"))
+        found.extend(i for i in self.record_issues if i[1] in numbers)
+        return found
+
+
+def read_counter(path=RECEIPT_NUMBER_FILE):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return _number(f.read())
+    except OSError:
+        return None
+
+
+def audit(history_path=HISTORY_FILE):
+    """Build an auditor from a history file (streamed; memory is the bitmap and date array)."""
+    with span("audit.build"):
+        return SequenceAuditor().build(iter_history(history_path))
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def check_appended(history_path, records, generation):
+    """
+    Issues introduced by receipts [(key, data)] that one write just appended to `history_path`.
+
+    `generation` is that write's versioned-store generation. If the index saw the
+    previous generation only the new receipts are checked; otherwise (first call, or
+    another machine wrote in between) it is rebuilt from the file, which already has them.
+    """
+    with _shared_lock:
+        auditor = _shared.get(history_path)
+        if auditor is not None and auditor.generation == generation - 1:
+            issues = []
+            for key, data in records:
+                issues.extend(auditor.add(key, data))
+        else:
+            auditor = _shared[history_path] = audit(history_path)
+            issues = auditor.issues_for(set(_number(data.get("recipeNum")) or _number(key) for key, data in records))
+        auditor.generation = generation
+        return issues
+
+
+class SequenceAuditApp(tk.Frame):
+    def __init__(self, master, history_path=HISTORY_FILE, counter_path=RECEIPT_NUMBER_FILE):
+        super().__init__(master)
+        self.master = master
+        self.history_path = history_path
+        self.counter_path = counter_path
+        self.pack(fill="both", expand=True, padx=10, pady=10)
+        self.build_ui()
+
+    def build_ui(self):
+        row = tk.Frame(self)
+        row.pack(fill="x", pady=6)
+        tk.Button(row, text="Audit Receipt Sequence", command=self.run_audit).pack(side="left")
+        tk.Button(row, text="Check PDF Archive", command=self.run_archive_scan).pack(side="left", padx=(6, 0))
+        self.summary = tk.Label(row, anchor="w")
+        self.summary.pack(side="left", padx=(8, 0))
+        columns = ("kind", "number", "detail")
+        self.tree = ttk.Treeview(self, columns=columns, show="headings")
+        for col, width in zip(columns, (90, 80, 500)):
+            self.tree.heading(col, text=col)
+            self.tree.column(col, width=width)
+        self.tree.pack(fill="both", expand=True, pady=(8, 0))
+
+    def run_audit(self):
+        self.summary.config(text="Auditing...")
+
+        def work():
+            try:
+                auditor = audit(self.history_path)
+                issues = auditor.issues(read_counter(self.counter_path))
+            except Exception as e:
+                err = e
+                self.after(0, lambda: messagebox.showerror("Audit failed", str(err)))
+                return
+            self.after(0, lambda: self.show(auditor, issues))
+
+        threading.Thread(target=work, daemon=True).start()
+
+    def run_archive_scan(self):
+        """Compare history with the saved receipt PDFs (see archive_scan)."""
+        self.summary.config(text="Scanning saved PDFs...")
+
+        def progress(done, total):
+            self.after(0, lambda: self.summary.config(text=f"Reading PDFs {done}/{total}..."))
+
+        def work():
+            try:
+                from archive_scan import compare, scan
+                from store import load_history
+                results, opened = scan(progress=progress)
+                issues = compare(results, load_history(self.history_path))
+            except Exception as e:
+                err = e
+                self.after(0, lambda: messagebox.showerror("Archive scan failed", str(err)))
+                return
+            self.after(0, lambda: self.show_archive(results, opened, issues))
+
+        threading.Thread(target=work, daemon=True).start()
+
+    def show_archive(self, results, opened, issues):
+        self.tree.delete(*self.tree.get_children())
+        for kind, num, detail, path in issues:
+            self.tree.insert("", tk.END, values=(kind, "" if num is None else f"{num:05d}",
+                                                 f"{detail}  {path}" if path else detail))
+        self.summary.config(text=f"{len(results)} receipt PDFs ({opened} read): "
+                                 + (f"{len(issues)} issues" if issues else "history matches the archive"))
+
+    def show(self, auditor, issues):
+        self.tree.delete(*self.tree.get_children())
+        for kind, num, detail in issues:
+            self.tree.insert("", tk.END, values=(kind, "" if num is None else f"{num:05d}", detail))
+        if auditor.low is None:
+            self.summary.config(text="No receipts in history")
+            return
+        self.summary.config(text=f"{auditor.count} receipts, {auditor.low:05d}-{auditor.high:05d}: "
+                                 + (f"{len(issues)} issues" if issues else "sequence is complete"))
+
+    def on_store_changed(self, names):
+        from history_store import HISTORY_NAMES
+        if names & set(HISTORY_NAMES) and self.tree.get_children():
+            self.run_audit()
+
+
+if __name__ == "__main__":
+    import sys
+    import argparse
+    parser = argparse.ArgumentParser(description="Audit the receipt number sequence")
+    parser.add_argument("--history", default=HISTORY_FILE)
+    parser.add_argument("--counter", default=RECEIPT_NUMBER_FILE)
+    args = parser.parse_args()
+    auditor = audit(args.history)
+    issues = auditor.issues(read_counter(args.counter))
+    if auditor.low is None:
+        print("No receipts in history")
+    else:
+        print(f"{auditor.count} receipts, {auditor.low:05d}-{auditor.high:05d}")
+    for kind, num, detail in issues:
+        print(f"{kind:<10} {'' if num is None else f'{num:05d}':>6}  {detail}")
+    print(f"{len(issues)} issues" if issues else "OK: sequence is complete")
+    sys.exit(1 if issues else 0)
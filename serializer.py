@@ -0,0 +1,183 @@
+"""Encoding of the JSON store files (history, customers).
+
+Formats:
+  json          the original pretty JSON (indent=2); kept for exports and hand editing
+  json-compact  JSON without indentation, encoded with orjson when installed (default)
+  msgpack       MessagePack, when the msgpack package is installed
+Any of them can also be gzip-compressed.
+
+Readers never need to know which one was used: loads() detects gzip by its
+magic bytes and msgpack by its leading map marker. Anything else is parsed
+as JSON. The file names stay the same (history.json, ...). Compact JSON is
+still plain JSON, so older copies of the tools on other machines can read it.
+msgpack and gzip need every machine to be on this version.
+
+RECEIPT_STORE_FORMAT picks the write format and RECEIPT_STORE_GZIP=1
+turns on compression.
+
+    python serializer.py convert <file> [--format json|json-compact|msgpack] [--gzip]
+    python serializer.py export <file> <out.json>       pretty JSON copy of any store file
+    python serializer.py bench [--counts 10000,100000]
+"""
+import os
+import io
+import gzip
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+FORMATS = ("json", "json-compact", "msgpack")
+STORE_FORMAT = os.environ.get("RECEIPT_STORE_FORMAT", "json-compact")
+STORE_GZIP = os.environ.get("RECEIPT_STORE_GZIP", "0") == "1"
+# Speed matters more than the last few percent of size for files rewritten on every receipt
+GZIP_LEVEL = 6
+_GZIP_MAGIC = b"\x1f\x8b"
+
+
+def available_formats():
+    return [f for f in FORMATS if f != "msgpack" or msgpack is not None]
+
+
+def dumps(obj, fmt=None, compress=None):
+    """Encode `obj` to bytes in `fmt` (default STORE_FORMAT), gzip-compressed if `compress`."""
+    fmt = fmt or STORE_FORMAT
+    compress = STORE_GZIP if compress is None else compress
+    if fmt == "json":
+        if orjson is not None:
+            raw = orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+        else:
+            raw = json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+    elif fmt == "json-compact":
+        if orjson is not None:
+            raw = orjson.dumps(obj)
+        else:
+            raw = json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    elif fmt == "msgpack":
+        if msgpack is None:
+            raise ValueError("The msgpack format needs the msgpack package (pip install msgpack)")
+        raw = msgpack.packb(obj, use_bin_type=True)
+    else:
+        raise ValueError(f"Unknown store format {fmt!r}; expected one of {', '.join(FORMATS)}")
+    if compress:
+        # mtime=0 keeps the output identical for identical data
+        raw = gzip.compress(raw, compresslevel=GZIP_LEVEL, mtime=0)
+    return raw
+
+
+def detect(raw):
+    """Return (format, compressed) for encoded bytes; the JSON formats are reported as 'json'."""
+    compressed = raw[:2] == _GZIP_MAGIC
+    if compressed:
+        with gzip.GzipFile(fileobj=io.BytesIO(raw)) as f:
+            head = f.read(1)
+    else:
+        head = raw[:1]
+    # fixmap (0x80-0x8f), map16 (0xde) and map32 (0xdf) cannot start a JSON document
+    if head and (0x80 <= head[0] <= 0x8f or head[0] in (0xde, 0xdf)):
+        return "msgpack", compressed
+    return "json", compressed
+
+
+def loads(raw):
+    """Decode bytes written by dumps() in any format, or a plain JSON file."""
+    fmt, compressed = detect(raw)
+    if compressed:
+        raw = gzip.decompress(raw)
+    if fmt == "msgpack":
+        if msgpack is None:
+            raise ValueError("This file is in msgpack format; install the msgpack package to read it")
+        return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+    if raw[:3] == b"\xef\xbb\xbf":
+        raw = raw[3:]
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw.decode("utf-8"))
+
+
+def is_plain_json(path):
+    """True if `path` is uncompressed JSON (what the streaming history reader can walk)."""
+    with open(path, "rb") as f:
+        head = f.read(2)
+    return head != _GZIP_MAGIC and detect(head) == ("json", False)
+
+
+def bench(counts=(10000, 100000), runs=3):
+    """Time save/load of a synthetic history in every available format."""
+    import time
+    import random
+    import tempfile
+    from store import write_bytes_atomic
+    with open("sample_data.json", "r", encoding="utf-8") as f:
+        sample = json.load(f)
+    folder = tempfile.mkdtemp(prefix="serializer_bench_")
+    print(f"orjson: {'yes' if orjson else 'no'}, msgpack: {'yes' if msgpack else 'no'}")
+    for count in counts:
+        history = {}
+        for i in range(count):
+            rec = dict(sample)
+            rec.update(recipeNum=f"{i:05d}", payment=str(random.randint(500, 9000)),
+                       Date=f"{random.randint(1, 28):02d}/{random.randint(1, 12):02d}/{random.choice((2023, 2024, 2025))}")
+            history[f"{i:05d}"] = {f"customer {i % 300}": rec}
+        print(f"\n{count} records")
+        print(f"{'format':<20} {'size KB':>10} {'save ms':>9} {'load ms':>9}")
+        path = os.path.join(folder, "history.json")
+        # The baseline is what the store did before: stdlib json, indent=2
+        start = time.perf_counter()
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(history, f, ensure_ascii=False, indent=2)
+        save = time.perf_counter() - start
+        start = time.perf_counter()
+        with open(path, "r", encoding="utf-8") as f:
+            json.load(f)
+        load = time.perf_counter() - start
+        print(f"{'stdlib json (old)':<20} {os.path.getsize(path) / 1024:>10.0f} {save * 1000:>9.0f} {load * 1000:>9.0f}")
+        for fmt in available_formats():
+            for compress in (False, True):
+                saves, loads_ = [], []
+                for _ in range(runs):
+                    start = time.perf_counter()
+                    write_bytes_atomic(path, dumps(history, fmt, compress))
+                    saves.append(time.perf_counter() - start)
+                    start = time.perf_counter()
+                    with open(path, "rb") as f:
+                        loaded = loads(f.read())
+                    loads_.append(time.perf_counter() - start)
+                    assert loaded == history
+                name = fmt + (" +gzip" if compress else "")
+                print(f"{name:<20} {os.path.getsize(path) / 1024:>10.0f} {min(saves) * 1000:>9.0f} {min(loads_) * 1000:>9.0f}")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Convert, export or benchmark the store file formats")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_convert = sub.add_parser("convert", help="rewrite a store file in another format")
+    p_convert.add_argument("path")
+    p_convert.add_argument("--format", choices=FORMATS, default=STORE_FORMAT)
+    p_convert.add_argument("--gzip", action="store_true")
+    p_export = sub.add_parser("export", help="write a pretty JSON copy of a store file")
+    p_export.add_argument("path")
+    p_export.add_argument("out")
+    p_bench = sub.add_parser("bench", help="compare formats on synthetic histories")
+    p_bench.add_argument("--counts", default="10000,100000")
+    args = parser.parse_args()
+    from store import write_bytes_atomic
+    if args.command == "bench":
+        bench(tuple(int(c) for c in args.counts.split(",")))
+    else:
+        with open(args.path, "rb") as f:
+            data = loads(f.read())
+        if args.command == "convert":
+            write_bytes_atomic(args.path, dumps(data, args.format, args.gzip))
+            print(f"{args.path}: {args.format}{' +gzip' if args.gzip else ''}, {os.path.getsize(args.path)} bytes")
+        else:
+            write_bytes_atomic(args.out, dumps(data, "json", False))
+            print(f"Wrote {args.out}")
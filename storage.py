@@ -0,0 +1,406 @@
+"""Where the RentalsDB files live, and the optional local cache in front of them.
+
+SYNCED_DIR is the Drive-synced folder shared by every machine. It comes from
+LOCAL_DIR/storage.json ({"db_dir": "...", "local_cache": true}) or the
+RECEIPT_DB_DIR and RECEIPT_LOCAL_CACHE=1 environment variables, and
+defaults to the Drive folder the tools always used.
+
+With the local cache off, DB_DIR is SYNCED_DIR and nothing changes. With it
+on, DB_DIR is a mirror in LOCAL_DIR/db: every tool reads it and writes it at
+local disk speed, and WriteBehind keeps it in step with SYNCED_DIR in the
+background:
+  - A write is copied once however often the file was rewritten meanwhile.
+    Files go in the order they were last written, so a history partition
+    reaches Drive before the manifest that lists it.
+  - LOCAL_DIR/db_sync_state.json records each file's signature on both sides
+    as of the last copy. A write that had not reached Drive when the program
+    stopped is found and copied by the next sync.
+  - Files changed on Drive by other machines are pulled into the mirror,
+    where the store watcher picks them up as before.
+  - A store file changed on both sides is merged per key against the last
+    synced copy, as versioned_store does. A record edited on both sides
+    keeps Drive's version; ours is saved in <name>.conflict-<timestamp> and
+    reported, and every other key from both sides is kept. Any other file
+    keeps Drive's version; the local one is set aside the same way.
+
+The receipt counter is never mirrored: COUNTER_FILE is always in SYNCED_DIR,
+and issuing a receipt (moving the counter and appending to history) happens
+under its lock. A lock in the mirror would only exclude other processes on
+the same machine, so two machines could issue the same number.
+
+pending() names the local writes that have not reached Drive yet; the GUI
+shows them in its status bar.
+
+    python storage.py status|sync
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import datetime
+import threading
+
+DEFAULT_DB_DIR = r"G:\My Drive\Rentals\RentalsDB"
+# Per-machine data that must not go through Drive sync (caches, recent picks)
+LOCAL_DIR = os.path.join(os.environ.get("LOCALAPPDATA") or os.path.join(os.path.expanduser("~"), ".cache"), "ReceiptTools")
+CONFIG_FILE = os.path.join(LOCAL_DIR, "storage.json")
+MIRROR_DIR = os.path.join(LOCAL_DIR, "db")
+SYNC_STATE_FILE = os.path.join(LOCAL_DIR, "db_sync_state.json")
+# Last synced copy of each mergeable store file, the base of a three-way merge
+SYNC_BASE_DIR = os.path.join(LOCAL_DIR, "db_sync_base")
+# Subfolders of the DB folder that are synced (besides its top level)
+SYNC_SUBDIRS = ("history",)
+# Seconds between checks of Drive for other machines' changes
+POLL_INTERVAL = 2.0
+# Wait this long after a write before copying, so a burst of writes is copied once
+COALESCE_DELAY = 0.3
+MERGEABLE = ("customers_data.json", "history.json", "history_manifest.json", "bank_issued.json")
+COUNTER_NAME = "receipt_number.txt"
+
+
+def load_config(path=CONFIG_FILE):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+    except (OSError, ValueError):
+        config = {}
+    if os.environ.get("RECEIPT_DB_DIR"):
+        config["db_dir"] = os.environ["RECEIPT_DB_DIR"]
+    if os.environ.get("RECEIPT_LOCAL_CACHE"):
+        config["local_cache"] = os.environ["RECEIPT_LOCAL_CACHE"] == "1"
+    return config
+
+
+_config = load_config()
+SYNCED_DIR = _config.get("db_dir") or DEFAULT_DB_DIR
+LOCAL_CACHE = bool(_config.get("local_cache"))
+DB_DIR = MIRROR_DIR if LOCAL_CACHE else SYNCED_DIR
+# Shared by every machine, so its lock is too; issuing a receipt needs the synced folder
+COUNTER_FILE = os.path.join(SYNCED_DIR, COUNTER_NAME)
+
+
+def _signature(path):
+    try:
+        st = os.stat(path)
+        return [st.st_mtime_ns, st.st_size]
+    except OSError:
+        return None
+
+
+def _synced(rel):
+    name = os.path.basename(rel)
+    if rel == COUNTER_NAME:
+        # Lives only in SYNCED_DIR (see COUNTER_FILE)
+        return False
+    return not (name.endswith(".lock") or ".lock." in name or name.endswith(".tmp") or ".conflict-" in name)
+
+
+def _listing(folder):
+    """{relative path: signature} of the synced files in `folder`."""
+    files = {}
+    for sub in ("",) + SYNC_SUBDIRS:
+        try:
+            with os.scandir(os.path.join(folder, sub)) as it:
+                for entry in it:
+                    rel = os.path.join(sub, entry.name) if sub else entry.name
+                    if entry.is_file() and _synced(rel):
+                        st = entry.stat()
+                        files[rel] = [st.st_mtime_ns, st.st_size]
+        except FileNotFoundError:
+            continue
+    return files
+
+
+def _mergeable(rel):
+    if rel.endswith(".meta") or ".bak." in rel:
+        return False
+    return rel in MERGEABLE or any(rel.startswith(sub + os.sep) for sub in SYNC_SUBDIRS)
+
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _copy(src, dst):
+    """Copy src over dst atomically; returns (bytes copied, dst signature)."""
+    from store import write_bytes_atomic
+    raw = _read(src)
+    write_bytes_atomic(dst, raw, notify=False)
+    return raw, _signature(dst)
+
+
+def _conflict_path(path):
+    return f"{path}.conflict-{datetime.datetime.now().strftime('%Y%m%dT%H%M%S')}"
+
+
+class WriteBehind:
+    """Keeps `local` (the mirror every tool uses) and `remote` (the Drive folder) in step."""
+
+    def __init__(self, local=MIRROR_DIR, remote=SYNCED_DIR, state_path=SYNC_STATE_FILE, base_dir=SYNC_BASE_DIR):
+        self.local = local
+        self.remote = remote
+        self.state_path = state_path
+        self.base_dir = base_dir
+        self.state = self._load_state()
+        # Local writes not on Drive yet, in the order they will be copied
+        self.pending_names = []
+        self.conflicts = []
+        self.last_error = None
+        self.last_sync = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._cycle_lock = threading.Lock()
+        self._thread = None
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        # Entries for files no longer synced (the counter mirrored by older versions) would
+        # otherwise look like local deletions and be deleted on Drive
+        return {rel: entry for rel, entry in state.items() if _synced(rel)}
+
+    def _save_state(self):
+        from store import write_json_atomic
+        write_json_atomic(self.state_path, self.state, indent=None)
+
+    def _record(self, rel, raw):
+        self.state[rel] = {"local": _signature(os.path.join(self.local, rel)),
+                           "remote": _signature(os.path.join(self.remote, rel)),
+                           "sha256": hashlib.sha256(raw).hexdigest()}
+        if _mergeable(rel):
+            from store import write_bytes_atomic
+            write_bytes_atomic(os.path.join(self.base_dir, rel), raw, notify=False)
+
+    def _forget(self, rel):
+        self.state.pop(rel, None)
+        try:
+            os.remove(os.path.join(self.base_dir, rel))
+        except OSError:
+            pass
+
+    def sync_once(self):
+        """Push local writes and pull Drive changes once. Returns the number of files copied."""
+        from versioned_store import FileLock
+        from tracing import span
+        with self._cycle_lock, FileLock(self.state_path), span("storage.sync"):
+            self.state = self._load_state()
+            try:
+                copied = self._sync()
+                self.last_error = None
+                self.last_sync = time.time()
+            except OSError as e:
+                # Drive not mounted or offline: everything stays pending and is retried
+                self.last_error = str(e)
+                copied = 0
+            finally:
+                self._save_state()
+            self.pending_names = self._pending(_listing(self.local))
+            return copied
+
+    def _pending(self, local_files):
+        changed = [rel for rel, sig in local_files.items() if (self.state.get(rel) or {}).get("local") != sig]
+        deleted = [rel for rel in self.state if rel not in local_files]
+        return sorted(changed, key=lambda rel: local_files[rel][0]) + sorted(deleted)
+
+    def _sync(self):
+        os.makedirs(self.local, exist_ok=True)
+        if not os.path.isdir(self.remote):
+            raise FileNotFoundError(f"Synced folder {self.remote} is not available")
+        local_files = _listing(self.local)
+        remote_files = _listing(self.remote)
+        copied = 0
+        # Local writes first, oldest write first; deletions after
+        for rel in self._pending(local_files):
+            entry = self.state.get(rel) or {}
+            remote_changed = remote_files.get(rel) != entry.get("remote")
+            local_path = os.path.join(self.local, rel)
+            remote_path = os.path.join(self.remote, rel)
+            if rel not in local_files:
+                # Deleted here (e.g. a year partition that was compressed). If Drive has a
+                # newer version it is pulled back below: another machine's edit wins.
+                if rel in remote_files and not remote_changed:
+                    os.remove(remote_path)
+                    del remote_files[rel]
+                self._forget(rel)
+                continue
+            if rel in remote_files and remote_changed:
+                # Also the first sync of a file that already exists on both sides
+                self._resolve(rel, local_path, remote_path)
+            raw, _ = _copy(local_path, remote_path)
+            self._record(rel, raw)
+            remote_files[rel] = self.state[rel]["remote"]
+            local_files[rel] = self.state[rel]["local"]
+            copied += 1
+        # Then whatever other machines changed
+        for rel, sig in sorted(remote_files.items(), key=lambda item: item[1][0]):
+            entry = self.state.get(rel)
+            if entry and entry.get("remote") == sig:
+                continue
+            raw, _ = _copy(os.path.join(self.remote, rel), os.path.join(self.local, rel))
+            self._record(rel, raw)
+            copied += 1
+        for rel in [rel for rel, entry in self.state.items() if rel not in remote_files and entry.get("local") == local_files.get(rel)]:
+            # Deleted on Drive and unchanged here
+            try:
+                os.remove(os.path.join(self.local, rel))
+            except OSError:
+                pass
+            self._forget(rel)
+        return copied
+
+    def _resolve(self, rel, local_path, remote_path):
+        """Both sides changed `rel` since the last sync: leave the merged result in the local file."""
+        ours, theirs = _read(local_path), _read(remote_path)
+        if ours == theirs:
+            return
+        if rel.endswith(".meta"):
+            # Rewritten with the data file it describes; ours matches our (merged) data
+            return
+        if _mergeable(rel):
+            try:
+                self._merge_store(rel, local_path, ours, theirs)
+                return
+            except Exception as e:
+                reason = str(e)
+        else:
+            reason = "changed on both sides"
+        # Keep Drive's version and set ours aside where the user can see it
+        aside = _conflict_path(local_path)
+        shutil.copy2(local_path, aside)
+        shutil.copy2(remote_path, local_path)
+        self.conflicts.append((rel, aside, reason))
+
+    def _merge_store(self, rel, local_path, ours, theirs):
+        import serializer
+        from versioned_store import Snapshot, merge, read_generation, read_versioned, write_versioned
+        try:
+            base = serializer.loads(_read(os.path.join(self.base_dir, rel)))
+        except FileNotFoundError:
+            base = {}
+        ours_data, theirs_data = serializer.loads(ours), serializer.loads(theirs)
+        conflicts = ()
+        if os.path.basename(rel) == "history_manifest.json":
+            merged = self._merge_manifest(ours_data, theirs_data)
+        else:
+            # A key edited on both sides gets Drive's version; all other keys are kept
+            merged, conflicts = merge(base, ours_data, theirs_data)
+        current = read_versioned(local_path)
+        remote_generation = read_generation(os.path.join(self.remote, rel))
+        # Newer than both sides, so either side's readers see it as a new version
+        base_snap = Snapshot(current.data, max(current.generation, remote_generation), current.sha256)
+        write_versioned(local_path, base_snap, merged, compress=serializer.detect(ours)[1])
+        if conflicts:
+            # Only the clashing records are set aside, with our version of each (None if we deleted it)
+            from store import write_json_atomic
+            aside = _conflict_path(local_path)
+            write_json_atomic(aside, {key: ours_data.get(key) for key in sorted(conflicts)})
+            self.conflicts.append((rel, aside, f"edited on both sides: {', '.join(sorted(conflicts))}"))
+
+    def _merge_manifest(self, ours, theirs):
+        """Union of both sides' partitions, described from the (already merged) local files."""
+        from versioned_store import read_versioned
+        from history_store import key_index
+        merged = dict(theirs)
+        merged.update({k: v for k, v in ours.items() if k != "partitions"})
+        partitions = dict(theirs.get("partitions", {}))
+        partitions.update(ours.get("partitions", {}))
+        folder = os.path.join(self.local, "history")
+        for info in partitions.values():
+            path = os.path.join(folder, info["file"])
+            if os.path.exists(path):
+                # Partitions only on Drive keep its description; they are pulled after this
+                snap = read_versioned(path)
+                info.update(count=len(snap.data), sha256=snap.sha256, **key_index(snap.data))
+        merged["partitions"] = partitions
+        return merged
+
+    def notify(self):
+        """A file in the mirror was written; copy it after a short pause."""
+        self._wake.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            woken = self._wake.wait(POLL_INTERVAL if self.last_error is None else 4 * POLL_INTERVAL)
+            if woken:
+                # Let a burst of writes (data file, .meta, manifest) finish first
+                time.sleep(COALESCE_DELAY)
+                self._wake.clear()
+            if self._stop.is_set():
+                break
+            try:
+                self.sync_once()
+            except Exception as e:
+                self.last_error = str(e)
+
+    def start(self):
+        """Sync once in the foreground (so the mirror is current), then keep syncing in the background."""
+        self.sync_once()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, flush=True):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        if flush:
+            self.sync_once()
+        return self.pending_names
+
+    def status_text(self):
+        if self.last_error:
+            return f"Drive not reachable ({self.last_error}); {len(self.pending_names)} changes only on this computer"
+        if self.pending_names:
+            shown = ", ".join(self.pending_names[:3]) + (" ..." if len(self.pending_names) > 3 else "")
+            return f"{len(self.pending_names)} changes not yet on Drive: {shown}"
+        if self.conflicts:
+            return f"{len(self.conflicts)} sync conflicts, local copies kept: " + ", ".join(c[1] for c in self.conflicts[-3:])
+        return "All changes saved to Drive"
+
+
+_active = None
+
+
+def start_write_behind():
+    """Start syncing the mirror when the local cache is configured; returns the WriteBehind or None."""
+    global _active
+    if not LOCAL_CACHE:
+        return None
+    if _active is None:
+        _active = WriteBehind().start()
+    return _active
+
+
+def notify_write(path):
+    """Called after every atomic store write; wakes the write-behind thread for mirror files."""
+    if _active is not None and os.path.abspath(path).startswith(os.path.abspath(_active.local) + os.sep):
+        _active.notify()
+
+
+def pending():
+    """Local writes that have not reached Drive yet (empty without the local cache)."""
+    return list(_active.pending_names) if _active is not None else []
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Local cache of the RentalsDB folder")
+    parser.add_argument("command", choices=("status", "sync"))
+    args = parser.parse_args()
+    print(f"Synced folder: {SYNCED_DIR}")
+    if not LOCAL_CACHE:
+        print(f"Local cache off; tools use the synced folder directly (set local_cache in {CONFIG_FILE})")
+    else:
+        print(f"Local mirror:  {MIRROR_DIR}")
+        syncer = WriteBehind()
+        if args.command == "sync":
+            print(f"Copied {syncer.sync_once()} files")
+        else:
+            syncer.pending_names = syncer._pending(_listing(syncer.local))
+        print(syncer.status_text())
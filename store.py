@@ -0,0 +1,313 @@
+"""Shared helpers for the RentalsDB files (history, customers, receipt counter)."""
+import os
+import re
+import json
+import calendar
+from datetime import date
+import serializer
+import storage
+# DB_DIR is the Drive folder, or its local mirror when the local cache is on (see storage)
+from storage import COUNTER_FILE, DB_DIR, LOCAL_DIR
+
+HISTORY_FILE = os.path.join(DB_DIR, "history.json")
+CUSTOMERS_FILE = os.path.join(DB_DIR, "customers_data.json")
+# Always on the synced folder, even with the local cache on, so its lock covers every machine
+RECEIPT_NUMBER_FILE = COUNTER_FILE
+# Characters read per step when streaming a history file
+STREAM_CHUNK = 1 << 16
+
+
+def read_json(path):
+    """
+    Load a store file in any serializer format (pretty or compact JSON, msgpack, gzip).
+
+    Errors propagate so callers can tell 'empty' from 'unreadable'.
+    """
+    with open(path, "rb") as f:
+        return serializer.loads(f.read())
+
+
+def load_history(path=HISTORY_FILE):
+    """Every history entry as one dict (all years when the history is partitioned); {} on error."""
+    try:
+        from history_store import partition_files
+        history = {}
+        for part in partition_files(path):
+            history.update(iter_history_entries(part))
+        return history
+    except Exception:
+        return {}
+
+
+def iter_records(history):
+    """Yield (key, customer, data) for each well-formed history entry, in key order."""
+    for key in sorted(history.keys()):
+        entry = history.get(key, {})
+        if not entry or not isinstance(entry, dict):
+            continue
+        cust = list(entry.keys())[0]
+        data = entry[cust]
+        if isinstance(data, dict):
+            yield key, cust, data
+
+
+_WS = re.compile(r"[ \t\r\n]*")
+
+
+def iter_json_object(f, chunk_size=STREAM_CHUNK):
+    """
+    Yield the (key, value) pairs of the top-level JSON object in text file `f` one at a time.
+
+    Only one value is held in memory, plus a chunk of raw text. Keys and values are
+    decoded by the stdlib's C scanner (raw_decode), so this is about as fast as json.load.
+    """
+    decoder = json.JSONDecoder()
+    buf, pos, eof = "", 0, False
+    state = "start"
+    key = None
+    while True:
+        pos = _WS.match(buf, pos).end()
+        if pos >= len(buf):
+            if eof:
+                raise ValueError("Unexpected end of JSON file")
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf, pos = buf[pos:] + chunk, 0
+            continue
+        ch = buf[pos]
+        if state == "start":
+            if ch != "{":
+                raise ValueError("Expected a JSON object at the top level")
+            pos += 1
+            state = "first"
+        elif state == "first" and ch == "}":
+            return
+        elif state in ("first", "key", "value"):
+            if state != "value" and ch != '"':
+                raise ValueError(f"Expected a key string, got {ch!r}")
+            try:
+                token, end = decoder.raw_decode(buf, pos)
+                # A number cut off by the buffer ("12" of "123", "1." of "1.5") still decodes,
+                # so only trust a token that is followed by a delimiter
+                complete = eof or (end < len(buf) and buf[end] in " \t\r\n,:}")
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                complete = False
+            if not complete:
+                # Cut off at the end of the buffer: read more and decode it again
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buf, pos = buf[pos:] + chunk, 0
+                continue
+            pos = end
+            if state == "value":
+                yield key, token
+                state = "comma"
+            else:
+                key = token
+                state = "colon"
+        elif state == "colon":
+            if ch != ":":
+                raise ValueError(f"Expected ':' after key {key!r}")
+            pos += 1
+            state = "value"
+        else:
+            if ch == "}":
+                return
+            if ch != ",":
+                raise ValueError(f"Expected ',' or '}}' after value of {key!r}")
+            pos += 1
+            state = "key"
+
+
+def record_matches(cust, data, start=None, end=None, customer=None):
+    """True if the record's Date falls in [start, end] and its customer matches (None = any)."""
+    if customer and customer not in (cust, data.get("customer")):
+        return False
+    if start or end:
+        dt = parse_date(data.get("Date", ""))
+        if dt is None:
+            return False
+        if (start and dt < start) or (end and dt > end):
+            return False
+    return True
+
+
+def iter_history_entries(path=HISTORY_FILE):
+    """Stream the raw (key, {customer: data}) entries of a history file in file order."""
+    if not serializer.is_plain_json(path):
+        # msgpack and gzip files are decoded whole; they are several times smaller than the JSON
+        yield from read_json(path).items()
+        return
+    try:
+        import ijson
+        # Only the C backend beats the stdlib scanner; the pure Python one is much slower
+        use_ijson = ijson.backend.endswith("_c")
+    except ImportError:
+        use_ijson = False
+    if use_ijson:
+        with open(path, "rb") as f:
+            yield from ijson.kvitems(f, "", use_float=True)
+    else:
+        with open(path, "r", encoding="utf-8-sig") as f:
+            yield from iter_json_object(f)
+
+
+def iter_history(path=HISTORY_FILE, start=None, end=None, customer=None):
+    """
+    Stream (key, customer, data) from a history file, in file order, without loading it whole.
+
+    Records outside [start, end] or for another customer are dropped as they are read,
+    so memory stays bounded by the matching records the caller keeps. With a
+    year-partitioned history only the years overlapping [start, end] are opened.
+    """
+    from history_store import partition_files
+    for part in partition_files(path, start, end):
+        for key, entry in iter_history_entries(part):
+            if not entry or not isinstance(entry, dict):
+                continue
+            cust = next(iter(entry))
+            data = entry[cust]
+            if isinstance(data, dict) and record_matches(cust, data, start, end, customer):
+                yield key, cust, data
+
+
+def parse_date(date_str):
+    """Parse the 'dd/mm/yyyy' (or 'dd/mm/yy') dates stored in history; None if invalid."""
+    try:
+        parts = (date_str or "").split('/')
+        if len(parts) != 3:
+            return None
+        d, m, y = int(parts[0]), int(parts[1]), int(parts[2])
+        if y < 100:
+            y += 2000
+        return date(y, m, d)
+    except Exception:
+        return None
+
+
+def period_bounds(year, month=None, quarter=None):
+    """Return (first_day, last_day) for a year, a month of it, or a quarter (1-4) of it."""
+    if month:
+        return date(year, month, 1), date(year, month, calendar.monthrange(year, month)[1])
+    if quarter:
+        first = 3 * (quarter - 1) + 1
+        last = first + 2
+        return date(year, first, 1), date(year, last, calendar.monthrange(year, last)[1])
+    return date(year, 1, 1), date(year, 12, 31)
+
+
+def receipt_filename(name, recipe_num, date_str):
+    """File name used for saved receipts, e.g. 'Gazoz 00026 jun 25.pdf'."""
+    month_year = ''
+    dt = parse_date(date_str)
+    if dt:
+        month_year = f"{calendar.month_abbr[dt.month].lower()} {dt.year % 100:02d}"
+    return f"{name} {recipe_num} {month_year}".strip() + ".pdf"
+
+
+def write_bytes_atomic(path, raw, notify=True):
+    """
+    Write bytes to a temp file next to `path` and rename it over the target.
+
+    With `notify`, a write into the local mirror wakes the write-behind copy to Drive.
+    """
+    import tempfile
+    folder = os.path.dirname(path) or "."
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=folder)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(raw)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except Exception:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    if notify:
+        storage.notify_write(path)
+
+
+def write_json_atomic(path, obj, indent=2):
+    """Write JSON to a temp file next to `path` and rename it over the target."""
+    write_bytes_atomic(path, json.dumps(obj, ensure_ascii=False, indent=indent).encode("utf-8"))
+
+
+def write_store_atomic(path, obj, compress=None):
+    """Atomically write a store file (history, customers) in the configured serializer format; returns the bytes."""
+    raw = serializer.dumps(obj, compress=compress)
+    write_bytes_atomic(path, raw)
+    return raw
+
+
+class ReceiptCounter:
+    """
+    The next receipt number from receipt_number.txt, cached in memory.
+
+    The file is read once, and again only after invalidate() (the store watcher saw
+    it change), so showing the number on every customer switch costs nothing.
+    """
+
+    def __init__(self, path=RECEIPT_NUMBER_FILE):
+        self.path = path
+        self._next = None
+        self._loaded = False
+
+    def peek(self):
+        """The next number as written in the file (e.g. '00042'), or None if there is none."""
+        if not self._loaded:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._next = f.read().strip() or None
+            except OSError:
+                self._next = None
+            self._loaded = True
+        return self._next
+
+    def invalidate(self):
+        self._loaded = False
+
+    def lock(self):
+        """The counter's file lock. Hold it while issuing a receipt (history append, then advance)."""
+        from versioned_store import FileLock
+        return FileLock(self.path)
+
+    def advance(self, used, locked=False):
+        """
+        Move the counter past receipt number `used`; returns the new next number.
+
+        Takes the file lock unless the caller already holds it (`locked`).
+        """
+        if not locked:
+            with self.lock():
+                return self.advance(used, locked=True)
+        new_num = int(used) + 1
+        # Never move the counter backwards if another writer already advanced it
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                new_num = max(new_num, int(f.read().strip()))
+        except Exception:
+            pass
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(f"{new_num:05d}")
+        self._next = f"{new_num:05d}"
+        self._loaded = True
+        return new_num
+
+
+def apply_changes(current, new):
+    """Update the dict `current` in place to match `new`; return the set of keys that changed."""
+    changed = set()
+    for key in [k for k in current if k not in new]:
+        del current[key]
+        changed.add(key)
+    for key, value in new.items():
+        if current.get(key) != value:
+            current[key] = value
+            changed.add(key)
+    return changed
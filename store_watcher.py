@@ -0,0 +1,180 @@
+"""Watch DB_DIR for changes made by other machines through Drive sync.
+
+Uses inotify on Linux, watchdog (ReadDirectoryChangesW etc.) when it is
+installed, and otherwise polls the files' size and mtime. Events for the
+watched files are coalesced: changed names pile up in a set until the folder
+has been quiet for `debounce` seconds. The GUI then collects them on its own
+thread with take_changes() and reports back with done() once every tab read
+them, or failed() if a read broke (e.g. a file Drive had only half written).
+A file's signature is only recorded as seen on done(); after failed() the
+names are delivered again `retry_delay` seconds later.
+"""
+import os
+import time
+import threading
+from store import DB_DIR
+
+# history_manifest.json changes on every append to a year-partitioned history
+WATCHED_FILES = ("history.json", "history_manifest.json", "customers_data.json", "receipt_number.txt")
+
+
+def _signature(path):
+    try:
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return None
+
+
+class StoreWatcher:
+    def __init__(self, folder=DB_DIR, files=WATCHED_FILES, debounce=0.5, poll_interval=2.0, retry_delay=2.0):
+        self.folder = folder
+        self.files = set(files)
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.backend = None
+        self._pending = set()
+        self._ready = set()
+        self._last_event = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        # Signatures of the versions the GUI has read successfully
+        self._signatures = {name: _signature(os.path.join(folder, name)) for name in self.files}
+        # Newer signatures reported but not yet confirmed by done()
+        self._seen = {}
+        self._thread = None
+        self._observer = None
+
+    def start(self):
+        if self._try_inotify() or self._try_watchdog():
+            pass
+        else:
+            self.backend = "polling"
+            self._thread = threading.Thread(target=self._poll_loop, daemon=True)
+            self._thread.start()
+        threading.Thread(target=self._settle_loop, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._observer is not None:
+            try:
+                self._observer.stop()
+            except Exception:
+                pass
+
+    def take_changes(self):
+        """Return (and clear) the set of file names whose changes have settled."""
+        with self._lock:
+            ready, self._ready = self._ready, set()
+        return ready
+
+    def done(self, names):
+        """The changes to `names` were read; remember their versions as seen."""
+        with self._lock:
+            for name in names:
+                if name in self._seen:
+                    self._signatures[name] = self._seen.pop(name)
+
+    def failed(self, names):
+        """Reading `names` failed; deliver them again after `retry_delay` (or sooner on a new event)."""
+        with self._lock:
+            self._pending |= set(names)
+            # _settle_loop waits `debounce` after the last event; push that point out to the retry time
+            self._last_event = max(self._last_event, time.monotonic() + self.retry_delay - self.debounce)
+
+    def _notify(self, name):
+        if name not in self.files:
+            return
+        path = os.path.join(self.folder, name)
+        sig = _signature(path)
+        with self._lock:
+            # Ignore events that did not change the file (e.g. a sync client touching it)
+            if sig == self._seen.get(name, self._signatures.get(name)):
+                return
+            self._seen[name] = sig
+            self._pending.add(name)
+            self._last_event = time.monotonic()
+
+    def _settle_loop(self):
+        # Move pending names to ready once no event arrived for `debounce` seconds
+        while not self._stop.wait(self.debounce / 2):
+            with self._lock:
+                if self._pending and time.monotonic() - self._last_event >= self.debounce:
+                    self._ready |= self._pending
+                    self._pending = set()
+
+    def _poll_loop(self):
+        while not self._stop.wait(self.poll_interval):
+            for name in self.files:
+                self._notify(name)
+
+    def _try_inotify(self):
+        if not hasattr(os, "uname") or os.uname().sysname != "Linux":
+            return False
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                return False
+            IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x2, 0x8, 0x80, 0x100, 0x200
+            mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+            if libc.inotify_add_watch(fd, os.fsencode(self.folder), mask) < 0:
+                os.close(fd)
+                return False
+        except Exception:
+            return False
+        self.backend = "inotify"
+        self._thread = threading.Thread(target=self._inotify_loop, args=(fd,), daemon=True)
+        self._thread.start()
+        return True
+
+    def _inotify_loop(self, fd):
+        import select
+        import struct
+        header = struct.Struct("iIII")
+        try:
+            while not self._stop.is_set():
+                readable, _, _ = select.select([fd], [], [], 1.0)
+                if not readable:
+                    continue
+                try:
+                    buf = os.read(fd, 64 * 1024)
+                except BlockingIOError:
+                    continue
+                pos = 0
+                while pos + header.size <= len(buf):
+                    _, _, _, length = header.unpack_from(buf, pos)
+                    raw = buf[pos + header.size:pos + header.size + length]
+                    pos += header.size + length
+                    self._notify(os.fsdecode(raw.rstrip(b"\0")))
+        finally:
+            os.close(fd)
+
+    def _try_watchdog(self):
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            return False
+        watcher = self
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                for attr in ("src_path", "dest_path"):
+                    path = getattr(event, attr, None)
+                    if path:
+                        watcher._notify(os.path.basename(os.fsdecode(path)))
+
+        try:
+            self._observer = Observer()
+            self._observer.schedule(Handler(), self.folder, recursive=False)
+            self._observer.start()
+        except Exception:
+            self._observer = None
+            return False
+        self.backend = "watchdog"
+        return True
@@ -0,0 +1,37 @@
+import os
+
+import pytest
+
+import history_store
+from history_store import MANIFEST_NAME, append_history, migrate, partition_dir
+from store import load_history, write_json_atomic
+from versioned_store import read_versioned, update_versioned
+
+
+def _receipt(date):
+    return {"Gazoz": {"customer": "Gazoz", "Date": date}}
+
+
+def test_failed_manifest_write_keeps_the_year_it_lists(tmp_path, monkeypatch):
+    history = str(tmp_path / "history.json")
+    write_json_atomic(history, {"00001": _receipt("01/06/2020"), "00002": _receipt("01/06/2026")})
+    # 2020 starts out open, then leaves the hot window on the next append
+    migrate(history, hot_years=100)
+    update_versioned(os.path.join(str(tmp_path), MANIFEST_NAME), lambda m: m.update(hot_years=2))
+
+    def failing(path, mutate, compress=None):
+        if os.path.basename(path) == MANIFEST_NAME:
+            mutate(read_versioned(path).data)
+            raise OSError("disk full")
+        return update_versioned(path, mutate, compress)
+
+    monkeypatch.setattr(history_store, "update_versioned", failing)
+    with pytest.raises(OSError):
+        append_history(history, {"00003": _receipt("02/06/2026")})
+    assert os.path.exists(os.path.join(partition_dir(history), "2020.json"))
+    assert "00001" in load_history(history)
+
+    monkeypatch.undo()
+    append_history(history, {"00003": _receipt("02/06/2026")})
+    assert not os.path.exists(os.path.join(partition_dir(history), "2020.json"))
+    assert sorted(load_history(history)) == ["00001", "00002", "00003"]
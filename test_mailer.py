@@ -0,0 +1,37 @@
+import threading
+
+from mailer import MailQueue, StubSMTPServer, deliver
+
+
+def test_queueing_during_a_run_is_not_lost(tmp_path):
+    path = str(tmp_path / "queue.json")
+    run = MailQueue(path)
+    first = run.enqueue("a@example.com", "a.pdf", "s", "b")
+    [(due_id, _)] = run.due()
+    # The generator queues a receipt with its own MailQueue while the run is sending
+    second = MailQueue(path).enqueue("b@example.com", "b.pdf", "s", "b")
+    run.update([(due_id, None)])
+    assert list(MailQueue(path).items) == [second]
+    assert first == due_id
+
+
+def test_concurrent_deliveries_send_each_message_once(tmp_path):
+    path = str(tmp_path / "queue.json")
+    pdf = tmp_path / "receipt.pdf"
+    pdf.write_bytes(b"%PDF-1.4\n")
+    count = 40
+    queue = MailQueue(path)
+    for i in range(count):
+        queue.enqueue(f"tenant{i}@example.com", str(pdf), "s", "b")
+    stub = StubSMTPServer().start()
+    try:
+        # Like the bank import's deliver() next to the generator's deliver_async()
+        threads = [threading.Thread(target=deliver, args=(MailQueue(path), stub.config())) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(30)
+    finally:
+        stub.stop()
+    assert stub.accepted == count
+    assert MailQueue(path).counts() == {}
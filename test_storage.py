@@ -0,0 +1,58 @@
+import json
+import os
+
+import storage
+from storage import WriteBehind
+from versioned_store import read_versioned, update_versioned
+
+
+def _machine(tmp_path, name):
+    os.makedirs(tmp_path / name, exist_ok=True)
+    return WriteBehind(local=str(tmp_path / name / "db"), remote=str(tmp_path / "drive"),
+                       state_path=str(tmp_path / name / "state.json"), base_dir=str(tmp_path / name / "base"))
+
+
+def _receipt(customer, amount):
+    return {customer: {"customer": customer, "amount": amount}}
+
+
+def test_same_key_on_two_mirrors_keeps_the_other_appends(tmp_path):
+    os.makedirs(tmp_path / "drive")
+    update_versioned(str(tmp_path / "drive" / "history.json"), lambda d: d.update({"00009": _receipt("Gazoz", "100")}))
+    a, b = _machine(tmp_path, "a"), _machine(tmp_path, "b")
+    a.sync_once()
+    b.sync_once()
+    # Both machines issue 00010 while offline from each other; B also issues 00011
+    update_versioned(os.path.join(a.local, "history.json"), lambda d: d.update({"00010": _receipt("Gazoz", "100")}))
+    update_versioned(os.path.join(b.local, "history.json"),
+                     lambda d: d.update({"00010": _receipt("Levi", "250"), "00011": _receipt("Cohen", "300")}))
+    a.sync_once()
+    b.sync_once()
+    a.sync_once()
+    for folder in (a.local, b.local, a.remote):
+        data = read_versioned(os.path.join(folder, "history.json")).data
+        assert sorted(data) == ["00009", "00010", "00011"]
+        # The clash keeps the version that reached Drive first
+        assert data["00010"] == _receipt("Gazoz", "100")
+    assert a.conflicts == []
+    [(rel, aside, reason)] = b.conflicts
+    assert rel == "history.json" and "00010" in reason
+    with open(aside, "r", encoding="utf-8") as f:
+        assert json.load(f) == {"00010": _receipt("Levi", "250")}
+
+
+def test_counter_is_not_mirrored(tmp_path):
+    os.makedirs(tmp_path / "drive")
+    with open(tmp_path / "drive" / storage.COUNTER_NAME, "w", encoding="utf-8") as f:
+        f.write("00010")
+    a = _machine(tmp_path, "a")
+    # A mirror from before the counter was kept out of it
+    os.makedirs(a.local)
+    with open(os.path.join(a.local, storage.COUNTER_NAME), "w", encoding="utf-8") as f:
+        f.write("00010")
+    with open(a.state_path, "w", encoding="utf-8") as f:
+        json.dump({storage.COUNTER_NAME: {"local": None, "remote": None, "sha256": ""}}, f)
+    a.sync_once()
+    with open(tmp_path / "drive" / storage.COUNTER_NAME, "r", encoding="utf-8") as f:
+        assert f.read() == "00010"
+    assert storage.COUNTER_NAME not in a.state
@@ -0,0 +1,83 @@
+import os
+import time
+from multiprocessing import Process
+
+import pytest
+
+import versioned_store
+from versioned_store import FileLock, LockTimeout, read_versioned, _stress_worker
+
+
+def _locked_increment(path, rounds, slow_stale_check=False):
+    if slow_stale_check:
+        # Widen the gap between deciding a lock is stale and breaking it, so that
+        # several waiters act on the same stale lock
+        getmtime = os.path.getmtime
+
+        def slow_getmtime(p):
+            value = getmtime(p)
+            time.sleep(0.05)
+            return value
+        versioned_store.os.path.getmtime = slow_getmtime
+    # Deliberately slow read-modify-write: only correct if the lock is exclusive
+    for _ in range(rounds):
+        with FileLock(path):
+            with open(path, "r", encoding="utf-8") as f:
+                value = int(f.read() or 0)
+            time.sleep(0.001)
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(str(value + 1))
+
+
+def _run(target, args_list):
+    procs = [Process(target=target, args=args) for args in args_list]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(60)
+    assert all(p.exitcode == 0 for p in procs)
+
+
+@pytest.mark.parametrize("use_merge", [False, True])
+def test_no_lost_updates(tmp_path, use_merge):
+    path = str(tmp_path / "store.json")
+    workers, count = 4, 25
+    _run(_stress_worker, [(path, w, count, use_merge) for w in range(workers)])
+    assert len(read_versioned(path).data) == workers * count
+
+
+def test_stale_lock_is_broken_by_one_waiter(tmp_path):
+    path = str(tmp_path / "counter.txt")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("0")
+    # A lock left behind by a crashed process, old enough to count as stale
+    lock = path + ".lock"
+    with open(lock, "w", encoding="utf-8") as f:
+        f.write("dead")
+    old = time.time() - versioned_store.LOCK_STALE_AFTER - 5
+    os.utime(lock, (old, old))
+    workers, rounds = 6, 20
+    _run(_locked_increment, [(path, rounds, True)] * workers)
+    with open(path, "r", encoding="utf-8") as f:
+        assert int(f.read()) == workers * rounds
+    assert not os.path.exists(lock)
+    assert not [n for n in os.listdir(tmp_path) if ".lock." in n]
+
+
+def test_exit_leaves_a_lock_it_no_longer_owns(tmp_path):
+    path = str(tmp_path / "data.json")
+    lock = FileLock(path)
+    with lock:
+        # Broken as stale and taken by someone else while we still "held" it
+        os.remove(lock.path)
+        with open(lock.path, "w", encoding="utf-8") as f:
+            f.write("other")
+    assert os.path.exists(lock.path)
+
+
+def test_timeout(tmp_path):
+    path = str(tmp_path / "data.json")
+    with FileLock(path):
+        with pytest.raises(LockTimeout):
+            with FileLock(path, timeout=0.05):
+                pass
@@ -1,10 +1,9 @@
 import os
-import json
 import tkinter as tk
 from tkinter import ttk, messagebox
-
-DB_DIR = r"G:\My Drive\Rentals\RentalsDB"
-HISTORY_FILE = os.path.join(DB_DIR, "history.json")
+from tracing import span
+from store import DB_DIR, HISTORY_FILE, period_bounds
+from export_pipeline import CsvSink, JsonLinesSink, TotalsSink, TsvSink, XlsxSink, collect_rows, feed
 
 
 class ToExcelApp(tk.Frame):
@@ -13,22 +12,10 @@ class ToExcelApp(tk.Frame):
         self.master = master
         self.pack(fill="both", expand=True, padx=10, pady=10)
         os.makedirs(DB_DIR, exist_ok=True)
-        self.history = {}
-        self.load_history()
+        # History is streamed from disk on each export (only the period's rows are kept),
+        # so there is nothing to load up front or to refresh when the file changes
         self.build_ui()
 
-    def load_history(self):
-        try:
-            with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-                self.history = json.load(f)
-        except Exception:
-            self.history = {}
-
-    def reload_history(self):
-        """Reload history from disk and write a short message to the UI log."""
-        # Keep reload silent for UI - update internal cache only
-        self.load_history()
-
     def build_ui(self):
         row = tk.Frame(self)
         row.pack(fill="x", pady=6)
@@ -41,119 +28,281 @@ class ToExcelApp(tk.Frame):
         tk.Button(row, text="Export to Clipboard", command=self.export).pack(side="left")
         tk.Button(row, text="Export .xlsx", command=self.export_xlsx).pack(side="left", padx=(8,0))
 
+        multi_row = tk.Frame(self)
+        multi_row.pack(fill="x", pady=6)
+        self.sink_vars = {}
+        for name, label in (("clipboard", "Clipboard"), ("xlsx", ".xlsx"), ("csv", ".csv"), ("jsonl", ".jsonl"), ("totals", "Totals")):
+            self.sink_vars[name] = tk.BooleanVar(value=name in ("clipboard", "xlsx"))
+            tk.Checkbutton(multi_row, text=label, variable=self.sink_vars[name]).pack(side="left")
+        tk.Button(multi_row, text="Export selected", command=self.export_selected).pack(side="left", padx=(8,0))
+        tk.Label(multi_row, text="(one pass over history)").pack(side="left", padx=(8,0))
+
+        zip_row = tk.Frame(self)
+        zip_row.pack(fill="x", pady=6)
+        tk.Label(zip_row, text="Customer (blank = all):").pack(side="left")
+        self.customer_var = tk.StringVar()
+        tk.Entry(zip_row, textvariable=self.customer_var, width=24).pack(side="left", padx=(4,8))
+        tk.Button(zip_row, text="Export PDFs to .zip", command=self.export_zip).pack(side="left")
+        tk.Label(zip_row, text="(month may be blank for the whole year, or Q1-Q4)").pack(side="left", padx=(8,0))
+
+        ledger_row = tk.Frame(self)
+        ledger_row.pack(fill="x", pady=6)
+        tk.Button(ledger_row, text="Payments & Arrears", command=self.show_arrears).pack(side="left")
+        tk.Button(ledger_row, text="Year Report PDF", command=self.export_year_report).pack(side="left", padx=(8,0))
+        tk.Button(ledger_row, text="Import legacy .xlsx", command=self.import_legacy).pack(side="left", padx=(8,0))
+        tk.Label(ledger_row, text="(for the year above; rent = the customer's payment field)").pack(side="left", padx=(8,0))
+
         self.log = tk.Text(self, height=20)
         self.log.pack(fill="both", expand=True, pady=(8,0))
 
-    def _collect_sorted_rows(self, month, year):
-        """Yield (date_obj, row_values) for entries matching month/year, sorted by date ascending."""
-        items = []
-        from datetime import date
-        for key in sorted(self.history.keys()):
-            entry = self.history.get(key, {})
-            if not entry or not isinstance(entry, dict):
-                continue
-            cust = list(entry.keys())[0]
-            data = entry[cust]
-            date_str = data.get("Date", "")
-            try:
-                parts = date_str.split('/')
-                if len(parts) == 3:
-                    d = int(parts[0])
-                    m = int(parts[1])
-                    y = int(parts[2])
-                    if y < 100:
-                        y += 2000
-                else:
-                    continue
-            except Exception:
-                continue
-            if m != month or y != year:
-                continue
-            try:
-                dt = date(y, m, d)
-            except Exception:
-                continue
-            payment = data.get("payment", "")
-            bank_number = data.get("BankNumber", "")
-            bank_account = data.get("bankAccount", data.get("bankAccount", ""))
-            receipt_no = data.get("recipeNum", key)
-            # Columns: A(hebrew 'הכנסה'), B(date), C(payment), D(customer), E(blank), F(receipt_no), G(bank_number), H(bank_account), I(CheckNumber)
-            check_number = data.get("CheckNumber", "")
-            row_vals = ["הכנסה", date_str, payment, cust, "", receipt_no, bank_number, bank_account, check_number]
-            items.append((dt, row_vals))
-        items.sort(key=lambda x: x[0])
-        for it in items:
-            yield it
-
-    def export(self):
+    def _period(self):
+        """(month, year) from the inputs, or None after telling the user what is wrong."""
         month_s = self.month_var.get().strip()
         year_s = self.year_var.get().strip()
         if not month_s or not year_s:
             messagebox.showwarning("Input required", "Please enter month and year.")
-            return
+            return None
         try:
-            month = int(month_s)
-            year = int(year_s)
+            month, year = int(month_s), int(year_s)
         except Exception:
             messagebox.showerror("Error", "Month and year must be integers.")
-            return
-        rows = [r for _, r in self._collect_sorted_rows(month, year)]
+            return None
+        # Month 0 would read as "no month" (the whole year) and 13 makes date() raise
+        if not 1 <= month <= 12 or not 1000 <= year <= 9999:
+            messagebox.showerror("Error", "Month must be 1-12 and year a 4-digit year.")
+            return None
+        return month, year
+
+    def _collect(self, month, year):
+        """The period's rows from one history pass; None (after telling the user) if there are none."""
+        with span("export.collect_rows"):
+            rows = collect_rows(HISTORY_FILE, *period_bounds(year, month))
         if not rows:
             messagebox.showinfo("No data", "No receipts found for that month/year.")
-            return
-        # build TSV
-        tsv_lines = ["\t".join(map(str, r)) for r in rows]
-        tsv = "\n".join(tsv_lines)
-        # copy to clipboard
+            return None
+        return rows
+
+    def _copy_tsv(self, tsv, count):
         try:
             self.master.clipboard_clear()
             self.master.clipboard_append(tsv)
-            self.log.delete(1.0, tk.END)
-            self.log.insert(tk.END, f"Copied {len(rows)} rows to clipboard.\n")
-            self.log.insert(tk.END, tsv)
-            messagebox.showinfo("Copied", f"Copied {len(rows)} rows to clipboard.")
         except Exception as e:
             messagebox.showerror("Clipboard Error", f"Failed to copy to clipboard: {e}")
+            return False
+        self.log.delete(1.0, tk.END)
+        self.log.insert(tk.END, f"Copied {count} rows to clipboard.\n")
+        self.log.insert(tk.END, tsv)
+        return True
+
+    def export(self):
+        period = self._period()
+        if period is None:
+            return
+        rows = self._collect(*period)
+        if rows is None:
+            return
+        result = feed([TsvSink()], rows)["tsv"]
+        if self._copy_tsv(result, len(rows)):
+            messagebox.showinfo("Copied", f"Copied {len(rows)} rows to clipboard.")
 
     def export_xlsx(self):
-        # collect the same rows as export()
-        month_s = self.month_var.get().strip()
+        period = self._period()
+        if period is None:
+            return
+        rows = self._collect(*period)
+        if rows is None:
+            return
+        # ask where to save
+        fpath = tk.filedialog.asksaveasfilename(title="Save Excel File", defaultextension=".xlsx", filetypes=[("Excel files","*.xlsx")])
+        if not fpath:
+            return
+        result = feed([XlsxSink(fpath)], rows)["xlsx"]
+        if isinstance(result, ImportError):
+            messagebox.showerror("Missing dependency", "openpyxl is required to export XLSX. Install with: pip install openpyxl")
+        elif isinstance(result, Exception):
+            messagebox.showerror("Save error", f"Failed to save Excel file: {result}")
+        else:
+            messagebox.showinfo("Saved", f"Saved {len(rows)} rows to {fpath}")
+
+    def export_selected(self):
+        """Every checked format from a single pass over history."""
+        from tkinter import filedialog
+        period = self._period()
+        if period is None:
+            return
+        month, year = period
+        if not any(var.get() for var in self.sink_vars.values()):
+            messagebox.showwarning("Nothing selected", "Tick at least one export format.")
+            return
+        rows = self._collect(month, year)
+        if rows is None:
+            return
+        base = f"receipts_{year:04d}_{month:02d}"
+        sinks = []
+        if self.sink_vars["clipboard"].get():
+            sinks.append(TsvSink())
+        for name, cls, label in (("xlsx", XlsxSink, "Excel files"), ("csv", CsvSink, "CSV files"), ("jsonl", JsonLinesSink, "JSON lines")):
+            if not self.sink_vars[name].get():
+                continue
+            fpath = filedialog.asksaveasfilename(title=f"Save .{name}", defaultextension=f".{name}",
+                                                 initialfile=f"{base}.{name}", filetypes=[(label, f"*.{name}")])
+            if not fpath:
+                return
+            sinks.append(cls(fpath))
+        if self.sink_vars["totals"].get():
+            sinks.append(TotalsSink())
+        results = feed(sinks, rows)
+        count = len(rows)
+        lines = [f"{count} rows for {month:02d}/{year}"]
+        for name, result in results.items():
+            if isinstance(result, Exception):
+                lines.append(f"{name}: FAILED - {result}")
+            elif name == "tsv":
+                lines.append("clipboard: copied" if self._copy_tsv(result, count) else "clipboard: failed")
+            elif name == "totals":
+                lines.append(f"totals: {result['count']} receipts, {result['amount']:,.2f}")
+                lines.extend(f"  {cust}: {n} receipts, {amount:,.2f}" for cust, (n, amount) in sorted(result["customers"].items()))
+            else:
+                lines.append(f"{name}: {result}")
+        self._show_log("\n".join(lines) + "\n")
+
+    def show_arrears(self):
+        import datetime
+        import threading
+        from store import CUSTOMERS_FILE, read_json
+        from ledger import HEADER, format_row, load_ledger
         year_s = self.year_var.get().strip()
-        if not month_s or not year_s:
-            messagebox.showwarning("Input required", "Please enter month and year.")
+        try:
+            year = int(year_s) if year_s else datetime.date.today().year
+        except ValueError:
+            messagebox.showerror("Error", "Year must be an integer.")
             return
+
+        def work():
+            try:
+                # Current ledger from LOCAL_DIR; only rebuilt if history changed elsewhere
+                ledger = load_ledger(HISTORY_FILE)
+                try:
+                    customers = read_json(CUSTOMERS_FILE)
+                except Exception:
+                    customers = {}
+                rows = ledger.arrears(customers, year)
+            except Exception as e:
+                err = e
+                self.after(0, lambda: messagebox.showerror("Ledger error", f"Failed to load the ledger: {err}"))
+                return
+            lines = [HEADER] + [format_row(r) for r in rows]
+            owed = sum(r[5] for r in rows if r[5] > 0)
+            lines.append(f"\n{len(rows)} customers, {sum(r[2] for r in rows):,.0f} paid in {year}, {owed:,.0f} owed")
+            self.after(0, lambda: self._show_log("\n".join(lines)))
+
+        threading.Thread(target=work, daemon=True).start()
+
+    def export_year_report(self):
+        import threading
+        from tkinter import filedialog
+        year_s = self.year_var.get().strip()
         try:
-            month = int(month_s)
             year = int(year_s)
-        except Exception:
-            messagebox.showerror("Error", "Month and year must be integers.")
+        except ValueError:
+            messagebox.showwarning("Input required", "Please enter the report year.")
             return
-        rows = [r for _, r in self._collect_sorted_rows(month, year)]
-        if not rows:
-            messagebox.showinfo("No data", "No receipts found for that month/year.")
-            return
-        # ask where to save
-        fpath = tk.filedialog.asksaveasfilename(title="Save Excel File", defaultextension=".xlsx", filetypes=[("Excel files","*.xlsx")])
+        fpath = filedialog.asksaveasfilename(title="Save Year Report", defaultextension=".pdf",
+                                             initialfile=f"income_report_{year}.pdf", filetypes=[("PDF files","*.pdf")])
         if not fpath:
             return
-        # ensure openpyxl available
+        self._show_log(f"Building the {year} report...\n")
+
+        def progress(done, total):
+            self.after(0, lambda: self.log.insert(tk.END, f"month {done}/{total}\n"))
+
+        def work():
+            try:
+                from year_report import build_report
+                build_report(year, fpath, HISTORY_FILE, progress=progress)
+                self.after(0, lambda: messagebox.showinfo("Saved", f"Saved the {year} report to {fpath}"))
+            except Exception as e:
+                err = e
+                self.after(0, lambda: messagebox.showerror("Report error", f"Failed to build the report: {err}"))
+
+        threading.Thread(target=work, daemon=True).start()
+
+    def import_legacy(self):
+        import threading
+        from tkinter import filedialog
+        paths = filedialog.askopenfilenames(title="Legacy receipt workbooks", filetypes=[("Excel files","*.xlsx")])
+        if not paths:
+            return
+        self._show_log(f"Importing {len(paths)} workbooks...\n")
+
+        def progress(sheet, row):
+            self.after(0, lambda: self.log.insert(tk.END, f"{sheet}: row {row}\n"))
+
+        def work():
+            from legacy_import import import_workbook
+            for path in paths:
+                try:
+                    result = import_workbook(path, HISTORY_FILE, progress=progress)
+                except Exception as e:
+                    err = e
+                    self.after(0, lambda p=path: messagebox.showerror("Import error", f"{os.path.basename(p)}: {err}\nRun the import again to continue where it stopped."))
+                    return
+                lines = [f"{os.path.basename(path)}: {result.summary()}"]
+                lines += [f"  {sheet} row {row}: {reason}" for sheet, row, reason in result.errors]
+                self.after(0, lambda text="\n".join(lines): self.log.insert(tk.END, text + "\n"))
+            self.after(0, lambda: messagebox.showinfo("Import", "Import finished; see the log for details."))
+
+        threading.Thread(target=work, daemon=True).start()
+
+    def _show_log(self, text):
+        self.log.delete(1.0, tk.END)
+        self.log.insert(tk.END, text)
+
+    def export_zip(self):
+        import threading
+        from tkinter import filedialog
+        from store import period_bounds
+        from zip_export import select_records_from_file, export_zip
+        month_s = self.month_var.get().strip().upper()
+        year_s = self.year_var.get().strip()
+        if not year_s:
+            messagebox.showwarning("Input required", "Please enter at least a year.")
+            return
         try:
-            import openpyxl
-            from openpyxl.utils import get_column_letter
+            year = int(year_s)
+            if month_s.startswith("Q"):
+                start, end = period_bounds(year, quarter=int(month_s[1:]))
+            else:
+                start, end = period_bounds(year, month=int(month_s) if month_s else None)
         except Exception:
-            messagebox.showerror("Missing dependency", "openpyxl is required to export XLSX. Install with: pip install openpyxl")
+            messagebox.showerror("Error", "Year must be an integer and month 1-12, Q1-Q4 or blank.")
             return
-        # write workbook
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        for r_idx, r in enumerate(rows, start=1):
-            for c_idx, val in enumerate(r, start=1):
-                ws.cell(row=r_idx, column=c_idx, value=val)
         try:
-            wb.save(fpath)
-            messagebox.showinfo("Saved", f"Saved {len(rows)} rows to {fpath}")
-        except Exception as e:
-            messagebox.showerror("Save error", f"Failed to save Excel file: {e}")
+            with span("history.stream"):
+                records = select_records_from_file(HISTORY_FILE, start, end, self.customer_var.get().strip() or None)
+        except FileNotFoundError:
+            records = []
+        if not records:
+            messagebox.showinfo("No data", "No receipts found for that period.")
+            return
+        fpath = filedialog.asksaveasfilename(title="Save ZIP Archive", defaultextension=".zip", filetypes=[("ZIP files","*.zip")])
+        if not fpath:
+            return
+        self.log.delete(1.0, tk.END)
+        self.log.insert(tk.END, f"Exporting {len(records)} receipts to {fpath}...\n")
+
+        def progress(done, total):
+            self.after(0, lambda: self.log.insert(tk.END, f"{done}/{total}\n"))
+
+        def work():
+            try:
+                count = export_zip(records, fpath, progress=progress)
+                self.after(0, lambda: messagebox.showinfo("Saved", f"Saved {count} receipts to {fpath}"))
+            except Exception as e:
+                err = e
+                self.after(0, lambda: messagebox.showerror("Export error", f"Failed to export ZIP: {err}"))
+
+        threading.Thread(target=work, daemon=True).start()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,173 @@
+"""Opt-in stage timing for receipt generation and the GUI actions.
+
+Tracing is off unless RECEIPT_TRACE=1 is set or enable() is called. While off,
+span() and action() hand back one shared no-op context manager, so the
+instrumented code only pays for a function call and a flag check.
+
+When on, every span is kept as a Chrome trace "complete" event (open the file
+written by write_chrome_trace() in chrome://tracing or Perfetto) and its
+duration is added to a per-stage sample list used by stage_stats(). If a
+profile directory is set, each action() also dumps a cProfile file.
+"""
+import os
+import json
+import math
+import time
+import threading
+
+MAX_SAMPLES = 1000   # per stage, oldest samples are dropped first
+MAX_EVENTS = 20000   # timeline events kept for the Chrome trace
+
+_enabled = os.environ.get("RECEIPT_TRACE", "") not in ("", "0")
+_profile_dir = os.environ.get("RECEIPT_PROFILE_DIR") or None
+_lock = threading.Lock()
+_events = []
+_durations = {}
+_pid = os.getpid()
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _record(self.name, self.start, time.perf_counter())
+        return False
+
+
+class _Action(_Span):
+    """Top level span for a user action; optionally profiled with cProfile."""
+    __slots__ = ("profiler",)
+
+    def __enter__(self):
+        self.profiler = None
+        if _profile_dir:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return super().__enter__()
+
+    def __exit__(self, *exc):
+        super().__exit__(*exc)
+        if self.profiler is not None:
+            self.profiler.disable()
+            try:
+                os.makedirs(_profile_dir, exist_ok=True)
+                ts = time.strftime("%Y%m%dT%H%M%S")
+                path = os.path.join(_profile_dir, f"{self.name}-{ts}-{int(self.start * 1000) % 1000:03d}.prof")
+                self.profiler.dump_stats(path)
+            except Exception:
+                # Profiling must never break the action being profiled
+                pass
+        return False
+
+
+def _record(name, start, end):
+    dur = end - start
+    event = {
+        "name": name,
+        "ph": "X",
+        "ts": start * 1e6,
+        "dur": dur * 1e6,
+        "pid": _pid,
+        "tid": threading.get_ident(),
+    }
+    with _lock:
+        _events.append(event)
+        if len(_events) > MAX_EVENTS:
+            del _events[:len(_events) - MAX_EVENTS]
+        samples = _durations.setdefault(name, [])
+        samples.append(dur * 1000.0)
+        if len(samples) > MAX_SAMPLES:
+            del samples[0]
+
+
+def span(name):
+    """Context manager timing one stage, e.g. ``with span("pdf.save"):``."""
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def action(name):
+    """Like span() but for a whole GUI action; also cProfiles it when a profile dir is set."""
+    if not _enabled:
+        return _NULL_SPAN
+    return _Action(name)
+
+
+def enable(profile_dir=None):
+    global _enabled, _profile_dir
+    _enabled = True
+    _profile_dir = profile_dir
+
+
+def disable():
+    global _enabled, _profile_dir
+    _enabled = False
+    _profile_dir = None
+
+
+def is_enabled():
+    return _enabled
+
+
+def profile_dir():
+    return _profile_dir
+
+
+def reset():
+    with _lock:
+        _events.clear()
+        _durations.clear()
+
+
+def _percentile(sorted_vals, pct):
+    # nearest-rank percentile on an already sorted list
+    if not sorted_vals:
+        return 0.0
+    idx = max(0, min(len(sorted_vals) - 1, math.ceil(pct / 100.0 * len(sorted_vals)) - 1))
+    return sorted_vals[idx]
+
+
+def stage_stats():
+    """Return {stage: {"count", "p50", "p95", "max"}} with times in milliseconds."""
+    with _lock:
+        snapshot = {k: list(v) for k, v in _durations.items()}
+    stats = {}
+    for name, samples in snapshot.items():
+        samples.sort()
+        stats[name] = {
+            "count": len(samples),
+            "p50": _percentile(samples, 50),
+            "p95": _percentile(samples, 95),
+            "max": samples[-1] if samples else 0.0,
+        }
+    return stats
+
+
+def write_chrome_trace(path):
+    """Write the recorded spans as a Chrome trace JSON file."""
+    with _lock:
+        events = list(_events)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    return len(events)
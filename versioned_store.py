@@ -0,0 +1,272 @@
+"""Versioned read-modify-write for the JSON store files.
+
+Every write also stores a sidecar "<file>.meta" with a generation counter and
+the SHA-256 of the file as written. A writer passes in the Snapshot it read.
+If the file's hash is unchanged the write goes through. Otherwise the three
+versions (what we read, what we want, what is there now) are merged per
+top-level key, so a receipt or customer added on another machine survives.
+Only edits to the same key on both sides raise ConflictError.
+
+A lock file around each write serializes writers on the same machine and
+between processes. Drive does not sync it fast enough to lock between
+machines; the hash check covers that case.
+
+Run ``python versioned_store.py stress`` to hammer a temp file from several
+processes and check that no update is lost; test_versioned_store.py runs the
+same check under pytest.
+"""
+import os
+import json
+import time
+import hashlib
+import uuid
+from store import write_json_atomic, write_store_atomic
+import serializer
+
+LOCK_TIMEOUT = 10.0
+# A lock file older than this is assumed to belong to a crashed process
+LOCK_STALE_AFTER = 30.0
+# Breaking a stale lock takes milliseconds; a guard file older than this is left over from a crash
+BREAK_GUARD_STALE_AFTER = 5.0
+
+
+class ConflictError(Exception):
+    def __init__(self, path, keys, detail="was changed elsewhere for"):
+        self.path = path
+        self.keys = sorted(keys)
+        super().__init__(f"{os.path.basename(path)} {detail}: {', '.join(self.keys)}")
+
+
+class LockTimeout(Exception):
+    pass
+
+
+class Snapshot:
+    """Data as read from disk, plus the generation and hash it was read at."""
+    __slots__ = ("data", "generation", "sha256")
+
+    def __init__(self, data, generation, sha256):
+        self.data = data
+        self.generation = generation
+        self.sha256 = sha256
+
+
+class FileLock:
+    """
+    Lock file created with O_EXCL and holding a unique token.
+
+    A lock older than LOCK_STALE_AFTER is broken under a second O_EXCL guard
+    file: the waiter holding the guard checks that the lock still has the
+    token it found stale, renames it to a unique name and deletes that.
+    Other waiters that found the same stale lock then see a fresh token (or
+    no lock) and leave it alone, so only one of them can take the lock.
+    """
+
+    def __init__(self, path, timeout=LOCK_TIMEOUT):
+        self.path = path + ".lock"
+        self.timeout = timeout
+        self.token = None
+
+    def __enter__(self):
+        deadline = time.monotonic() + self.timeout
+        token = f"{os.getpid()} {time.time()} {uuid.uuid4().hex}"
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, token.encode())
+                os.close(fd)
+                self.token = token
+                return self
+            except FileExistsError:
+                try:
+                    held = _read_token(self.path)
+                    if time.time() - os.path.getmtime(self.path) > LOCK_STALE_AFTER:
+                        self._break_stale(held)
+                        continue
+                except OSError:
+                    continue
+                if time.monotonic() > deadline:
+                    raise LockTimeout(f"Could not lock {self.path}")
+                time.sleep(0.01)
+
+    def _break_stale(self, held):
+        guard = self.path + ".break"
+        try:
+            os.close(os.open(guard, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            # Someone else is breaking it; a guard this old was left by a crash mid-break
+            try:
+                if time.time() - os.path.getmtime(guard) > BREAK_GUARD_STALE_AFTER:
+                    os.remove(guard)
+            except OSError:
+                pass
+            time.sleep(0.01)
+            return
+        try:
+            # Another waiter may have broken it and taken the lock since we looked
+            if _read_token(self.path) != held:
+                return
+            aside = f"{self.path}.stale-{uuid.uuid4().hex}"
+            os.rename(self.path, aside)
+            os.remove(aside)
+        except OSError:
+            pass
+        finally:
+            try:
+                os.remove(guard)
+            except OSError:
+                pass
+
+    def __exit__(self, *exc):
+        try:
+            # Only remove our own lock; it may have been broken as stale and re-taken
+            if _read_token(self.path) == self.token:
+                os.remove(self.path)
+        except OSError:
+            pass
+        self.token = None
+        return False
+
+
+def _read_token(path):
+    with open(path, "rb") as f:
+        return f.read().decode("utf-8", "replace")
+
+
+def _meta_path(path):
+    return path + ".meta"
+
+
+def _read_meta(path):
+    try:
+        with open(_meta_path(path), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def read_generation(path):
+    """The generation recorded in the sidecar, without reading or hashing the file itself."""
+    return _read_meta(path).get("generation", 0)
+
+
+def read_versioned(path, default=None):
+    """Read `path` into a Snapshot; a missing file gives `default` (an empty dict) at generation 0."""
+    try:
+        with open(path, "rb") as f:
+            raw = f.read()
+    except FileNotFoundError:
+        return Snapshot({} if default is None else default, 0, None)
+    meta = _read_meta(path)
+    digest = hashlib.sha256(raw).hexdigest()
+    generation = meta.get("generation", 0)
+    if meta.get("sha256") != digest:
+        # Written by something that does not keep the sidecar up to date
+        generation += 1
+    return Snapshot(serializer.loads(raw), generation, digest)
+
+
+def merge(base, ours, theirs):
+    """Three-way merge of top-level keys. Returns (merged, conflicting_keys)."""
+    merged = {}
+    conflicts = set()
+    missing = object()
+    for key in set(base) | set(ours) | set(theirs):
+        b = base.get(key, missing)
+        o = ours.get(key, missing)
+        t = theirs.get(key, missing)
+        if o == b:
+            result = t
+        elif t == b or t == o:
+            result = o
+        else:
+            conflicts.add(key)
+            result = t
+        if result is not missing:
+            merged[key] = result
+    return merged, conflicts
+
+
+def _write(path, data, generation, compress=None):
+    digest = hashlib.sha256(write_store_atomic(path, data, compress)).hexdigest()
+    write_json_atomic(_meta_path(path), {"generation": generation, "sha256": digest}, indent=None)
+    return Snapshot(data, generation, digest)
+
+
+def write_versioned(path, base, data, auto_merge=True, compress=None):
+    """
+    Write `data` if `path` is still at `base`; otherwise merge per key or raise ConflictError.
+
+    Returns the new Snapshot. Its data is the merged content when a merge happened,
+    so callers should adopt it.
+    """
+    with FileLock(path):
+        current = read_versioned(path)
+        if current.sha256 != base.sha256:
+            if not auto_merge:
+                raise ConflictError(path, [])
+            data, conflicts = merge(base.data, data, current.data)
+            if conflicts:
+                raise ConflictError(path, conflicts)
+        return _write(path, data, max(current.generation, base.generation) + 1, compress)
+
+
+def update_versioned(path, mutate, compress=None):
+    """
+    Read the latest version under the lock, apply `mutate(data)` in place, and write it back.
+
+    For short read-modify-write cycles such as appending a receipt. `mutate` may raise to abort.
+    `compress` overrides the configured gzip setting for this file (see serializer).
+    """
+    with FileLock(path):
+        current = read_versioned(path)
+        mutate(current.data)
+        return _write(path, current.data, current.generation + 1, compress)
+
+
+def _stress_worker(path, worker, count, use_merge):
+    for i in range(count):
+        key = f"w{worker:02d}-{i:04d}"
+        if use_merge:
+            # Deliberately stale read: other workers write between our read and our write
+            while True:
+                snap = read_versioned(path)
+                data = dict(snap.data)
+                data[key] = {"worker": worker, "i": i}
+                try:
+                    write_versioned(path, snap, data)
+                    break
+                except ConflictError:
+                    continue
+        else:
+            update_versioned(path, lambda d: d.__setitem__(key, {"worker": worker, "i": i}))
+
+
+def stress(workers=6, count=50):
+    """Run concurrent writers against a temp file and assert no update was lost."""
+    import tempfile
+    from multiprocessing import Process
+    folder = tempfile.mkdtemp(prefix="versioned_store_")
+    ok = True
+    for use_merge in (False, True):
+        path = os.path.join(folder, f"stress_{'merge' if use_merge else 'update'}.json")
+        procs = [Process(target=_stress_worker, args=(path, w, count, use_merge)) for w in range(workers)]
+        start = time.perf_counter()
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        snap = read_versioned(path)
+        expected = workers * count
+        mode = "merge" if use_merge else "update"
+        print(f"{mode}: {len(snap.data)}/{expected} records, generation {snap.generation}, {time.perf_counter() - start:.2f}s")
+        ok = ok and len(snap.data) == expected
+    print("OK: no lost updates" if ok else "FAILED: updates were lost")
+    return ok
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "stress":
+        sys.exit(0 if stress() else 1)
+    print("usage: python versioned_store.py stress")
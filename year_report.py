@@ -0,0 +1,211 @@
+"""Year-end income report: every receipt of a year, with monthly, customer and VAT totals.
+
+History is streamed one month at a time (iter_history with that month's
+bounds, so a partitioned history only opens the year's file). Rows are fed
+to ReportLab platypus as tables of ROWS_PER_TABLE rows through a story
+that is filled lazily as pages are laid out. Memory therefore stays at one
+month of records plus the running totals, however many receipts the year
+has.
+
+Payments are taken to include VAT at the receipt's mamVal rate, so
+VAT = payment * rate / (100 + rate).
+
+    python year_report.py 2025 [--out report.pdf] [--history path]
+"""
+import datetime
+from bidi.algorithm import get_display
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import mm
+from reportlab.lib.styles import ParagraphStyle
+from reportlab.platypus import PageBreak, Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+import receiptGen  # noqa: F401  registers the Alef fonts
+from store import HISTORY_FILE, iter_history, parse_date, period_bounds
+from tracing import span
+
+# Rows per platypus Table; small tables split across pages cheaply
+ROWS_PER_TABLE = 40
+COLUMNS = ("Receipt", "Date", "Customer", "Description", "Amount", "VAT %", "VAT", "Net")
+COL_WIDTHS = (18 * mm, 20 * mm, 38 * mm, 48 * mm, 20 * mm, 12 * mm, 16 * mm, 20 * mm)
+_TITLE = ParagraphStyle("title", fontName="Alef-Bold", fontSize=16, leading=20, spaceAfter=6)
+_HEADING = ParagraphStyle("heading", fontName="Alef-Bold", fontSize=12, leading=15, spaceBefore=8, spaceAfter=4)
+_TABLE_STYLE = TableStyle([
+    ("FONTNAME", (0, 0), (-1, -1), "Alef"),
+    ("FONTSIZE", (0, 0), (-1, -1), 8),
+    ("FONTNAME", (0, 0), (-1, 0), "Alef-Bold"),
+    ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#e8e8e8")),
+    ("ALIGN", (4, 0), (-1, -1), "RIGHT"),
+    ("LINEBELOW", (0, 0), (-1, 0), 0.5, colors.grey),
+    ("BOTTOMPADDING", (0, 0), (-1, -1), 1.5),
+    ("TOPPADDING", (0, 0), (-1, -1), 1.5),
+])
+_TOTAL_STYLE = TableStyle([
+    ("FONTNAME", (0, 0), (-1, -1), "Alef-Bold"),
+    ("FONTSIZE", (0, 0), (-1, -1), 8),
+    ("ALIGN", (1, 0), (-1, -1), "RIGHT"),
+    ("LINEABOVE", (0, 0), (-1, 0), 0.5, colors.grey),
+])
+
+
+def _amount(value):
+    try:
+        return round(float(str(value).replace(",", "").strip()), 2)
+    except ValueError:
+        return 0.0
+
+
+def _rate(value):
+    try:
+        return float(str(value).replace("%", "").strip())
+    except ValueError:
+        return 0.0
+
+
+def _heb(text, limit=None):
+    text = str(text or "")
+    if limit and len(text) > limit:
+        text = text[:limit - 1] + "…"
+    return get_display(text)
+
+
+def _money(value):
+    return f"{value:,.2f}"
+
+
+class Totals:
+    """Running sums of amount, VAT and receipt count."""
+    __slots__ = ("amount", "vat", "count")
+
+    def __init__(self):
+        self.amount = 0.0
+        self.vat = 0.0
+        self.count = 0
+
+    def add(self, amount, vat):
+        self.amount += amount
+        self.vat += vat
+        self.count += 1
+
+    def row(self, label):
+        return [label, str(self.count), _money(self.amount), _money(self.vat), _money(self.amount - self.vat)]
+
+
+def _totals_table(rows):
+    table = Table([["", "Receipts", "Amount", "VAT", "Net"]] + rows,
+                  colWidths=(60 * mm, 22 * mm, 28 * mm, 24 * mm, 28 * mm), repeatRows=1)
+    table.setStyle(_TOTAL_STYLE)
+    return table
+
+
+def _rows_table(rows):
+    table = Table([list(COLUMNS)] + rows, colWidths=COL_WIDTHS, repeatRows=1)
+    table.setStyle(_TABLE_STYLE)
+    return table
+
+
+def _month_records(history_path, year, month):
+    start, end = period_bounds(year, month)
+    try:
+        records = list(iter_history(history_path, start, end))
+    except FileNotFoundError:
+        return []
+    # By date, then receipt number, as the Excel export orders them
+    records.sort(key=lambda r: (parse_date(r[2].get("Date", "")), r[0]))
+    return records
+
+
+def report_flowables(year, history_path=HISTORY_FILE, progress=None):
+    """Yield the report's flowables; history is read one month at a time as they are consumed."""
+    year_totals = Totals()
+    by_customer = {}
+    by_rate = {}
+    by_month = []
+    yield Paragraph(f"Income report {year}", _TITLE)
+    yield Paragraph(f"Generated {datetime.date.today():%d/%m/%Y}", _HEADING)
+    for month in range(1, 13):
+        with span("report.month"):
+            records = _month_records(history_path, year, month)
+        month_totals = Totals()
+        month_customers = {}
+        rows = []
+        if records:
+            yield Paragraph(datetime.date(year, month, 1).strftime("%B %Y"), _HEADING)
+        for key, cust, data in records:
+            amount = _amount(data.get("payment"))
+            rate = _rate(data.get("mamVal"))
+            vat = round(amount * rate / (100 + rate), 2) if rate else 0.0
+            for totals in (month_totals, year_totals, month_customers.setdefault(cust, Totals()),
+                           by_customer.setdefault(cust, Totals()), by_rate.setdefault(rate, Totals())):
+                totals.add(amount, vat)
+            rows.append([data.get("recipeNum", key), data.get("Date", ""), _heb(cust, 24),
+                         _heb(data.get("discription"), 32), _money(amount), f"{rate:g}", _money(vat), _money(amount - vat)])
+            if len(rows) == ROWS_PER_TABLE:
+                yield _rows_table(rows)
+                rows = []
+        if rows:
+            yield _rows_table(rows)
+        if records:
+            yield Spacer(1, 2 * mm)
+            yield _totals_table([t.row(_heb(c, 30)) for c, t in sorted(month_customers.items())]
+                                + [month_totals.row(f"Total {datetime.date(year, month, 1):%B}")])
+        by_month.append((month, month_totals))
+        if progress:
+            progress(month, 12)
+    yield PageBreak()
+    yield Paragraph(f"Summary {year}", _TITLE)
+    yield Paragraph("By month", _HEADING)
+    yield _totals_table([t.row(datetime.date(year, m, 1).strftime("%B")) for m, t in by_month]
+                        + [year_totals.row(f"Total {year}")])
+    yield Paragraph("By customer", _HEADING)
+    yield _totals_table([t.row(_heb(c, 30)) for c, t in sorted(by_customer.items())])
+    yield Paragraph("VAT", _HEADING)
+    yield _totals_table([t.row(f"VAT {r:g}%") for r, t in sorted(by_rate.items())]
+                        + [year_totals.row("Total")])
+
+
+class _LazyStory(list):
+    """
+    A story that pulls flowables from an iterator as platypus consumes it.
+
+    DocTemplate.build() checks len() before each flowable, so only a few tables
+    are ever built ahead of the page being laid out.
+    """
+
+    def __init__(self, flowables, ahead=3):
+        super().__init__()
+        self._source = iter(flowables)
+        self._ahead = ahead
+
+    def __len__(self):
+        while list.__len__(self) < self._ahead:
+            try:
+                self.append(next(self._source))
+            except StopIteration:
+                break
+        return list.__len__(self)
+
+
+def _page_number(canvas, doc):
+    canvas.setFont("Alef", 8)
+    canvas.drawRightString(A4[0] - 12 * mm, 8 * mm, f"{doc.page}")
+
+
+def build_report(year, out_path, history_path=HISTORY_FILE, progress=None):
+    """Write the year report for `year` to `out_path`."""
+    doc = SimpleDocTemplate(out_path, pagesize=A4, leftMargin=10 * mm, rightMargin=10 * mm,
+                            topMargin=12 * mm, bottomMargin=14 * mm, title=f"Income report {year}")
+    with span("report.build"):
+        doc.build(_LazyStory(report_flowables(year, history_path, progress)),
+                  onFirstPage=_page_number, onLaterPages=_page_number)
+    return out_path
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Year-end income report PDF")
+    parser.add_argument("year", type=int)
+    parser.add_argument("--out", help="output PDF (default: income_report_<year>.pdf)")
+    parser.add_argument("--history", default=HISTORY_FILE)
+    args = parser.parse_args()
+    out = build_report(args.year, args.out or f"income_report_{args.year}.pdf", args.history)
+    print(f"Wrote {out}")
@@ -0,0 +1,151 @@
+"""Export the receipt PDFs of a period into a single ZIP with a manifest CSV.
+
+Saved PDFs found under the record's SaveFolder are streamed from disk into the
+archive; records without a saved file are rendered in a process pool. Only a
+small window of renders is in flight at once and each PDF is written to the
+ZIP as soon as it is ready, so memory use does not grow with the period size.
+"""
+import os
+import io
+import csv
+import glob
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from store import HISTORY_FILE, iter_history, iter_records, record_matches, receipt_filename
+
+MANIFEST_FIELDS = ["key", "recipeNum", "customer", "Date", "payment", "source", "file"]
+
+
+def select_records(history, start=None, end=None, customer=None):
+    """Return [(key, customer, data)] whose Date falls in [start, end] and customer matches."""
+    return [(key, cust, data) for key, cust, data in iter_records(history)
+            if record_matches(cust, data, start, end, customer)]
+
+
+def select_records_from_file(path=HISTORY_FILE, start=None, end=None, customer=None):
+    """Like select_records, but streams the history file so only matching records are kept."""
+    return sorted(iter_history(path, start, end, customer), key=lambda rec: rec[0])
+
+
+def find_saved_pdf(data, listing_cache=None):
+    """Locate an already saved PDF for this record in its SaveFolder, or None.
+
+    Pass the same dict as `listing_cache` across calls to list each folder only once.
+    """
+    if listing_cache is None:
+        listing_cache = {}
+    folder = data.get("SaveFolder")
+    num = data.get("recipeNum", "")
+    if not folder or not num or not os.path.isdir(folder):
+        return None
+    if folder not in listing_cache:
+        listing_cache[folder] = glob.glob(os.path.join(folder, "*.pdf"))
+    token = f" {num} "
+    for path in listing_cache[folder]:
+        name = os.path.basename(path)
+        if token in f" {os.path.splitext(name)[0]} " and "_recreate" not in name:
+            return path
+    return None
+
+
+def _render(data, profile):
+    # Runs in a worker process
+    from receiptGen import render_receipt
+    return bytes(render_receipt(data, profile=profile))
+
+
+def export_zip(records, zip_path, workers=None, render_missing=True, progress=None, profile="standard"):
+    """
+    Write the PDFs for `records` (as returned by select_records) into `zip_path`.
+
+    Returns the number of PDFs written. `progress(done, total)` is called after each one.
+    """
+    workers = workers or min(4, os.cpu_count() or 1)
+    window = workers * 2
+    total = len(records)
+    counts = {"done": 0, "written": 0}
+    used_names = set()
+    listings = {}
+    pending = {}
+    manifest = io.StringIO()
+    writer = csv.DictWriter(manifest, fieldnames=MANIFEST_FIELDS)
+    writer.writeheader()
+
+    def arcname_for(key, cust, data, path=None):
+        name = os.path.basename(path) if path else receipt_filename(cust, data.get("recipeNum", key), data.get("Date", ""))
+        if name in used_names:
+            name = f"{key} {name}"
+        used_names.add(name)
+        return name
+
+    def add_manifest(key, cust, data, source, name):
+        writer.writerow({
+            "key": key,
+            "recipeNum": data.get("recipeNum", ""),
+            "customer": cust,
+            "Date": data.get("Date", ""),
+            "payment": data.get("payment", ""),
+            "source": source,
+            "file": name,
+        })
+
+    def write_rendered(fut):
+        key, cust, data = pending.pop(fut)
+        name = arcname_for(key, cust, data)
+        zf.writestr(name, fut.result())
+        add_manifest(key, cust, data, "rendered", name)
+        counts["written"] += 1
+        tick()
+
+    def drain(limit):
+        # Block until fewer than `limit` renders are in flight, writing each as it finishes
+        while pending and len(pending) >= limit:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                write_rendered(fut)
+
+    def tick():
+        counts["done"] += 1
+        if progress:
+            progress(counts["done"], total)
+
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for key, cust, data in records:
+                path = find_saved_pdf(data, listings)
+                if path:
+                    name = arcname_for(key, cust, data, path)
+                    zf.write(path, name)
+                    add_manifest(key, cust, data, "saved", name)
+                    counts["written"] += 1
+                    tick()
+                elif render_missing:
+                    pending[pool.submit(_render, data, profile)] = (key, cust, data)
+                    drain(window)
+                else:
+                    add_manifest(key, cust, data, "missing", "")
+                    tick()
+            drain(1)
+        zf.writestr("manifest.csv", "\ufeff" + manifest.getvalue())
+    return counts["written"]
+
+
+if __name__ == "__main__":
+    import argparse
+    from store import period_bounds
+    parser = argparse.ArgumentParser(description="Export receipt PDFs for a period into a ZIP")
+    parser.add_argument("zip_path")
+    parser.add_argument("--year", type=int, required=True)
+    parser.add_argument("--month", type=int)
+    parser.add_argument("--quarter", type=int)
+    parser.add_argument("--customer")
+    parser.add_argument("--history", default=None, help="history.json path (defaults to DB_DIR)")
+    parser.add_argument("--no-render", action="store_true", help="only collect saved PDFs")
+    parser.add_argument("--compact", action="store_true", help="render missing PDFs with the compact profile")
+    args = parser.parse_args()
+    start, end = period_bounds(args.year, args.month, args.quarter)
+    recs = select_records_from_file(args.history or HISTORY_FILE, start, end, args.customer)
+    count = export_zip(recs, args.zip_path, render_missing=not args.no_render,
+                       profile="compact" if args.compact else "standard",
+                       progress=lambda d, t: print(f"\r{d}/{t}", end=""))
+    print(f"\nWrote {count} receipts to {args.zip_path}")